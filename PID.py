@@ -1,6 +1,7 @@
 """
-PID loop controller
+PID loop controllers
 """
+import numpy as np
 
 # pylint: disable=invalid-name
 # pylint: disable=too-many-arguments
@@ -95,3 +96,124 @@ class PID:
         Get Derivator
         """
         return self.Derivator
+
+class PIDBank:
+    """
+    Many discrete PID controllers held in arrays
+
+    Each element follows PID.update above. The shape is set by
+    broadcasting the coefficients and set point, e.g. (2, 1) for the
+    X and Y loops of the guider or (n_axes, n_controllers) for a
+    tuning sweep, or given explicitly with shape
+    """
+    def __init__(self, P=0.5, I=0.25, D=0.0, set_point=0.0, shape=None,
+                 Integrator_max=500, Integrator_min=-500):
+        if shape is None:
+            shape = np.broadcast(P, I, D, set_point).shape
+        self.shape = tuple(shape)
+        self.Integrator_max = Integrator_max
+        self.Integrator_min = Integrator_min
+        self.reset(P, I, D, set_point)
+    def _full(self, value):
+        """
+        Broadcast a value to the bank shape, as a new array
+        """
+        return np.array(np.broadcast_to(value, self.shape), dtype=float)
+    def reset(self, P=None, I=None, D=None, set_point=None):
+        """
+        Clear the controller states, optionally with new
+        coefficients and set points, as building new PIDs would
+        """
+        if P is not None:
+            self.Kp = self._full(P)
+        if I is not None:
+            self.Ki = self._full(I)
+        if D is not None:
+            self.Kd = self._full(D)
+        if set_point is not None:
+            self.set_point = self._full(set_point)
+        self.Integrator = np.zeros(self.shape)
+        self.Derivator = np.zeros(self.shape)
+        self.error = np.zeros(self.shape)
+    def update(self, current_value, active=None):
+        """
+        Calculate the PID outputs for given feedback values
+
+        Controllers where active is False are left untouched
+        and output 0, as for frames the guider does not correct
+        """
+        error = self.set_point - current_value
+        integrator = np.clip(self.Integrator + error, self.Integrator_min, self.Integrator_max)
+        pid = self.Kp * error + self.Ki * integrator + self.Kd * (error - self.Derivator)
+        if active is None:
+            self.error, self.Integrator, self.Derivator = self._full(error), integrator, self._full(error)
+            return pid
+        self.error = np.where(active, error, self.error)
+        self.Integrator = np.where(active, integrator, self.Integrator)
+        self.Derivator = np.where(active, error, self.Derivator)
+        return np.where(active, pid, 0.0)
+    def updateSequence(self, values, active=None):
+        """
+        Run update over a sequence of feedback values, the first
+        axis of values (and active) is time. Returns the outputs,
+        shape (len(values), ) + shape
+        """
+        values = np.asarray(values, dtype=float)
+        out = np.empty((len(values), ) + self.shape)
+        for i, value in enumerate(values):
+            out[i] = self.update(value, None if active is None else active[i])
+        return out
+    def setPoint(self, set_point, where=None):
+        """
+        Set the setpoints, clearing the integrators and derivators
+        of the controllers changed (all, or where True)
+        """
+        where = np.ones(self.shape, dtype=bool) if where is None else np.broadcast_to(where, self.shape)
+        self.set_point = np.where(where, set_point, self.set_point)
+        self.Integrator = np.where(where, 0.0, self.Integrator)
+        self.Derivator = np.where(where, 0.0, self.Derivator)
+    def setKp(self, P):
+        """
+        Set Kp
+        """
+        self.Kp = self._full(P)
+    def setKi(self, I):
+        """
+        Set Ki
+        """
+        self.Ki = self._full(I)
+    def setKd(self, D):
+        """
+        Set Kd
+        """
+        self.Kd = self._full(D)
+    def getPoint(self):
+        """
+        Get points
+        """
+        return self.set_point
+    def getError(self):
+        """
+        Get Errors
+        """
+        return self.error
+    def snapshot(self):
+        """
+        Get the full bank state as a dict of nested lists
+        """
+        state = {key: getattr(self, key).tolist()
+                 for key in ('Kp', 'Ki', 'Kd', 'Derivator', 'Integrator',
+                             'set_point', 'error')}
+        state.update({'Integrator_max': self.Integrator_max,
+                      'Integrator_min': self.Integrator_min,
+                      'shape': list(self.shape)})
+        return state
+    def restore(self, state):
+        """
+        Restore the bank state from snapshot()
+        """
+        self.shape = tuple(state['shape'])
+        self.Integrator_max = state['Integrator_max']
+        self.Integrator_min = state['Integrator_min']
+        for key in ('Kp', 'Ki', 'Kd', 'Derivator', 'Integrator', 'set_point', 'error'):
+            setattr(self, key, self._full(state[key]))
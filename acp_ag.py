@@ -3,13 +3,35 @@ ACP + DONUTS Autoguiding
 
 Usage:
     $> python acp_ag.py INSTRUMENT
+    $> python acp_ag.py --warm
+    $> python acp_ag.py INSTRUMENT --backend sim --sim_dir /tmp/donuts_sim
+    $> python acp_ag.py INSTRUMENT --replay NIGHT_DIR [NIGHT_DIR ...] --replay_out OUT_DIR
 
 where INSTRUMENT can be:
-    nites, io, europa, callisto, ganymede, saintex, artemis
+    nites, io, europa, callisto, ganymede, saintex, artemis, rcos20
+
+With --warm the process imports everything it needs and then
+waits for a 'start INSTRUMENT' line on stdin before loading that
+instrument's configuration and guiding. This is how the process
+handler keeps pre-imported workers ready for any of its instruments.
+
+With --backend sim the telescope and camera are simulated (see
+ag_simulator.py). The simulated camera writes frames into tonight's
+folder under --sim_dir, which replaces BASE_DIR and AUTOGUIDER_REF_DIR,
+and the Sun altitude check is switched off. --sim_db swaps the MySQL
+database for a local SQLite file (see ag_sqlite.py).
+
+With --replay archived nights are fed through the guide loop in the
+order the frames were taken, with the guide pulses recorded rather than
+sent (see ag_replay.py). Logs, references and the SQLite database go to
+a folder per night under --replay_out. Given several nights, each is
+replayed in its own process, --replay_jobs at a time.
 """
 import time
 import os
 import sys
+import atexit
+import signal
 from contextlib import contextmanager
 from shutil import copyfile
 from datetime import (
@@ -24,7 +46,6 @@ from collections import defaultdict
 import argparse as ap
 import glob as g
 import numpy as np
-import win32com.client
 import pymysql
 from astropy.io import fits
 import astropy.units as u
@@ -34,7 +55,45 @@ from astropy.coordinates import (
     AltAz,
     get_sun
     )
-from PID import PID
+from PID import PIDBank
+from ref_registry import ReferenceRegistry
+from guide_log import (
+    STAGES,
+    BinaryGuideLog,
+    StageTimer,
+    getBinaryLogPath
+    )
+from ag_channel import emitStatus
+from ag_config import CommandReader
+from ag_profiler import FrameProfiler
+from ag_hardware import (
+    BACKENDS,
+    getBackend
+    )
+from ag_replay import (
+    REPLAY_DB_FILE,
+    nightName,
+    replayNights
+    )
+from ag_sqlite import (
+    SqliteDb,
+    createSchema
+    )
+from ag_watchdog import (
+    DEFAULT_DEADLINES,
+    WATCHDOG_DUMP_FILE,
+    FrameStalled,
+    Watchdog
+    )
+from ag_state import (
+    getStatePath,
+    saveState,
+    loadState
+    )
+from utils import (
+    INSTRUMENT_CONFIGS,
+    get_config_values
+    )
 from donuts import Donuts
 
 # pylint: disable = invalid-name
@@ -47,6 +106,11 @@ from donuts import Donuts
 # autoguider status flags
 ag_new_day, ag_new_start, ag_new_field, ag_new_filter, ag_no_change = range(5)
 
+# database timeouts (s), so a hung server cannot block the guide loop
+DB_CONNECT_TIMEOUT = 5
+DB_READ_TIMEOUT = 10
+DB_WRITE_TIMEOUT = 10
+
 # get command line arguments
 def argParse():
     """
@@ -66,11 +130,69 @@ def argParse():
     """
     p = ap.ArgumentParser()
     p.add_argument('instrument',
-                   help='select an instrument',
-                   choices=['io', 'callisto', 'europa',
-                            'ganymede', 'saintex', 'nites',
-                            'artemis', 'rcos20'])
-    return p.parse_args()
+                   help='select an instrument (given on stdin with --warm)',
+                   nargs='?',
+                   choices=sorted(INSTRUMENT_CONFIGS))
+    p.add_argument('--warm',
+                   help='import everything then wait for \'start INSTRUMENT\' on stdin',
+                   action='store_true')
+    p.add_argument('--backend',
+                   help='telescope and camera backend',
+                   choices=BACKENDS,
+                   default='com')
+    sim = p.add_argument_group('simulator', 'options for --backend sim')
+    sim.add_argument('--sim_dir',
+                     help='folder to hold the simulated nights and reference images')
+    sim.add_argument('--sim_speedup',
+                     help='simulated seconds per real second',
+                     type=float,
+                     default=1.)
+    sim.add_argument('--sim_field',
+                     help='name of the simulated field',
+                     default='SIM-FIELD')
+    sim.add_argument('--sim_filter',
+                     help='name of the simulated filter',
+                     default='I+z')
+    sim.add_argument('--sim_exptime',
+                     help='simulated exposure time (s)',
+                     type=float,
+                     default=30.)
+    sim.add_argument('--sim_frames',
+                     help='number of frames to simulate, 0 to leave the camera idle',
+                     type=int,
+                     default=100)
+    sim.add_argument('--sim_shape',
+                     help='override the detector shape (ny nx)',
+                     type=int,
+                     nargs=2)
+    sim.add_argument('--sim_events',
+                     help='file to log the guide pulses to, one JSON line each')
+    sim.add_argument('--sim_db',
+                     help='use this SQLite file instead of the MySQL database')
+    sim.add_argument('--sim_db_latency',
+                     help='extra delay per database query with --sim_db (s)',
+                     type=float,
+                     default=0.)
+    replay = p.add_argument_group('replay', 'run over archived nights')
+    replay.add_argument('--replay',
+                        help='folders of archived frames to replay',
+                        nargs='+',
+                        metavar='NIGHT_DIR')
+    replay.add_argument('--replay_out',
+                        help='folder for the replay logs, references and database')
+    replay.add_argument('--replay_jobs',
+                        help='nights to replay at once, default one per CPU',
+                        type=int)
+    args = p.parse_args()
+    if args.instrument is None and not args.warm:
+        p.error('an instrument is required unless --warm is given')
+    if args.backend == 'sim' and not args.sim_dir:
+        p.error('--sim_dir is required with --backend sim')
+    if args.replay and (args.warm or args.backend == 'sim'):
+        p.error('--replay cannot be used with --warm or --backend sim')
+    if args.replay and not args.replay_out:
+        p.error('--replay_out is required with --replay')
+    return args
 
 def getSunAlt(observatory):
     """
@@ -159,10 +281,14 @@ def guide(x, y, images_to_stabilise, gem=False):
         Stddev of X buffer
     sigma_y : float
         Stddev of Y buffer
+    pulses : dict | None
+        Guide pulse duration (ms) sent per direction,
+        None if the correction was rejected by the buffer
 
     Raises
     ------
-    None
+    FrameStalled
+        If the watchdog aborts the pid or guide stage
     """
 
 
@@ -195,7 +321,7 @@ def guide(x, y, images_to_stabilise, gem=False):
                     # was too big, this will allow small outliers to be caught
                     BUFF_X.append(x)
                     BUFF_Y.append(y)
-                    return True, 0.0, 0.0, sigma_x, sigma_y
+                    return True, 0.0, 0.0, sigma_x, sigma_y, None
                 else:
                     pass
         else:
@@ -204,61 +330,67 @@ def guide(x, y, images_to_stabilise, gem=False):
             sigma_x = 0.0
             sigma_y = 0.0
 
-        # update the PID controllers, run them in parallel
-        pidx = PIDx.update(x) * -1
-        pidy = PIDy.update(y) * -1
-
-        # check if we are stabilising and allow for the max shift
-        if images_to_stabilise > 0:
-            if pidx >= CURRENT_MAX_SHIFT:
-                pidx = CURRENT_MAX_SHIFT
-            elif pidx <= -CURRENT_MAX_SHIFT:
-                pidx = -CURRENT_MAX_SHIFT
-            if pidy >= CURRENT_MAX_SHIFT:
-                pidy = CURRENT_MAX_SHIFT
-            elif pidy <= -CURRENT_MAX_SHIFT:
-                pidy = -CURRENT_MAX_SHIFT
+        with frame_timer.span('pid'):
+            # update the X and Y PID controllers together
+            pidx, pidy = (float(v) for v in pid_bank.update([[x], [y]])[:, 0] * -1)
+
+            # check if we are stabilising and allow for the max shift
+            if images_to_stabilise > 0:
+                if pidx >= CURRENT_MAX_SHIFT:
+                    pidx = CURRENT_MAX_SHIFT
+                elif pidx <= -CURRENT_MAX_SHIFT:
+                    pidx = -CURRENT_MAX_SHIFT
+                if pidy >= CURRENT_MAX_SHIFT:
+                    pidy = CURRENT_MAX_SHIFT
+                elif pidy <= -CURRENT_MAX_SHIFT:
+                    pidy = -CURRENT_MAX_SHIFT
         logMessageToDb(args.instrument, "PID: {0:.2f}  {1:.2f}".format(float(pidx), float(pidy)))
 
+        pulses = {}
         # make another check that the post PID values are not > Max allowed
         # using >= allows for the stabilising runs to get through
         # abs() on -ve duration otherwise throws back an error
-        if pidy > 0 and pidy <= CURRENT_MAX_SHIFT:
-            guide_time_y = pidy * PIX2TIME['+y']
-            if RA_AXIS == 'y':
-                guide_time_y = guide_time_y/cos_dec
-            myScope.PulseGuide(DIRECTIONS['+y'], guide_time_y)
-        if pidy < 0 and pidy >= -CURRENT_MAX_SHIFT:
-            guide_time_y = abs(pidy * PIX2TIME['-y'])
-            if RA_AXIS == 'y':
-                guide_time_y = guide_time_y/cos_dec
-            myScope.PulseGuide(DIRECTIONS['-y'], guide_time_y)
-        while myScope.IsPulseGuiding == 'True':
-            time.sleep(0.01)
-        if pidx > 0 and pidx <= CURRENT_MAX_SHIFT:
-            guide_time_x = pidx * PIX2TIME['+x']
-            if RA_AXIS == 'x':
-                guide_time_x = guide_time_x/cos_dec
-            myScope.PulseGuide(DIRECTIONS['+x'], guide_time_x)
-        if pidx < 0 and pidx >= -CURRENT_MAX_SHIFT:
-            guide_time_x = abs(pidx * PIX2TIME['-x'])
-            if RA_AXIS == 'x':
-                guide_time_x = guide_time_x/cos_dec
-            myScope.PulseGuide(DIRECTIONS['-x'], guide_time_x)
-        while myScope.IsPulseGuiding == 'True':
-            time.sleep(0.01)
+        with frame_timer.span('guide'):
+            if pidy > 0 and pidy <= CURRENT_MAX_SHIFT:
+                guide_time_y = pidy * PIX2TIME['+y']
+                if RA_AXIS == 'y':
+                    guide_time_y = guide_time_y/cos_dec
+                myScope.PulseGuide(DIRECTIONS['+y'], guide_time_y)
+                pulses['+y'] = guide_time_y
+            if pidy < 0 and pidy >= -CURRENT_MAX_SHIFT:
+                guide_time_y = abs(pidy * PIX2TIME['-y'])
+                if RA_AXIS == 'y':
+                    guide_time_y = guide_time_y/cos_dec
+                myScope.PulseGuide(DIRECTIONS['-y'], guide_time_y)
+                pulses['-y'] = guide_time_y
+            while myScope.IsPulseGuiding == 'True':
+                time.sleep(0.01)
+            if pidx > 0 and pidx <= CURRENT_MAX_SHIFT:
+                guide_time_x = pidx * PIX2TIME['+x']
+                if RA_AXIS == 'x':
+                    guide_time_x = guide_time_x/cos_dec
+                myScope.PulseGuide(DIRECTIONS['+x'], guide_time_x)
+                pulses['+x'] = guide_time_x
+            if pidx < 0 and pidx >= -CURRENT_MAX_SHIFT:
+                guide_time_x = abs(pidx * PIX2TIME['-x'])
+                if RA_AXIS == 'x':
+                    guide_time_x = guide_time_x/cos_dec
+                myScope.PulseGuide(DIRECTIONS['-x'], guide_time_x)
+                pulses['-x'] = guide_time_x
+            while myScope.IsPulseGuiding == 'True':
+                time.sleep(0.01)
         logMessageToDb(args.instrument, "Guide correction Applied")
         # store the original values in the buffer
         # only if we are not stabilising
         if images_to_stabilise < 0:
             BUFF_X.append(x)
             BUFF_Y.append(y)
-        return True, pidx, pidy, sigma_x, sigma_y
+        return True, pidx, pidy, sigma_x, sigma_y, pulses
     else:
         logMessageToDb(args.instrument, "Telescope NOT connected!")
         logMessageToDb(args.instrument, "Please connect Telescope via ACP!")
         logMessageToDb(args.instrument, "Ignoring corrections!")
-        return False, 0.0, 0.0, 0.0, 0.0
+        return False, 0.0, 0.0, 0.0, 0.0, {}
 
 # log guide corrections to file
 def logShiftsToFile(logfile, loglist, header=False):
@@ -300,6 +432,8 @@ def logShiftsToFile(logfile, loglist, header=False):
             Culled X measurement if > max allowed shift (y | n)
         culled_max_shift_y : string
             Culled Y measurement if > max allowed shift (y | n)
+        t_detect ... t_db : string
+            Duration of each stage in guide_log.STAGES (s)
     header : boolean
         Flag to set writing the log file header. This is done
         at the start of the night only
@@ -314,7 +448,8 @@ def logShiftsToFile(logfile, loglist, header=False):
     """
     if header:
         line = "night  ref  check  stable  shift_x  shift_y  pre_pid_x  pre_pid_y  " \
-               "post_pid_x  post_pid_y  std_buff_x  std_buff_y  culled_x  culled_y"
+               "post_pid_x  post_pid_y  std_buff_x  std_buff_y  culled_x  culled_y  " \
+               "{}".format("  ".join(["t_{}".format(stage) for stage in STAGES]))
     else:
         line = "  ".join(loglist)
     with open(logfile, "a") as outfile:
@@ -343,8 +478,15 @@ def openDb(host, user, db, passwd):
     ------
     None
     """
+    if args.sim_db:
+        with SqliteDb(args.sim_db, args.sim_db_latency) as cur:
+            yield cur
+        return
     with pymysql.connect(host=host, user=user,
-                         db=db, password=passwd) as cur:
+                         db=db, password=passwd,
+                         connect_timeout=DB_CONNECT_TIMEOUT,
+                         read_timeout=DB_READ_TIMEOUT,
+                         write_timeout=DB_WRITE_TIMEOUT) as cur:
         yield cur
 
 def logShiftsToDb(qry_args):
@@ -355,7 +497,9 @@ def logShiftsToDb(qry_args):
     ----------
     qry_args : array like
         Tuple of items to log in the database.
-        See itemised list in logShiftsToFile docstring
+        See itemised list in logShiftsToFile docstring.
+        The stage durations are the StageTimer values
+        before this insert, so t_db excludes the insert itself
 
     Returns
     -------
@@ -369,10 +513,12 @@ def logShiftsToDb(qry_args):
         INSERT INTO autoguider_log_new
         (night, reference, comparison, stabilised, shift_x, shift_y,
          pre_pid_x, pre_pid_y, post_pid_x, post_pid_y, std_buff_x,
-         std_buff_y, culled_max_shift_x, culled_max_shift_y)
+         std_buff_y, culled_max_shift_x, culled_max_shift_y,
+         t_detect, t_load, t_measure, t_pid, t_guide, t_db)
         VALUES
         (%s, %s, %s, %s, %s, %s, %s,
-         %s, %s, %s, %s, %s, %s, %s)
+         %s, %s, %s, %s, %s, %s, %s,
+         %s, %s, %s, %s, %s, %s)
         """
     with openDb(DB_HOST, DB_USER, DB_DATABASE, DB_PASS) as cur:
         cur.execute(qry, qry_args)
@@ -403,9 +549,59 @@ def logMessageToDb(telescope, message):
         (%s, %s)
         """
     qry_args = (telescope, message)
-    with openDb(DB_HOST, DB_USER, DB_DATABASE, DB_PASS) as cur:
-        cur.execute(qry, qry_args)
+    # a message is not worth losing the frame over
+    try:
+        with frame_timer.span('db'), openDb(DB_HOST, DB_USER, DB_DATABASE, DB_PASS) as cur:
+            cur.execute(qry, qry_args)
+    except (pymysql.MySQLError, FrameStalled) as err:
+        print('Failed to log message to database: {}'.format(err))
+    # also stream it to the process handler
+    emitStatus('message', telescope=telescope, message=message)
+
+def logStallToDb(stage, elapsed, dump_path, aborted):
+    """
+    Record a guide loop stall caught by the watchdog.
+    Called from the watchdog thread, so the stall is not
+    timed as part of the frame
+
+    Parameters
+    ----------
+    stage : string
+        Name of the stalled stage, see STAGES
+    elapsed : float
+        Seconds spent in the stage when the stall was caught
+    dump_path : string | None
+        File holding the stacks of all threads
+    aborted : boolean
+        Was the frame aborted?
 
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    deadline = watchdog.deadlines[stage]
+    print('Stage {} stalled for {:.1f}s (deadline {:.1f}s), stacks in {}'.format(stage, elapsed,
+                                                                            deadline, dump_path))
+    emitStatus('stall', stage=stage, elapsed=elapsed, deadline=deadline,
+               aborted=aborted, dump_file=dump_path)
+    qry = """
+        INSERT INTO autoguider_stall_log
+        (telescope, night, comparison, stage, elapsed,
+         deadline, aborted, dump_file)
+        VALUES
+        (%s, %s, %s, %s, %s, %s, %s, %s)
+        """
+    qry_args = (args.instrument, globals().get('night'), globals().get('check_file'),
+                stage, elapsed, deadline, 'y' if aborted else 'n', dump_path)
+    try:
+        with openDb(DB_HOST, DB_USER, DB_DATABASE, DB_PASS) as cur:
+            cur.execute(qry, qry_args)
+    except pymysql.MySQLError as err:
+        print('Failed to log stall to database: {}'.format(err))
 
 # get evening or morning
 def getAmOrPm():
@@ -442,18 +638,21 @@ def getAmOrPm():
     return token
 
 # get tonights directory
-def getDataDir(data_subdir):
+def getNightDir(data_subdir):
     """
-    Get tonight's data directory
+    Get the path to tonight's data directory, whether it exists or not
 
     Parameters
     ----------
-    None
+    data_subdir : string
+        subdirectory of data folder for raw data
 
     Returns
     -------
     data_loc : string
         Path to tonight's data directory
+    night_str : string
+        Tonight's date, YYYY-mm-dd
 
     Raises
     ------
@@ -463,11 +662,37 @@ def getDataDir(data_subdir):
     d = date.today()-timedelta(days=token)
     night = "{:d}{:02d}{:02d}".format(d.year, d.month, d.day)
     night_str = "{:d}-{:02d}-{:02d}".format(d.year, d.month, d.day)
-    data_loc = "{}\\{}".format(BASE_DIR, night)
+    data_loc = os.path.join(BASE_DIR, night)
     # adds capability for data to live in folders
     # inside the nightly folder, as for saintex
     if data_subdir != "":
-        data_loc = data_loc + "\\{}".format(data_subdir)
+        data_loc = os.path.join(data_loc, data_subdir)
+    return data_loc, night_str
+
+def getDataDir(data_subdir):
+    """
+    Get tonight's data directory
+
+    Parameters
+    ----------
+    data_subdir : string
+        subdirectory of data folder for raw data
+
+    Returns
+    -------
+    data_loc : string | None
+        Path to tonight's data directory, None if it does not exist yet
+    night_str : string
+        Tonight's date, YYYY-mm-dd
+
+    Raises
+    ------
+    None
+    """
+    if args.replay:
+        # the archived night being replayed
+        return hardware.night_dir, hardware.night
+    data_loc, night_str = getNightDir(data_subdir)
     if os.path.exists(data_loc):
         return data_loc, night_str
     else:
@@ -515,54 +740,67 @@ def waitForImage(data_subdir, current_field, n_images, current_filter,
     None
     """
     while 1:
-        # check for new data directory, i.e. tomorrow
-        new_data_dir, _ = getDataDir(data_subdir)
-        if new_data_dir != current_data_dir:
-            return ag_new_day, None, None, None
-        # secondary check, check the sun altitude, quit if > 0
-        sunalt = getSunAlt(observatory)
-        if sunalt > SUNALT_LIMIT:
-            return ag_new_day, None, None, None
-        # check for new images
-        t = g.glob('*{}'.format(IMAGE_EXTENSION))
-        if len(t) > n_images:
+        if args.replay:
+            # archived frames come in the order they were taken,
+            # the last one ends the night
+            newest_image = hardware.nextFrame()
+            if newest_image is None:
+                return ag_new_day, None, None, None
+        else:
+            # check for new data directory, i.e. tomorrow
+            new_data_dir, _ = getDataDir(data_subdir)
+            if new_data_dir != current_data_dir:
+                return ag_new_day, None, None, None
+            # secondary check, check the sun altitude, quit if > 0
+            sunalt = getSunAlt(observatory)
+            if sunalt > SUNALT_LIMIT:
+                return ag_new_day, None, None, None
+            # check for new images
+            t = g.glob('*{}'.format(IMAGE_EXTENSION))
+            # if no new images, wait for a bit
+            if len(t) <= n_images:
+                time.sleep(0.1)
+                continue
             # get newest image
             try:
                 newest_image = max(t, key=os.path.getctime)
             except ValueError:
                 # if the intial list is empty, just cycle back and try again
                 continue
-            # open the newest image and check the field and filter
-            try:
-                with fits.open(newest_image) as fitsfile:
-                    newest_filter = fitsfile[0].header[FILTER_KEYWORD]
-                    newest_field = fitsfile[0].header[FIELD_KEYWORD]
-            except FileNotFoundError:
-                # if the file cannot be accessed (not completely written to disc yet)
-                # cycle back and try again
-                logMessageToDb(args.instrument,
-                               'Problem accessing fits file {}, skipping...'.format(newest_image))
-                continue
-            except OSError:
-                # this catches the missing header END card
-                logMessageToDb(args.instrument,
-                               'Problem accessing fits file {}, skipping...'.format(newest_image))
-                continue
-            # new start? if so, return the newest image info
-            if current_field == "" and current_filter == "":
-                return ag_new_start, newest_image, newest_field, newest_filter
-            # check that the field is the same
-            if current_field != "" and current_field != newest_field:
-                return ag_new_field, newest_image, newest_field, newest_filter
-            # check that the field is the same but filter has changed
-            if current_field != "" and current_field == newest_field and current_filter != newest_filter:
-                return ag_new_filter, newest_image, newest_field, newest_filter
-            # check the field and filters are the same
-            if current_field != "" and current_field == newest_field and current_filter == newest_filter:
-                return ag_no_change, newest_image, newest_field, newest_filter
-        # if no new images, wait for a bit
-        else:
-            time.sleep(0.1)
+        # open the newest image and check the field and filter, this is
+        # the frame's first open so the watchdog watches it as a load
+        try:
+            with frame_timer.span('load'), fits.open(newest_image) as fitsfile:
+                newest_filter = fitsfile[0].header[FILTER_KEYWORD]
+                newest_field = fitsfile[0].header[FIELD_KEYWORD]
+        except FrameStalled:
+            logMessageToDb(args.instrument,
+                           'Stalled reading the header of {}, skipping...'.format(newest_image))
+            emitStatus('dropped', reason='stalled')
+            continue
+        except FileNotFoundError:
+            # if the file cannot be accessed (not completely written to disc yet)
+            # cycle back and try again
+            logMessageToDb(args.instrument,
+                           'Problem accessing fits file {}, skipping...'.format(newest_image))
+            continue
+        except OSError:
+            # this catches the missing header END card
+            logMessageToDb(args.instrument,
+                           'Problem accessing fits file {}, skipping...'.format(newest_image))
+            continue
+        # new start? if so, return the newest image info
+        if current_field == "" and current_filter == "":
+            return ag_new_start, newest_image, newest_field, newest_filter
+        # check that the field is the same
+        if current_field != "" and current_field != newest_field:
+            return ag_new_field, newest_image, newest_field, newest_filter
+        # check that the field is the same but filter has changed
+        if current_field != "" and current_field == newest_field and current_filter != newest_filter:
+            return ag_new_filter, newest_image, newest_field, newest_filter
+        # check the field and filters are the same
+        if current_field != "" and current_field == newest_field and current_filter == newest_filter:
+            return ag_no_change, newest_image, newest_field, newest_filter
 
 def rotateAxes(x, y, theta):
     """
@@ -631,9 +869,13 @@ def splitObjectIdIntoPidCoeffs(filename):
 
 def getReferenceImage(field, filt):
     """
-    Look in the database for the current
+    Look in the reference registry for the current
     field/filter reference image
 
+    The registry holds all valid references for this telescope
+    in memory and reloads itself if setnewrefimage.py or
+    stopcurrentrefimage.py have changed the autoguider_ref table
+
     Parameters
     ----------
     field : string
@@ -651,24 +893,7 @@ def getReferenceImage(field, filt):
     ------
     None
     """
-    tnow = datetime.utcnow().isoformat().split('.')[0].replace('T', ' ')
-    qry = """
-        SELECT ref_image
-        FROM autoguider_ref
-        WHERE field = %s
-        AND filter = %s
-        AND valid_from < %s
-        AND valid_until IS NULL
-        """
-    qry_args = (field, filt, tnow)
-    with openDb(DB_HOST, DB_USER, DB_DATABASE, DB_PASS) as cur:
-        cur.execute(qry, qry_args)
-    result = cur.fetchone()
-    if not result:
-        ref_image = None
-    else:
-        ref_image = "{}\\{}".format(AUTOGUIDER_REF_DIR, result[0])
-    return ref_image
+    return ref_registry.lookup(field, filt)
 
 def setReferenceImage(field, filt, ref_image, telescope):
     """
@@ -702,38 +927,173 @@ def setReferenceImage(field, filt, ref_image, telescope):
     qry_args = (field, telescope, ref_image, filt, tnow)
     with openDb(DB_HOST, DB_USER, DB_DATABASE, DB_PASS) as cur:
         cur.execute(qry, qry_args)
+    ref_registry.add(field, filt, ref_image)
     # copy the file to the autoguider_ref location
     #os.system('cp {} {}'.format(ref_image, AUTOGUIDER_REF_DIR))
-    copyfile(ref_image, "{}/{}".format(AUTOGUIDER_REF_DIR, ref_image))
+    copyfile(ref_image, os.path.join(AUTOGUIDER_REF_DIR, ref_image))
+
+def flushGuideLog():
+    """
+    Write any buffered binary guide log records to disc
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    if guide_log is not None:
+        guide_log.flush()
 
 def stopAg(pypath, donutspath):
     """
     Call the donuts_process_handler to stop this guiding job
     """
-    cmd = "{} {}\\donuts_process.py stop".format(pypath, donutspath)
+    flushGuideLog()
+    if args.replay:
+        # nothing to stop, the replayed night is over
+        logMessageToDb(args.instrument,
+                       'Replay finished, {} guide pulses recorded'.format(myScope.n_pulses))
+        sys.exit(0)
+    cmd = "{} {} stop --instrument {}".format(pypath, os.path.join(donutspath, 'donuts_process.py'),
+                                              args.instrument)
     os.system(cmd)
 
+def pidCoeffs(stabilising=False):
+    """
+    PID coefficients and set points for the X and Y
+    loops, shaped for the guider's PIDBank (2 axes, 1 controller)
+
+    Parameters
+    ----------
+    stabilising : boolean
+        Use the P=1.0, I=0.0, D=0.0 pull in loop?
+        Default = False
+
+    Returns
+    -------
+    p, i, d, set_point : np.ndarray
+        Arrays of shape (2, 1), X then Y
+
+    Raises
+    ------
+    None
+    """
+    set_point = np.array([[PID_COEFFS['set_x']], [PID_COEFFS['set_y']]])
+    if stabilising:
+        return np.ones((2, 1)), np.zeros((2, 1)), np.zeros((2, 1)), set_point
+    p, i, d = (np.array([[PID_COEFFS[axis][c]] for axis in ('x', 'y')]) for c in ('p', 'i', 'd'))
+    return p, i, d, set_point
+
+def applyConfigUpdates():
+    """
+    Apply any config updates pushed by the process handler.
+    Called between frames so each frame sees one consistent config
+
+    The PID gains are changed in place, keeping the integrators.
+    During stabilisation the P=1.0 loop is left alone and the new
+    gains are picked up when the PID loop is reset afterwards
+    """
+    update = worker_commands.pending()
+    if not update:
+        return
+    for key, value in sorted(update.items()):
+        logMessageToDb(args.instrument,
+                       'Config reload: {} {} -> {}'.format(key, globals()[key], value))
+    globals().update(update)
+    if 'PID_COEFFS' in update and images_to_stabilise <= 0:
+        p, i, d, set_point = pidCoeffs()
+        pid_bank.setKp(p)
+        pid_bank.setKi(i)
+        pid_bank.setKd(d)
+        changed = pid_bank.getPoint() != set_point
+        if changed.any():
+            pid_bank.setPoint(set_point, where=changed)
+    emitStatus('config', applied=update)
+
 if __name__ == "__main__":
     # read the command line args
     args = argParse()
-    if args.instrument == 'nites':
-        from nites import *
-    elif args.instrument == 'io':
-        from speculoos_io import *
-    elif args.instrument == 'callisto':
-        from speculoos_callisto import *
-    elif args.instrument == 'europa':
-        from speculoos_europa import *
-    elif args.instrument == 'ganymede':
-        from speculoos_ganymede import *
-    elif args.instrument == 'saintex':
-        from saintex import *
-    elif args.instrument == 'artemis':
-        from speculoos_artemis import *
-    elif args.instrument == 'rcos20':
-        from rcos20 import *
+
+    # binary guide log, flushed on exit and when CTRL_BREAK
+    # is received from the process handler
+    guide_log = None
+    # per stage timings of the current frame, see guide_log.STAGES
+    frame_timer = StageTimer()
+    atexit.register(flushGuideLog)
+    if hasattr(signal, 'SIGBREAK'):
+        signal.signal(signal.SIGBREAK, lambda signum, frame: sys.exit(0))
+
+    if args.warm:
+        # the first Sun position calculation is slow, get it done now.
+        # The instrument is not known yet, any location will do
+        getSunAlt(EarthLocation(lat=0*u.deg, lon=0*u.deg, height=0*u.m))
+        # pre-forked by the process handler, wait here until it hands
+        # us a guiding job. EOF means the handler has gone away
+        command = sys.stdin.readline().split()
+        if len(command) != 2 or command[0] != 'start' or command[1] not in INSTRUMENT_CONFIGS:
+            sys.exit(0)
+        args.instrument = command[1]
+
+    # several nights are replayed in parallel, one child process each
+    if args.replay and len(args.replay) > 1:
+        failed = replayNights(args.instrument, args.replay, args.replay_out,
+                              jobs=args.replay_jobs)
+        sys.exit(1 if failed else 0)
+
+    # equivalent to 'from <instrument config> import *'
+    globals().update(get_config_values(args.instrument))
+
+    # live config updates and profile requests from the
+    # process handler arrive on stdin
+    worker_commands = CommandReader(sys.stdin)
+    frame_profiler = FrameProfiler()
+
+    # watch the guide loop stages for stalls, the deadlines
+    # and aborting stalled frames can be set in the config
+    watchdog = Watchdog(globals().get('STAGE_DEADLINES', DEFAULT_DEADLINES),
+                        on_stall=logStallToDb,
+                        abort=globals().get('ABORT_STALLED_FRAMES', False))
+    frame_timer = StageTimer(watchdog)
+
+    # the real telescope and camera, or the simulator
+    if args.backend == 'sim':
+        BASE_DIR = args.sim_dir
+        AUTOGUIDER_REF_DIR = os.path.join(args.sim_dir, 'autoguider_ref')
+        # the simulated night never ends
+        SUNALT_LIMIT = 90
+        hardware = getBackend('sim', get_config_values(args.instrument),
+                              speedup=args.sim_speedup,
+                              shape=tuple(args.sim_shape) if args.sim_shape else None,
+                              event_log=args.sim_events)
+        night_dir, _ = getNightDir(DATA_SUBDIR)
+        for folder in (night_dir, AUTOGUIDER_REF_DIR):
+            os.makedirs(folder, exist_ok=True)
+        if args.sim_frames > 0:
+            hardware.observe(night_dir, args.sim_field, args.sim_filter,
+                             args.sim_exptime, args.sim_frames)
+    elif args.replay:
+        # everything the replay writes goes to --replay_out/<night>,
+        # the archived night is only read
+        args.replay_out = os.path.join(args.replay_out, nightName(args.replay[0]))
+        AUTOGUIDER_REF_DIR = os.path.join(args.replay_out, 'autoguider_ref')
+        LOGFILE = os.path.join(args.replay_out, LOGFILE)
+        os.makedirs(AUTOGUIDER_REF_DIR, exist_ok=True)
+        if not args.sim_db:
+            args.sim_db = os.path.join(args.replay_out, REPLAY_DB_FILE)
+        hardware = getBackend('replay', get_config_values(args.instrument),
+                              night_dir=args.replay[0], out_dir=args.replay_out)
+        atexit.register(hardware.close)
     else:
-        sys.exit(1)
+        hardware = getBackend('com')
+    if args.sim_db:
+        createSchema(args.sim_db)
 
     # set up observatory location from coords in telescope file
     observatory = EarthLocation(lat=OLAT*u.deg, lon=OLON*u.deg, height=ELEV*u.m)
@@ -741,13 +1101,21 @@ if __name__ == "__main__":
     # dictionaries to hold reference images for different fields/filters
     ref_track = defaultdict(dict)
 
+    # load all valid reference images for this telescope up front
+    ref_registry = ReferenceRegistry(args.instrument, AUTOGUIDER_REF_DIR,
+                                     lambda: openDb(DB_HOST, DB_USER, DB_DATABASE, DB_PASS))
+    n_refs = ref_registry.load()
+    logMessageToDb(args.instrument,
+                   "Loaded {} valid reference images".format(n_refs))
+
+    # only try to resume from a snapshot when first starting up,
+    # a replay always starts from the beginning of the night
+    resume = not args.replay
+
     # outer loop to loop over field and night changes etc
     while 1:
         # initialise the PID controllers for X and Y
-        PIDx = PID(PID_COEFFS['x']['p'], PID_COEFFS['x']['i'], PID_COEFFS['x']['d'])
-        PIDy = PID(PID_COEFFS['y']['p'], PID_COEFFS['y']['i'], PID_COEFFS['y']['d'])
-        PIDx.setPoint(PID_COEFFS['set_x'])
-        PIDy.setPoint(PID_COEFFS['set_y'])
+        pid_bank = PIDBank(*pidCoeffs())
 
         # ag correction buffers - used for outlier rejection
         BUFF_X, BUFF_Y = [], []
@@ -762,6 +1130,9 @@ if __name__ == "__main__":
                 logMessageToDb(args.instrument,
                                "Found data directory: {}".format(data_loc))
                 os.chdir(data_loc)
+                # where the night's own files go, kept out of the archive when replaying
+                out_loc = args.replay_out if args.replay else data_loc
+                watchdog.dump_path = os.path.join(out_loc, WATCHDOG_DUMP_FILE)
                 break
             if not data_loc:
                 logMessageToDb(args.instrument,
@@ -771,7 +1142,7 @@ if __name__ == "__main__":
 
         # connect to ACP only after the data directory is found
         logMessageToDb(args.instrument, "Checking for the telescope...")
-        myScope = win32com.client.Dispatch("ACP.Telescope")
+        myScope = hardware.telescope()
         connected = myScope.Connected
         if not connected:
             logMessageToDb(args.instrument,
@@ -781,9 +1152,16 @@ if __name__ == "__main__":
         # if we get to here we assume we have found the data directory
         # and that the scope is connected
         # get a list of the images in the directory
-        templist = g.glob('*{}'.format(IMAGE_EXTENSION))
+        if args.replay:
+            # carry on from the frame the replay last handed over
+            templist = [hardware.current] if hardware.current else []
+        else:
+            templist = g.glob('*{}'.format(IMAGE_EXTENSION))
         # add the logfile header row
         logShiftsToFile(LOGFILE, [], header=True)
+        # the binary log sits alongside the text log
+        flushGuideLog()
+        guide_log = BinaryGuideLog(getBinaryLogPath(LOGFILE))
         # check for any data in there
         n_images = len(templist)
         # if no images appear before the end of the night
@@ -810,7 +1188,7 @@ if __name__ == "__main__":
                 # set the previous reference image
                 if not ref_file:
                     setReferenceImage(current_field, current_filter, last_file, args.instrument)
-                    ref_file = "{}\\{}".format(AUTOGUIDER_REF_DIR, last_file)
+                    ref_file = os.path.join(AUTOGUIDER_REF_DIR, last_file)
         except IOError:
             logMessageToDb(args.instrument, "Problem opening {}...".format(last_file))
             logMessageToDb(args.instrument, "Breaking back to check for new day...")
@@ -826,14 +1204,44 @@ if __name__ == "__main__":
         images_to_stabilise = IMAGES_TO_STABILISE
         stabilised = 'n'
 
+        # if this worker replaced one that died or was restarted on the
+        # same field, carry on from its snapshot rather than pulling in again
+        state_path = getStatePath(out_loc)
+        if resume:
+            resume = False
+            state = loadState(state_path, night, current_field, current_filter)
+            if state and state['ref_file'] == ref_file:
+                pid_bank.restore(state['pid'])
+                BUFF_X, BUFF_Y = state['buff_x'], state['buff_y']
+                images_to_stabilise = state['images_to_stabilise']
+                stabilised = state['stabilised']
+                for field, filters in state['ref_track'].items():
+                    ref_track[field].update(filters)
+                logMessageToDb(args.instrument,
+                               "Resumed from state saved {:.0f}s ago".format(time.time() - state['saved']))
+
         # Now wait on new images
         while 1:
+            # per stage timings for this frame, in seconds, started
+            # before waiting so the header read is timed and watched
+            frame_timer = StageTimer(watchdog)
+            timings = frame_timer.durations
             ag_status, check_file, current_field, current_filter = waitForImage(DATA_SUBDIR,
                                                                                 current_field,
                                                                                 n_images,
                                                                                 current_filter,
                                                                                 data_loc,
                                                                                 observatory)
+            frame_time = time.time()
+            if check_file and not args.replay:
+                frame_timer.add('detect', max(frame_time - os.path.getmtime(check_file), 0.0))
+            # between frames, safe to change the guiding parameters
+            applyConfigUpdates()
+            profile_request = worker_commands.pendingProfile()
+            if profile_request and frame_profiler.start(profile_request['frames'],
+                                                        profile_request['mode']):
+                logMessageToDb(args.instrument,
+                               'Profiling the next {frames} frames ({mode})'.format(**profile_request))
             if ag_status == ag_new_day:
                 logMessageToDb(args.instrument,
                                "New day detected, ending process...")
@@ -843,18 +1251,17 @@ if __name__ == "__main__":
                                "New field/filter detected, looking for previous reference image...")
                 # reset the PID coeffs to not carry performance across objects
                 logMessageToDb(args.instrument, 'Resetting PID loop for new field...')
-                PIDx = PID(PID_COEFFS['x']['p'], PID_COEFFS['x']['i'], PID_COEFFS['x']['d'])
-                PIDy = PID(PID_COEFFS['y']['p'], PID_COEFFS['y']['i'], PID_COEFFS['y']['d'])
-                PIDx.setPoint(PID_COEFFS['set_x'])
-                PIDy.setPoint(PID_COEFFS['set_y'])
-                try:
-                    ref_file = ref_track[current_field][current_filter]
-                    donuts_ref = Donuts(ref_file)
-                    images_to_stabilise = IMAGES_TO_STABILISE
-                except KeyError:
-                    logMessageToDb(args.instrument, 'No reference in ref_track for this field/filter')
+                pid_bank.reset(*pidCoeffs())
+                # the registry is checked rather than ref_track so that
+                # references changed by the admin scripts are picked up
+                ref_file = getReferenceImage(current_field, current_filter)
+                if not ref_file:
+                    logMessageToDb(args.instrument, 'No reference in registry for this field/filter')
                     logMessageToDb(args.instrument, 'Skipping back to reference image checks...')
                     break
+                ref_track[current_field][current_filter] = ref_file
+                donuts_ref = Donuts(ref_file)
+                images_to_stabilise = IMAGES_TO_STABILISE
             else:
                 logMessageToDb(args.instrument, "Same field and same filter, continuing...")
                 logMessageToDb(args.instrument,
@@ -864,31 +1271,37 @@ if __name__ == "__main__":
                 # if we are done stabilising, reset the PID loop
                 if images_to_stabilise == 0:
                     logMessageToDb(args.instrument, 'Stabilisation complete, reseting PID loop...')
-                    PIDx = PID(PID_COEFFS['x']['p'], PID_COEFFS['x']['i'], PID_COEFFS['x']['d'])
-                    PIDy = PID(PID_COEFFS['y']['p'], PID_COEFFS['y']['i'], PID_COEFFS['y']['d'])
-                    PIDx.setPoint(PID_COEFFS['set_x'])
-                    PIDy.setPoint(PID_COEFFS['set_y'])
+                    pid_bank.reset(*pidCoeffs())
                 elif images_to_stabilise > 0:
                     logMessageToDb(args.instrument, 'Stabilising using P=1.0, I=0.0, D=0.0')
-                    PIDx = PID(1.0, 0.0, 0.0)
-                    PIDy = PID(1.0, 0.0, 0.0)
-                    PIDx.setPoint(PID_COEFFS['set_x'])
-                    PIDy.setPoint(PID_COEFFS['set_y'])
+                    pid_bank.reset(*pidCoeffs(stabilising=True))
 
             # test load the comparison image to get the shift
             try:
-                h2 = fits.open(check_file)
-                del h2
+                with frame_timer.span('load'):
+                    h2 = fits.open(check_file)
+                    del h2
             except IOError:
                 logMessageToDb(args.instrument, "Problem opening CHECK: {}...".format(check_file))
                 logMessageToDb(args.instrument, "Breaking back to look for new file...")
+                emitStatus('dropped', reason='unreadable')
+                continue
+            except FrameStalled:
+                logMessageToDb(args.instrument, "Stalled opening CHECK: {}, skipping...".format(check_file))
+                emitStatus('dropped', reason='stalled')
                 continue
 
             # reset culled tags
             culled_max_shift_x = 'n'
             culled_max_shift_y = 'n'
             # work out shift here
-            shift = donuts_ref.measure_shift(check_file)
+            try:
+                with frame_timer.span('measure'):
+                    shift = donuts_ref.measure_shift(check_file)
+            except FrameStalled:
+                logMessageToDb(args.instrument, "Stalled measuring CHECK: {}, skipping...".format(check_file))
+                emitStatus('dropped', reason='stalled')
+                continue
             shift_x = shift.x.value
             shift_y = shift.y.value
             logMessageToDb(args.instrument, "x shift: {:.2f}".format(float(shift_x)))
@@ -934,10 +1347,18 @@ if __name__ == "__main__":
             if culled_max_shift_x == 'y' or culled_max_shift_y == 'y':
                 pre_pid_x, pre_pid_y, post_pid_x, post_pid_y, \
                     std_buff_x, std_buff_y = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
+                pulses = {}
             else:
-                applied, post_pid_x, post_pid_y, \
-                    std_buff_x, std_buff_y = guide(pre_pid_x, pre_pid_y,
-                                                   images_to_stabilise)
+                # an aborted correction may have been partly applied,
+                # the next frame measures and corrects what is left
+                try:
+                    applied, post_pid_x, post_pid_y, \
+                        std_buff_x, std_buff_y, pulses = guide(pre_pid_x, pre_pid_y,
+                                                               images_to_stabilise)
+                except FrameStalled:
+                    logMessageToDb(args.instrument, "Stalled applying the correction, skipping...")
+                    emitStatus('dropped', reason='stalled')
+                    continue
                 # !applied means no telescope, break to tomorrow
                 if not applied:
                     logMessageToDb(args.instrument,
@@ -958,11 +1379,57 @@ if __name__ == "__main__":
                         culled_max_shift_x,
                         culled_max_shift_y]
 
-            # log info to file
-            logShiftsToFile(LOGFILE, log_list)
             # log info to database - enable when DB is running
-            logShiftsToDb(tuple(log_list))
+            db_timings = frame_timer.getColumns()
+            # the frame insert on its own, the db stage also
+            # includes any info messages logged during the frame
+            db_frame = None
+            try:
+                with frame_timer.span('db'):
+                    t0 = time.perf_counter()
+                    logShiftsToDb(tuple(log_list + db_timings))
+                    db_frame = time.perf_counter() - t0
+            except (pymysql.MySQLError, FrameStalled) as err:
+                logMessageToDb(args.instrument, "Frame not logged to database: {}".format(err))
+            # log info to file, including the database insert time
+            logShiftsToFile(LOGFILE, log_list + ['nan' if t is None else '{:.4f}'.format(t)
+                                                 for t in frame_timer.getColumns()])
+            # log the full precision values to the binary log
+            guide_log.append(frame_time,
+                             log_list[:4] + [shift_x, shift_y, pre_pid_x, pre_pid_y,
+                                             post_pid_x, post_pid_y, std_buff_x, std_buff_y] + log_list[12:],
+                             timings)
+            # tell the process handler how this frame went
+            emitStatus('frame', night=night, reference=log_list[1],
+                       comparison=check_file, stabilised=stabilised,
+                       shift_x=shift_x, shift_y=shift_y,
+                       pre_pid_x=pre_pid_x, pre_pid_y=pre_pid_y,
+                       post_pid_x=post_pid_x, post_pid_y=post_pid_y,
+                       std_buff_x=std_buff_x, std_buff_y=std_buff_y,
+                       culled_max_shift_x=culled_max_shift_x,
+                       culled_max_shift_y=culled_max_shift_y,
+                       rejected=pulses is None, pulses=pulses or {},
+                       timings=timings, db_frame=db_frame)
+            # snapshot the loop state in case this process dies
+            saveState(state_path, {'night': night,
+                                   'field': current_field,
+                                   'filter': current_filter,
+                                   'ref_file': ref_file,
+                                   'ref_track': ref_track,
+                                   'images_to_stabilise': images_to_stabilise,
+                                   'stabilised': stabilised,
+                                   'pid': pid_bank.snapshot(),
+                                   'buff_x': BUFF_X,
+                                   'buff_y': BUFF_Y})
+            # finish any requested profile and switch it off
+            profile_summary, profile_error = frame_profiler.frameDone(out_loc)
+            if profile_summary:
+                logMessageToDb(args.instrument, 'Profile written to {}'.format(profile_summary))
+                emitStatus('profile', path=profile_summary)
+            if profile_error:
+                logMessageToDb(args.instrument, 'Profile not written: {}'.format(profile_error))
             # reset the comparison templist so the nested while(1) loop
-            # can find new images
-            templist = g.glob("*{}".format(IMAGE_EXTENSION))
-            n_images = len(templist)
+            # can find new images, the replay hands them over itself
+            if not args.replay:
+                templist = g.glob("*{}".format(IMAGE_EXTENSION))
+                n_images = len(templist)
@@ -0,0 +1,145 @@
+"""
+Line based message channel between the guide worker and the process handler
+
+The guide worker (acp_ag.py) writes status messages to its stdout as
+single lines of JSON prefixed with STATUS_PREFIX. The process handler
+drains the pipe continuously in a StatusReader thread, so the worker
+can never block on a full pipe buffer, and keeps the latest state in
+memory instead of polling the database.
+
+Status kinds:
+    message : an info message, as also sent to autoguider_info_log
+    frame : the outcome of one guide frame (shifts, PID output,
+            buffer sigma, guide pulses, per-stage timings and the
+            time taken by the frame's database insert)
+    config : a live config update has been applied
+    dropped : a new image was skipped before its shift was measured
+    profile : a requested profile has been written
+    stall : a guide loop stage overran its deadline, see ag_watchdog.py
+"""
+import sys
+import json
+import time
+import threading
+
+# pylint: disable=invalid-name
+
+STATUS_PREFIX = "@AG "
+
+def emitStatus(kind, **payload):
+    """
+    Write a status message to stdout for the process handler
+
+    Parameters
+    ----------
+    kind : string
+        Type of status message, e.g. message or frame
+    **payload
+        JSON serialisable values to include
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    payload['kind'] = kind
+    payload['time'] = time.time()
+    line = "{}{}\n".format(STATUS_PREFIX, json.dumps(payload, default=float))
+    try:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+    except (OSError, ValueError):
+        # no handler listening, status is best effort only
+        pass
+
+def parseStatusLine(line):
+    """
+    Decode one line from a worker's stdout
+
+    Parameters
+    ----------
+    line : string
+        Line read from the worker
+
+    Returns
+    -------
+    status : dict | None
+        The decoded status message, None if the line
+        is not a status message
+
+    Raises
+    ------
+    None
+    """
+    if not line.startswith(STATUS_PREFIX):
+        return None
+    try:
+        return json.loads(line[len(STATUS_PREFIX):])
+    except ValueError:
+        return None
+
+class StatusReader(object):
+    """
+    Continuously drain a worker's stdout in a background thread
+
+    Parameters
+    ----------
+    pid : int
+        Process ID of the worker, passed back to the callback
+    pipe : file like
+        The worker's stdout, opened in binary mode
+    callback : callable
+        Called as callback(pid, status) for every status message
+    echo : boolean
+        Print any non status lines (e.g. tracebacks)?
+        Default = True
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, pid, pipe, callback, echo=True):
+        """
+        Initialise the class and start reading
+
+        See class docstring above
+        """
+        self.pid = pid
+        self.pipe = pipe
+        self.callback = callback
+        self.echo = echo
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        """
+        Read lines until the worker closes its stdout
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        for raw in iter(self.pipe.readline, b''):
+            line = raw.decode('utf-8', errors='replace').rstrip('\r\n')
+            status = parseStatusLine(line)
+            if status is not None:
+                self.callback(self.pid, status)
+            elif self.echo and line:
+                print('[{}] {}'.format(self.pid, line))
+        self.pipe.close()
@@ -0,0 +1,89 @@
+"""
+Minimal command channel between ACP and the process handler
+
+ACP launches a new python process for every start/stop request and
+waits for it to finish. Importing Pyro4 dominates the run time of such
+a short lived client, so the process handler also listens on a plain
+local TCP socket for one line commands:
+
+    start [INSTRUMENT]\\n  ->  STATUS\\n
+    stop [INSTRUMENT]\\n   ->  STATUS\\n
+    ping\\n                ->  STATUS\\n
+
+where STATUS is one of the integer utils.ag_status values. This module
+only imports socket so clients can use it without paying for Pyro4.
+"""
+import socket
+
+# pylint: disable=invalid-name
+
+COMMAND_HOST = 'localhost'
+COMMAND_PORT = 9235
+COMMANDS = ('start', 'stop', 'ping')
+# stop_ag can escalate through 3 waits in the handler
+COMMAND_TIMEOUT = 60
+# utils.ag_status.pyro_connection_error, repeated to avoid the import
+CONNECTION_ERROR = 3
+
+def sendCommand(action, instrument=None, host=COMMAND_HOST,
+                port=COMMAND_PORT, timeout=COMMAND_TIMEOUT):
+    """
+    Send one command to the process handler and wait for the reply
+
+    Parameters
+    ----------
+    action : string
+        One of COMMANDS
+    instrument : string, optional
+        Instrument to act on, needed if the handler
+        supervises more than one
+    host : string, optional
+        Address of the process handler
+    port : int, optional
+        Port of the process handler command server
+    timeout : float, optional
+        Seconds to wait for the reply
+
+    Returns
+    -------
+    status : int
+        The ag_status returned by the handler, or CONNECTION_ERROR
+        if the handler could not be reached
+
+    Raises
+    ------
+    None
+    """
+    line = action if instrument is None else "{} {}".format(action, instrument)
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall("{}\n".format(line).encode())
+            reply = sock.makefile('rb').readline()
+        return int(reply)
+    except (OSError, ValueError):
+        return CONNECTION_ERROR
+
+def parseCommand(line):
+    """
+    Decode a command line received by the process handler
+
+    Parameters
+    ----------
+    line : string
+        The received line
+
+    Returns
+    -------
+    action : string | None
+        The requested action, None if the line is invalid
+    instrument : string | None
+        The requested instrument, if given
+
+    Raises
+    ------
+    None
+    """
+    parts = line.split()
+    if not parts or parts[0] not in COMMANDS or len(parts) > 2:
+        return None, None
+    return parts[0], parts[1] if len(parts) == 2 else None
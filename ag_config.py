@@ -0,0 +1,243 @@
+"""
+Live configuration updates for a running guide worker
+
+Only the tuning parameters below can be changed while guiding. The
+process handler validates an update and writes it to the worker's stdin
+as a single line:
+
+    config {"SIGMA_BUFFER": 8, ...}
+
+The worker reads its stdin in a background thread (CommandReader) and
+applies all queued updates between frames, so a frame is always guided
+with one consistent set of parameters. CommandReader also queues
+profile requests, see ag_profiler.py.
+"""
+import json
+import queue
+import importlib
+import threading
+from numbers import Real
+from utils import load_config
+from ag_profiler import (
+    PROFILE_COMMAND,
+    validateProfileRequest
+    )
+
+# pylint: disable=invalid-name
+
+CONFIG_COMMAND = 'config'
+PID_AXES = ('x', 'y')
+PID_TERMS = ('p', 'i', 'd')
+PIX2TIME_KEYS = ('+x', '-x', '+y', '-y')
+
+def _isNumber(value):
+    """
+    True for real numbers, excluding booleans
+    """
+    return isinstance(value, Real) and not isinstance(value, bool)
+
+def _checkPositive(key, value):
+    """
+    Raise ValueError unless value is a positive number
+    """
+    if not _isNumber(value) or value <= 0:
+        raise ValueError('{} must be a positive number, got {!r}'.format(key, value))
+
+def _checkPositiveInt(key, value):
+    """
+    Raise ValueError unless value is a positive integer
+    """
+    if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+        raise ValueError('{} must be a positive integer, got {!r}'.format(key, value))
+
+def _checkPidCoeffs(key, value):
+    """
+    Raise ValueError unless value is a complete PID_COEFFS dict
+    """
+    try:
+        for axis in PID_AXES:
+            for term in PID_TERMS:
+                if not _isNumber(value[axis][term]) or value[axis][term] < 0:
+                    raise ValueError('{}[{}][{}] must be >= 0'.format(key, axis, term))
+            if not _isNumber(value['set_{}'.format(axis)]):
+                raise ValueError('{}[set_{}] must be a number'.format(key, axis))
+    except (KeyError, TypeError):
+        raise ValueError('{} is missing PID terms, got {!r}'.format(key, value))
+
+def _checkPix2Time(key, value):
+    """
+    Raise ValueError unless value has a positive rate per direction
+    """
+    try:
+        for direction in PIX2TIME_KEYS:
+            _checkPositive('{}[{}]'.format(key, direction), value[direction])
+    except (KeyError, TypeError):
+        raise ValueError('{} is missing directions, got {!r}'.format(key, value))
+
+# parameters that may be changed while guiding and their checks
+RELOADABLE = {'PID_COEFFS': _checkPidCoeffs,
+              'SIGMA_BUFFER': _checkPositive,
+              'MAX_ERROR_PIXELS': _checkPositive,
+              'MAX_ERROR_STABIL_PIXELS': _checkPositive,
+              'GUIDE_BUFFER_LENGTH': _checkPositiveInt,
+              'IMAGES_TO_STABILISE': _checkPositiveInt,
+              'PIX2TIME': _checkPix2Time}
+
+def validateConfig(update):
+    """
+    Check a configuration update
+
+    Parameters
+    ----------
+    update : dict
+        Parameter name -> new value
+
+    Returns
+    -------
+    update : dict
+        The checked update
+
+    Raises
+    ------
+    ValueError
+        If a parameter cannot be reloaded or has an invalid value
+    """
+    if not isinstance(update, dict) or not update:
+        raise ValueError('Config update must be a non-empty dict')
+    for key, value in update.items():
+        if key not in RELOADABLE:
+            raise ValueError('{} cannot be changed while guiding, choose from {}'.format(key,
+                                                                                        sorted(RELOADABLE)))
+        RELOADABLE[key](key, value)
+    return update
+
+def getReloadableConfig(instrument):
+    """
+    Re-read an instrument's configuration module from disc and
+    return the parameters that can be changed while guiding
+
+    Parameters
+    ----------
+    instrument : string
+        Name of the instrument
+
+    Returns
+    -------
+    config : dict
+        Parameter name -> value from the configuration file
+
+    Raises
+    ------
+    None
+    """
+    config = importlib.reload(load_config(instrument))
+    return {key: getattr(config, key) for key in RELOADABLE if hasattr(config, key)}
+
+def formatConfigCommand(update):
+    """
+    Encode a config update as a line for the worker's stdin
+    """
+    return '{} {}\n'.format(CONFIG_COMMAND, json.dumps(update))
+
+class CommandReader(object):
+    """
+    Read config and profile commands from the process handler on
+    stdin in a background thread and queue them for the guide loop
+
+    Parameters
+    ----------
+    pipe : file like
+        The worker's stdin
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, pipe):
+        """
+        Initialise the class and start reading
+
+        See class docstring above
+        """
+        self.pipe = pipe
+        self.updates = queue.Queue()
+        self.profile_requests = queue.Queue()
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        """
+        Queue each valid command line until stdin is closed
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        for line in iter(self.pipe.readline, ''):
+            command, _, payload = line.strip().partition(' ')
+            try:
+                if command == CONFIG_COMMAND:
+                    self.updates.put(validateConfig(json.loads(payload)))
+                elif command == PROFILE_COMMAND:
+                    self.profile_requests.put(validateProfileRequest(json.loads(payload)))
+            except ValueError as err:
+                print('Rejected {} command: {}'.format(command, err))
+
+    def pending(self):
+        """
+        Return all queued updates merged into one, oldest first
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        update : dict
+            Merged update, empty if nothing is queued
+
+        Raises
+        ------
+        None
+        """
+        update = {}
+        while True:
+            try:
+                update.update(self.updates.get_nowait())
+            except queue.Empty:
+                return update
+
+    def pendingProfile(self):
+        """
+        Return the oldest queued profile request
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        request : dict | None
+            The request, None if nothing is queued
+
+        Raises
+        ------
+        None
+        """
+        try:
+            return self.profile_requests.get_nowait()
+        except queue.Empty:
+            return None
@@ -0,0 +1,93 @@
+"""
+Hardware access for the guider and calibration scripts
+
+DONUTS drives the mount through the ACP telescope hub and the camera
+through MaxIm DL, both over COM. The rest of the code only uses the
+objects returned here, so the COM backend can be swapped for the
+simulator (ag_simulator.py) to run the guide loop on any machine.
+
+Backends:
+    com : ACP.Telescope and MaxIm.CCDCamera via win32com (Windows only)
+    sim : SimTelescope and SimCamera on a shared SimClock
+
+acp_ag.py --replay uses a third, ag_replay.ReplayNight, which records
+the guide pulses and has no camera.
+"""
+
+# pylint: disable=invalid-name
+# pylint: disable=import-outside-toplevel
+
+BACKENDS = ('com', 'sim')
+
+class ComBackend(object):
+    """
+    The real hardware, through COM
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        # only importable on the Windows control PCs
+        import win32com.client
+        self.dispatch = win32com.client.Dispatch
+
+    def telescope(self):
+        """
+        The ACP telescope hub
+        """
+        return self.dispatch("ACP.Telescope")
+
+    def camera(self):
+        """
+        The MaxIm DL camera
+        """
+        return self.dispatch("MaxIm.CCDCamera")
+
+def getBackend(backend, config=None, **options):
+    """
+    Get the hardware backend
+
+    Parameters
+    ----------
+    backend : string
+        One of BACKENDS, or 'replay'
+    config : dict, optional
+        Instrument configuration values, needed by the simulator
+        and the replay
+    **options
+        Passed on to ag_simulator.SimObservatory, e.g. speedup,
+        or ag_replay.ReplayNight, i.e. night_dir and out_dir
+
+    Returns
+    -------
+    hardware : ComBackend | SimObservatory | ReplayNight
+        Object with telescope() and camera() methods
+
+    Raises
+    ------
+    ValueError
+        If the backend is unknown
+    """
+    if backend == 'com':
+        return ComBackend()
+    if backend == 'sim':
+        from ag_simulator import SimObservatory
+        return SimObservatory(config, **options)
+    if backend == 'replay':
+        from ag_replay import ReplayNight
+        return ReplayNight(config, **options)
+    raise ValueError('Unknown hardware backend {}, choose from {}'.format(backend, BACKENDS))
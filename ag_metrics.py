@@ -0,0 +1,323 @@
+"""
+Prometheus style metrics for the process handler
+
+The handler feeds every status message streamed from the guide workers
+(see ag_channel.py) into GuideMetrics, which keeps counters and
+histograms per instrument in memory. MetricsServer serves them as a
+plain text page in the Prometheus exposition format, e.g.
+
+    $> curl http://localhost:9236/metrics
+
+so guide latency and throughput can be trended by a local scraper
+without querying MySQL.
+"""
+import threading
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer
+    )
+
+# pylint: disable=invalid-name
+
+METRICS_HOST = 'localhost'
+METRICS_PORT = 9236
+METRICS_PREFIX = 'donuts_'
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PULSE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIGMA_BUCKETS = (0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+def _formatLabels(names, values):
+    """
+    Format a label set, e.g. {instrument="io",stage="load"}
+    """
+    if not names:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, value)
+                                    for name, value in zip(names, values)))
+
+class Counter(object):
+    """
+    Monotonic counter with labels
+
+    Parameters
+    ----------
+    name : string
+        Metric name, without METRICS_PREFIX
+    description : string
+        Help text
+    labels : tuple
+        Label names
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, name, description, labels):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.name = METRICS_PREFIX + name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, label_values, amount=1):
+        """
+        Add to the counter for a label set
+        """
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        """
+        Render the counter in the exposition format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} counter'.format(self.name)]
+        for label_values, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, _formatLabels(self.labels, label_values), value))
+        return lines
+
+class Histogram(object):
+    """
+    Cumulative histogram with labels
+
+    Parameters
+    ----------
+    name : string
+        Metric name, without METRICS_PREFIX
+    description : string
+        Help text
+    labels : tuple
+        Label names
+    buckets : tuple
+        Upper bounds of the buckets, +Inf is added
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, name, description, labels, buckets):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.name = METRICS_PREFIX + name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, label_values, value):
+        """
+        Add one observation for a label set
+        """
+        counts, total, n = self.values.get(label_values, ([0]*len(self.buckets), 0.0, 0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[label_values] = (counts, total + value, n + 1)
+
+    def render(self):
+        """
+        Render the histogram in the exposition format
+        """
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} histogram'.format(self.name)]
+        for label_values, (counts, total, n) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                labels = _formatLabels(self.labels + ('le', ), label_values + (bound, ))
+                lines.append('{}_bucket{} {}'.format(self.name, labels, count))
+            labels = _formatLabels(self.labels + ('le', ), label_values + ('+Inf', ))
+            lines.append('{}_bucket{} {}'.format(self.name, labels, n))
+            labels = _formatLabels(self.labels, label_values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, total))
+            lines.append('{}_count{} {}'.format(self.name, labels, n))
+        return lines
+
+class GuideMetrics(object):
+    """
+    Guide loop metrics for all instruments, fed from worker status messages
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.lock = threading.Lock()
+        self.frames_seen = Counter('frames_seen_total',
+                                   'New images detected by the guider',
+                                   ('instrument', ))
+        self.frames_measured = Counter('frames_measured_total',
+                                       'Images with a measured shift',
+                                       ('instrument', ))
+        self.frames_dropped = Counter('frames_dropped_total',
+                                      'Images not used for a correction',
+                                      ('instrument', 'reason'))
+        self.stage_latency = Histogram('stage_latency_seconds',
+                                       'Time spent in each stage of the guide loop',
+                                       ('instrument', 'stage'), LATENCY_BUCKETS)
+        self.db_latency = Histogram('db_write_latency_seconds',
+                                    'Time to insert one frame into autoguider_log_new',
+                                    ('instrument', ), LATENCY_BUCKETS)
+        self.pulse_duration = Histogram('pulse_duration_seconds',
+                                        'Duration of guide pulses sent to the mount',
+                                        ('instrument', 'direction'), PULSE_BUCKETS)
+        self.buffer_sigma = Histogram('buffer_sigma_pixels',
+                                      'Standard deviation of the outlier rejection buffer',
+                                      ('instrument', 'axis'), SIGMA_BUCKETS)
+        self.stalls = Counter('stalls_total',
+                              'Guide loop stages that overran their watchdog deadline',
+                              ('instrument', 'stage'))
+        self.metrics = (self.frames_seen, self.frames_measured, self.frames_dropped,
+                        self.stalls, self.stage_latency, self.db_latency, self.pulse_duration,
+                        self.buffer_sigma)
+
+    def observe(self, instrument, status):
+        """
+        Update the metrics from one worker status message
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string
+            Instrument the worker is guiding
+        status : dict
+            Decoded status message, see ag_channel.py
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        key = (instrument, )
+        with self.lock:
+            if status['kind'] == 'dropped':
+                self.frames_seen.inc(key)
+                self.frames_dropped.inc(key + (status['reason'], ))
+            elif status['kind'] == 'stall':
+                self.stalls.inc(key + (status['stage'], ))
+            elif status['kind'] == 'frame':
+                self.frames_seen.inc(key)
+                self.frames_measured.inc(key)
+                if status['culled_max_shift_x'] == 'y' or status['culled_max_shift_y'] == 'y':
+                    self.frames_dropped.inc(key + ('max_shift', ))
+                if status.get('rejected'):
+                    self.frames_dropped.inc(key + ('sigma_clip', ))
+                for stage, duration in status['timings'].items():
+                    self.stage_latency.observe(key + (stage, ), duration)
+                if status.get('db_frame') is not None:
+                    self.db_latency.observe(key, status['db_frame'])
+                for direction, duration in status.get('pulses', {}).items():
+                    # PulseGuide durations are in ms
+                    self.pulse_duration.observe(key + (direction, ), duration/1000.)
+                if status['stabilised'] == 'y':
+                    self.buffer_sigma.observe(key + ('x', ), status['std_buff_x'])
+                    self.buffer_sigma.observe(key + ('y', ), status['std_buff_y'])
+
+    def render(self):
+        """
+        Render all metrics as a Prometheus text page
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        page : string
+            The metrics page
+
+        Raises
+        ------
+        None
+        """
+        with self.lock:
+            lines = [line for metric in self.metrics for line in metric.render()]
+        return '\n'.join(lines) + '\n'
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the metrics page on GET /metrics
+    """
+    def do_GET(self):
+        """
+        Reply with the current metrics page
+        """
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Keep scrapes out of the handler's console
+        """
+        # pylint: disable=redefined-builtin
+        return
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    Local HTTP server for the metrics page
+
+    Parameters
+    ----------
+    metrics : GuideMetrics
+        The metrics to serve
+    host : string, optional
+        Address to listen on
+    port : int, optional
+        Port to listen on
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    daemon_threads = True
+
+    def __init__(self, metrics, host=METRICS_HOST, port=METRICS_PORT):
+        """
+        Initialise the class and start serving in a background thread
+
+        See class docstring above
+        """
+        ThreadingHTTPServer.__init__(self, (host, port), MetricsRequestHandler)
+        self.metrics = metrics
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
@@ -0,0 +1,330 @@
+"""
+On-demand profiling of a running guide worker
+
+The process handler can ask a live worker to profile its next N frames
+without a restart. The request arrives on the worker's stdin as:
+
+    profile {"frames": 20, "mode": "cprofile"}
+
+Modes:
+    cprofile : deterministic profile of the guide loop thread
+    sample   : low overhead sampling of the guide loop thread's stack
+
+When the frames are done the profiler switches itself off and writes
+to the night's data directory:
+    profile_YYYYmmddTHHMMSS.prof    pstats file (cprofile only)
+    profile_YYYYmmddTHHMMSS.txt     top functions by cumulative time
+"""
+import io
+import os
+import json
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter
+from datetime import datetime
+
+# pylint: disable=invalid-name
+
+PROFILE_COMMAND = 'profile'
+PROFILE_MODES = ('cprofile', 'sample')
+PROFILE_MAX_FRAMES = 500
+PROFILE_TOP_N = 30
+# seconds between stack samples in sample mode
+SAMPLE_INTERVAL = 0.005
+
+def validateProfileRequest(request):
+    """
+    Check a profile request
+
+    Parameters
+    ----------
+    request : dict
+        frames : int
+            Number of frames to profile
+        mode : string
+            One of PROFILE_MODES
+
+    Returns
+    -------
+    request : dict
+        The checked request
+
+    Raises
+    ------
+    ValueError
+        If the request is invalid
+    """
+    if not isinstance(request, dict):
+        raise ValueError('Profile request must be a dict')
+    frames, mode = request.get('frames'), request.get('mode', 'cprofile')
+    if not isinstance(frames, int) or isinstance(frames, bool) or \
+            not 0 < frames <= PROFILE_MAX_FRAMES:
+        raise ValueError('frames must be an integer 1-{}, got {!r}'.format(PROFILE_MAX_FRAMES,
+                                                                          frames))
+    if mode not in PROFILE_MODES:
+        raise ValueError('mode must be one of {}, got {!r}'.format(PROFILE_MODES, mode))
+    return {'frames': frames, 'mode': mode}
+
+def formatProfileCommand(frames, mode):
+    """
+    Encode a profile request as a line for the worker's stdin
+    """
+    return '{} {}\n'.format(PROFILE_COMMAND, json.dumps({'frames': frames, 'mode': mode}))
+
+class StackSampler(object):
+    """
+    Sample the stack of one thread at a fixed interval
+
+    Each sample adds one count to every function on the stack
+    (cumulative) and one to the innermost function (own time)
+
+    Parameters
+    ----------
+    thread_id : int
+        Identifier of the thread to sample
+    interval : float, optional
+        Seconds between samples
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        """
+        Initialise the class and start sampling
+
+        See class docstring above
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.cumulative = Counter()
+        self.own = Counter()
+        self.n_samples = 0
+        self.t_start = time.perf_counter()
+        self.elapsed = None
+        self.running = threading.Event()
+        self.running.set()
+        self.thread = threading.Thread(target=self.sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def sample(self):
+        """
+        Take samples until stopped
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            seen = set()
+            innermost = True
+            while frame is not None:
+                code = frame.f_code
+                key = '{}:{}({})'.format(code.co_filename, code.co_firstlineno, code.co_name)
+                if innermost:
+                    self.own[key] += 1
+                    innermost = False
+                # count recursive functions once per sample
+                if key not in seen:
+                    self.cumulative[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+            self.n_samples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        """
+        Stop sampling and wait for the sampler thread
+        """
+        self.running.clear()
+        self.thread.join()
+        self.elapsed = time.perf_counter() - self.t_start
+
+    def summary(self, top_n=PROFILE_TOP_N):
+        """
+        Top functions by cumulative samples
+
+        Parameters
+        ----------
+        self : the class self object
+        top_n : int, optional
+            Number of functions to list
+
+        Returns
+        -------
+        summary : string
+            Table of cumulative and own time per function
+
+        Raises
+        ------
+        None
+        """
+        elapsed = self.elapsed if self.elapsed is not None else time.perf_counter() - self.t_start
+        # real sample period, including the sampler's own overhead
+        period = elapsed / max(self.n_samples, 1)
+        lines = ['{} samples over {:.3f}s, approx. seconds shown'.format(self.n_samples, elapsed),
+                 '{:>10s} {:>10s}  function'.format('cumtime', 'owntime')]
+        for key, count in self.cumulative.most_common(top_n):
+            lines.append('{:>10.3f} {:>10.3f}  {}'.format(count*period, self.own[key]*period, key))
+        return '\n'.join(lines) + '\n'
+
+class FrameProfiler(object):
+    """
+    Profile the guide loop for a number of frames, then switch off
+
+    Must be started and advanced from the guide loop thread
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.mode = None
+        self.frames_left = 0
+        self.profiler = None
+        self.sampler = None
+        self.started = None
+
+    @property
+    def active(self):
+        """
+        Is a profile running?
+        """
+        return self.mode is not None
+
+    def start(self, frames, mode='cprofile'):
+        """
+        Start profiling the calling thread
+
+        Parameters
+        ----------
+        self : the class self object
+        frames : int
+            Number of frames to profile
+        mode : string, optional
+            One of PROFILE_MODES
+
+        Returns
+        -------
+        started : boolean
+            False if a profile is already running
+
+        Raises
+        ------
+        None
+        """
+        if self.active:
+            return False
+        self.mode, self.frames_left = mode, frames
+        self.started = datetime.utcnow()
+        if mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.sampler = StackSampler(threading.get_ident())
+        return True
+
+    def frameDone(self, out_dir):
+        """
+        Count a finished frame and write the results after the last one
+
+        Parameters
+        ----------
+        self : the class self object
+        out_dir : string
+            Folder to write the results to, e.g. the night directory
+
+        Returns
+        -------
+        summary_path : string | None
+            Path to the summary file if the profile has just finished
+        error : OSError | None
+            Why the results could not be written, if they could not
+
+        Raises
+        ------
+        None
+        """
+        if not self.active:
+            return None, None
+        self.frames_left -= 1
+        if self.frames_left > 0:
+            return None, None
+        return self.finish(out_dir)
+
+    def finish(self, out_dir):
+        """
+        Stop profiling and write the results
+
+        The profiler is always switched off, even if the results
+        cannot be written (e.g. a full disc), so a failed profile
+        never stops guiding or blocks the next request
+
+        Parameters
+        ----------
+        self : the class self object
+        out_dir : string
+            Folder to write the results to
+
+        Returns
+        -------
+        summary_path : string | None
+            Path to the summary file, None if it was not written
+        error : OSError | None
+            Why the results could not be written, if they could not
+
+        Raises
+        ------
+        None
+        """
+        stem = os.path.join(out_dir, 'profile_{}'.format(self.started.strftime('%Y%m%dT%H%M%S')))
+        summary_path = '{}.txt'.format(stem)
+        header = 'Guide loop profile ({}) started {} UTC\n\n'.format(self.mode, self.started)
+        try:
+            if self.mode == 'cprofile':
+                self.profiler.disable()
+                self.profiler.dump_stats('{}.prof'.format(stem))
+                stream = io.StringIO()
+                stats = pstats.Stats(self.profiler, stream=stream)
+                stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+                summary = stream.getvalue()
+            else:
+                self.sampler.stop()
+                summary = self.sampler.summary()
+            with open(summary_path, 'w') as sf:
+                sf.write(header + summary)
+        except OSError as err:
+            return None, err
+        finally:
+            self.mode, self.profiler, self.sampler = None, None, None
+        return summary_path, None
@@ -0,0 +1,316 @@
+"""
+Replay archived nights through the guide loop
+
+With --replay acp_ag.py reads an archived night instead of waiting on
+the camera. The frames are handed to the loop one at a time in the order
+they were taken, so the field/filter routing, shift measurement, PID
+loop and logging are the same code that runs on sky. Guide pulses go to
+a recorder rather than the mount and nothing waits on real time, so a
+night replays as fast as the frames can be measured.
+
+Several nights are replayed in parallel, each in its own acp_ag.py
+process with its own output folder, see replayNights.
+"""
+import os
+import re
+import sys
+import json
+import time
+import subprocess as sp
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from astropy.io import fits
+from astropy.coordinates import Angle
+import astropy.units as u
+
+# pylint: disable=invalid-name
+
+# frames are ordered by this header keyword, or file time if missing
+REPLAY_TIME_KEYWORD = 'DATE-OBS'
+# the recorder reports this declination so RA pulses scale as on sky
+REPLAY_DEC_KEYWORD = 'DEC'
+REPLAY_PULSE_FILE = 'pulses.jsonl'
+REPLAY_DB_FILE = 'replay.db'
+REPLAY_STDOUT_FILE = 'replay.out'
+
+def nightName(night_dir):
+    """
+    Name of an archived night, the first YYYYMMDD folder
+    found walking up from night_dir, e.g. for DATA_SUBDIRs
+
+    Parameters
+    ----------
+    night_dir : string
+        Folder holding the night's frames
+
+    Returns
+    -------
+    name : string
+        YYYYMMDD, or the folder name if no date is found
+
+    Raises
+    ------
+    None
+    """
+    path = os.path.abspath(night_dir)
+    while True:
+        head, tail = os.path.split(path)
+        if re.match(r'^\d{8}$', tail):
+            return tail
+        if not tail or head == path:
+            return os.path.basename(os.path.abspath(night_dir))
+        path = head
+
+def frameTime(path):
+    """
+    When a frame was taken, for ordering the replay
+
+    Parameters
+    ----------
+    path : string
+        Path to the frame
+
+    Returns
+    -------
+    t : float
+        Unix time from REPLAY_TIME_KEYWORD, or the file's
+        modification time if the header has no usable time
+
+    Raises
+    ------
+    None
+    """
+    try:
+        value = fits.getheader(path)[REPLAY_TIME_KEYWORD]
+        return datetime.strptime(value.split('.')[0], '%Y-%m-%dT%H:%M:%S').timestamp()
+    except (KeyError, ValueError, OSError, AttributeError):
+        print('No {} in {}, using the file time'.format(REPLAY_TIME_KEYWORD, path))
+        return os.path.getmtime(path)
+
+class RecorderTelescope(object):
+    """
+    Stand-in for ACP.Telescope that records guide pulses
+
+    Parameters
+    ----------
+    directions : dict
+        Direction -> PulseGuide direction code, see DIRECTIONS
+    pulse_log : string
+        File to append a JSON line to for every pulse
+    declination : float, optional
+        Declination reported to the guide loop (deg)
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, directions, pulse_log, declination=0.):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.direction_names = {code: name for name, code in directions.items()}
+        self.Declination = declination
+        self.Connected = True
+        self.IsPulseGuiding = 'False'
+        # the frame whose correction is being sent
+        self.frame = None
+        self.n_pulses = 0
+        self.pulse_file = open(pulse_log, 'a')
+
+    @property
+    def connected(self):
+        """
+        COM properties are case insensitive
+        """
+        return self.Connected
+
+    def PulseGuide(self, direction, duration):
+        """
+        Record a guide pulse, returning immediately
+
+        Parameters
+        ----------
+        self : the class self object
+        direction : int
+            Direction code, see DIRECTIONS
+        duration : float
+            Length of the pulse (ms)
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self.n_pulses += 1
+        self.pulse_file.write('{}\n'.format(json.dumps({'frame': self.frame,
+                                                        'direction': self.direction_names[direction],
+                                                        'duration': duration})))
+
+    def close(self):
+        """
+        Close the pulse log
+        """
+        self.pulse_file.close()
+
+class ReplayNight(object):
+    """
+    An archived night, fed to the guide loop a frame at a time
+
+    Parameters
+    ----------
+    config : dict
+        Instrument configuration values
+    night_dir : string
+        Folder holding the night's frames
+    out_dir : string
+        Folder for the replay's logs, references and pulse record
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, config, night_dir, out_dir):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.night_dir = os.path.abspath(night_dir)
+        self.out_dir = out_dir
+        name = nightName(night_dir)
+        self.night = '{}-{}-{}'.format(name[:4], name[4:6], name[6:]) \
+            if re.match(r'^\d{8}$', name) else name
+        extension = config['IMAGE_EXTENSION'].lstrip('*')
+        frames = [f for f in os.listdir(self.night_dir) if f.endswith(extension)]
+        times = {f: frameTime(os.path.join(self.night_dir, f)) for f in frames}
+        self.frames = sorted(frames, key=lambda f: (times[f], f))
+        self.index = -1
+        self.scope = RecorderTelescope(config['DIRECTIONS'],
+                                       os.path.join(out_dir, REPLAY_PULSE_FILE))
+
+    @property
+    def current(self):
+        """
+        The frame last handed to the guide loop, None before the first
+        """
+        return self.frames[self.index] if self.index >= 0 else None
+
+    def nextFrame(self):
+        """
+        Hand over the next frame
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        frame : string | None
+            Name of the frame, relative to the night folder,
+            None once the night is finished
+
+        Raises
+        ------
+        None
+        """
+        if self.index + 1 >= len(self.frames):
+            return None
+        self.index += 1
+        self.scope.frame = self.frames[self.index]
+        try:
+            value = fits.getheader(os.path.join(self.night_dir, self.scope.frame))[REPLAY_DEC_KEYWORD]
+            self.scope.Declination = Angle(value, unit=u.deg).deg
+        except (KeyError, ValueError, OSError):
+            pass
+        return self.scope.frame
+
+    def telescope(self):
+        """
+        The pulse recorder
+        """
+        return self.scope
+
+    def camera(self):
+        """
+        There is no camera in a replay
+        """
+        raise RuntimeError('No camera when replaying {}'.format(self.night_dir))
+
+    def close(self):
+        """
+        Close the pulse record
+        """
+        self.scope.close()
+
+def replayNights(instrument, night_dirs, out_dir, jobs=None):
+    """
+    Replay several nights in parallel, one acp_ag.py process each
+
+    Each night is written to out_dir/<night>/, as for a single
+    night, holding its guide logs, the SQLite stand-in database,
+    the reference images it picked, the pulse record and the
+    process output
+
+    Parameters
+    ----------
+    instrument : string
+        Instrument whose config to replay with
+    night_dirs : list
+        Folders holding the nights' frames
+    out_dir : string
+        Folder for the per night output folders
+    jobs : int, optional
+        Number of nights to replay at once, default one per CPU
+
+    Returns
+    -------
+    failed : list
+        Nights whose replay did not finish cleanly
+
+    Raises
+    ------
+    None
+    """
+    jobs = jobs or os.cpu_count() or 1
+    # one BLAS thread per replay, the nights are the parallelism
+    env = dict(os.environ)
+    for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        env.setdefault(name, '1')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'acp_ag.py')
+
+    def replay(night_dir):
+        """
+        Replay one night in a child process
+        """
+        night_out = os.path.join(out_dir, nightName(night_dir))
+        os.makedirs(night_out, exist_ok=True)
+        t0 = time.perf_counter()
+        with open(os.path.join(night_out, REPLAY_STDOUT_FILE), 'w') as of:
+            # the child adds the night to --replay_out itself
+            returncode = sp.call([sys.executable, script, instrument,
+                                  '--replay', night_dir, '--replay_out', out_dir],
+                                 stdin=sp.DEVNULL, stdout=of, stderr=sp.STDOUT, env=env)
+        return night_dir, returncode, time.perf_counter() - t0
+
+    failed = []
+    # the work is done in the child processes, threads just wait on them
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for night_dir, returncode, elapsed in pool.map(replay, night_dirs):
+            print('{} {} in {:.1f}s'.format(night_dir, 'done' if returncode == 0 else 'FAILED',
+                                           elapsed))
+            if returncode != 0:
+                failed.append(night_dir)
+    return failed
@@ -0,0 +1,483 @@
+"""
+Simulated ACP telescope and MaxIm camera
+
+A stand-in for the observatory hardware so the guide loop can run and
+be benchmarked on any machine. The simulated objects have the parts of
+the ACP.Telescope and MaxIm.CCDCamera COM interfaces that DONUTS uses,
+see ag_hardware.py.
+
+Models:
+    mount  : linear drift, periodic error along the RA axis, seeing
+             jitter and guide pulses with a start latency, moving the
+             field at the rates given by PIX2TIME in the config
+    camera : exposure plus readout time, frames of defocused stars
+             (see ag_synthetic.py) are rendered with the field at its
+             mid-exposure position and the true offset is stored in
+             the header (SIM_DX, SIM_DY)
+
+Time runs on a SimClock, so with speedup=10 a 30s exposure or a 1s
+pulse takes a tenth of the time. A guide pulse in direction +x moves
+the stars towards -x, matching Donuts which measures the shift that
+brings the comparison image back to the reference.
+"""
+import os
+import json
+import time
+import zlib
+import threading
+from math import (
+    radians,
+    cos,
+    sin,
+    pi)
+from datetime import (
+    datetime,
+    timedelta)
+import numpy as np
+from ag_synthetic import (
+    SyntheticField,
+    frameHeader,
+    getGeometry,
+    writeFrame
+    )
+
+# pylint: disable=invalid-name
+# pylint: disable=too-many-instance-attributes
+
+# default simulation parameters, all times in simulated seconds
+SIM_DRIFT = (2.0, -1.5)
+SIM_PE_AMPLITUDE = 1.0
+SIM_PE_PERIOD = 480.
+SIM_JITTER = 0.1
+SIM_PULSE_LATENCY = 0.05
+SIM_READOUT_TIME = 2.0
+
+class SimClock(object):
+    """
+    Simulated time, running speedup times faster than real time
+
+    Parameters
+    ----------
+    speedup : float, optional
+        Simulated seconds per real second
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, speedup=1.):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.speedup = float(speedup)
+        self.t0 = time.monotonic()
+        self.utc0 = datetime.utcnow()
+
+    def now(self):
+        """
+        Simulated seconds since the clock started
+        """
+        return (time.monotonic() - self.t0) * self.speedup
+
+    def utc(self, t):
+        """
+        Simulated UTC time at simulated time t
+        """
+        return self.utc0 + timedelta(seconds=t)
+
+    def sleep(self, seconds):
+        """
+        Sleep for a number of simulated seconds
+        """
+        time.sleep(max(seconds, 0.) / self.speedup)
+
+class SimTelescope(object):
+    """
+    Simulated ACP.Telescope
+
+    Parameters
+    ----------
+    clock : SimClock
+        Simulated time
+    pix2time : dict
+        Pulse guide rates (ms per pixel) per direction, see PIX2TIME
+    directions : dict
+        Direction -> PulseGuide direction code, see DIRECTIONS
+    ra_axis : string
+        Detector axis along RA, 'x' or 'y'
+    declination : float, optional
+        Declination of the field (deg)
+    drift : tuple, optional
+        Linear drift of the field in x and y (pixels per hour)
+    pe_amplitude : float, optional
+        Periodic error amplitude along the RA axis (pixels)
+    pe_period : float, optional
+        Periodic error period (s)
+    jitter : float, optional
+        RMS of the random seeing motion per frame (pixels)
+    pulse_latency : float, optional
+        Delay between a PulseGuide call and the mount moving (s)
+    seed : int, optional
+        Random number seed
+    event_log : string, optional
+        File to append a JSON line to for every pulse, with the
+        wall clock time it was sent, e.g. for latency benchmarks
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, clock, pix2time, directions, ra_axis, declination=0.,
+                 drift=SIM_DRIFT, pe_amplitude=SIM_PE_AMPLITUDE, pe_period=SIM_PE_PERIOD,
+                 jitter=SIM_JITTER, pulse_latency=SIM_PULSE_LATENCY, seed=None,
+                 event_log=None):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.clock = clock
+        self.pix2time = pix2time
+        self.direction_names = {code: name for name, code in directions.items()}
+        self.ra_axis = ra_axis
+        self.Declination = declination
+        self.Connected = True
+        self.drift = drift
+        self.pe_amplitude = pe_amplitude
+        self.pe_period = pe_period
+        self.jitter = jitter
+        self.pulse_latency = pulse_latency
+        self.event_log = event_log
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        # every pulse sent, as (axis, start, length, pixels)
+        self.pulses = []
+
+    @property
+    def connected(self):
+        """
+        COM properties are case insensitive
+        """
+        return self.Connected
+
+    def PulseGuide(self, direction, duration):
+        """
+        Start a guide pulse
+
+        Parameters
+        ----------
+        self : the class self object
+        direction : int
+            Direction code, see DIRECTIONS
+        duration : float
+            Length of the pulse (ms)
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        sent = time.time()
+        name = self.direction_names[direction]
+        axis = name[1]
+        # pixels moved by the whole pulse, RA rates shrink with cos(dec)
+        pixels = duration / self.pix2time[name]
+        if axis == self.ra_axis:
+            pixels *= cos(radians(self.Declination))
+        # guiding +x moves the stars towards -x
+        if name[0] == '+':
+            pixels = -pixels
+        start = self.clock.now() + self.pulse_latency
+        with self.lock:
+            self.pulses.append((axis, start, duration/1000., pixels))
+        if self.event_log:
+            with open(self.event_log, 'a') as ef:
+                ef.write('{}\n'.format(json.dumps({'event': 'pulse', 'time': sent,
+                                                   'direction': name,
+                                                   'duration': duration})))
+
+    @property
+    def IsPulseGuiding(self):
+        """
+        Guiding state, as the string compared against in acp_ag.guide()
+        """
+        now = self.clock.now()
+        with self.lock:
+            # only the last pulse on each axis can still be running
+            guiding = any(start + length > now for _, start, length, _ in self.pulses[-2:])
+        return 'True' if guiding else 'False'
+
+    def offset(self, t):
+        """
+        True position of the field relative to the start (pixels)
+
+        Parameters
+        ----------
+        self : the class self object
+        t : float
+            Simulated time
+
+        Returns
+        -------
+        dx, dy : float
+            Offset of the stars in x and y (pixels)
+
+        Raises
+        ------
+        None
+        """
+        offset = {'x': self.drift[0] * t / 3600.,
+                  'y': self.drift[1] * t / 3600.}
+        offset[self.ra_axis] += self.pe_amplitude * sin(2 * pi * t / self.pe_period)
+        with self.lock:
+            pulses = list(self.pulses)
+        # pulses move the field linearly while they run
+        for axis, start, length, pixels in pulses:
+            if t >= start + length:
+                offset[axis] += pixels
+            elif t > start:
+                offset[axis] += pixels * (t - start) / length
+        jitter = self.rng.normal(0., self.jitter, 2) if self.jitter > 0 else (0., 0.)
+        return offset['x'] + jitter[0], offset['y'] + jitter[1]
+
+class SimCamera(object):
+    """
+    Simulated MaxIm.CCDCamera
+
+    Parameters
+    ----------
+    clock : SimClock
+        Simulated time
+    telescope : SimTelescope
+        Mount the camera is on
+    config : dict
+        Instrument configuration values, for the header keywords
+        and detector geometry
+    shape : tuple, optional
+        Override the imaging area shape (ny, nx) from the config
+    readout_time : float, optional
+        Time from the end of an exposure to the image being ready (s)
+    seed : int, optional
+        Random number seed
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, clock, telescope, config, shape=None,
+                 readout_time=SIM_READOUT_TIME, seed=None):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.clock = clock
+        self.telescope = telescope
+        self.config = config
+        detector_shape, self.prescan, self.overscan = getGeometry(config)
+        self.shape = shape or detector_shape
+        self.readout_time = readout_time
+        self.rng = np.random.default_rng(seed)
+        self.LinkEnabled = False
+        self.DisableAutoShutdown = False
+        self.field = 'SIM-FIELD'
+        self.filter = 'I+z'
+        self.fields = {}
+        self.exposure = None
+
+    def setTarget(self, field, filt):
+        """
+        Point at a new field and filter, like an ACP plan target
+        """
+        self.field, self.filter = field, filt
+
+    def Expose(self, exptime, light=1, filter_id=0):
+        """
+        Start an exposure
+
+        Parameters
+        ----------
+        self : the class self object
+        exptime : float
+            Exposure time (s)
+        light : int, optional
+            1 for a light frame, unused
+        filter_id : int, optional
+            Filter wheel slot, unused, see setTarget
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        # pylint: disable=unused-argument
+        self.exposure = (self.clock.now(), float(exptime))
+
+    @property
+    def ImageReady(self):
+        """
+        Has the last exposure been read out?
+        """
+        if self.exposure is None:
+            return False
+        start, exptime = self.exposure
+        return self.clock.now() >= start + exptime + self.readout_time
+
+    def SaveImage(self, path):
+        """
+        Render the last exposure and write it to disc
+
+        The frame is written under a temporary name first, so the
+        guider never sees a partly written file
+
+        Parameters
+        ----------
+        self : the class self object
+        path : string
+            Where to write the FITS file
+
+        Returns
+        -------
+        saved : boolean
+            False if there is no exposure to save
+
+        Raises
+        ------
+        None
+        """
+        if self.exposure is None:
+            return False
+        start, exptime = self.exposure
+        # any pulses sent during the exposure are known by now
+        dx, dy = self.telescope.offset(start + exptime / 2.)
+        if self.field not in self.fields:
+            # the same field always has the same stars
+            self.fields[self.field] = SyntheticField(self.shape, self.prescan, self.overscan,
+                                                     seed=zlib.crc32(self.field.encode()))
+        data = self.fields[self.field].render(dx, dy, rng=self.rng)
+        header = frameHeader(self.config, self.field, self.filter, exptime,
+                             self.clock.utc(start), dx, dy, 1., False)
+        writeFrame(path, data, header)
+        return True
+
+class SimObservatory(object):
+    """
+    A simulated mount and camera on a shared clock
+
+    Parameters
+    ----------
+    config : dict
+        Instrument configuration values, see utils.get_config_values
+    speedup : float, optional
+        Simulated seconds per real second
+    seed : int, optional
+        Random number seed
+    shape : tuple, optional
+        Override the imaging area shape (ny, nx) from the config
+    **options
+        Passed on to SimTelescope
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, config, speedup=1., seed=None, shape=None, **options):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.config = config
+        self.clock = SimClock(speedup)
+        self.scope = SimTelescope(self.clock, config['PIX2TIME'], config['DIRECTIONS'],
+                                  config['RA_AXIS'], seed=seed, **options)
+        self.ccd = SimCamera(self.clock, self.scope, config, shape=shape, seed=seed)
+        self.thread = None
+
+    def telescope(self):
+        """
+        The simulated ACP.Telescope
+        """
+        return self.scope
+
+    def camera(self):
+        """
+        The simulated MaxIm.CCDCamera
+        """
+        return self.ccd
+
+    def takeImage(self, path, exptime):
+        """
+        Expose, wait for readout and save one image
+        """
+        self.ccd.Expose(exptime)
+        self.clock.sleep(exptime + self.ccd.readout_time)
+        while not self.ccd.ImageReady:
+            time.sleep(0.001)
+        return self.ccd.SaveImage(path)
+
+    def observe(self, night_dir, field, filt, exptime, n_frames):
+        """
+        Take a sequence of images into the night directory in the
+        background, as ACP would while DONUTS guides
+
+        Parameters
+        ----------
+        self : the class self object
+        night_dir : string
+            Folder to write the images to
+        field : string
+            Name of the field
+        filt : string
+            Name of the filter
+        exptime : float
+            Exposure time (s)
+        n_frames : int
+            Number of images to take
+
+        Returns
+        -------
+        thread : threading.Thread
+            The thread taking the images
+
+        Raises
+        ------
+        None
+        """
+        extension = self.config['IMAGE_EXTENSION'].lstrip('*')
+        def sequence():
+            """
+            Take the images one after another
+            """
+            self.ccd.setTarget(field, filt)
+            for i in range(n_frames):
+                name = '{}-{:04d}-{}{}'.format(field, i, filt, extension)
+                self.takeImage(os.path.join(night_dir, name), exptime)
+        self.thread = threading.Thread(target=sequence)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.thread
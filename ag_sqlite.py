@@ -0,0 +1,181 @@
+"""
+SQLite stand-in for the MySQL ops database
+
+Lets acp_ag.py run against a local file when benchmarking with the
+simulator (--sim_db), so no MySQL server is needed. The tables mirror
+the schemas in install/ and the README, and queries written for
+pymysql (%s placeholders) are translated on the fly. An artificial
+delay per query can be added to model a slow database.
+"""
+import time
+import sqlite3
+
+# pylint: disable=invalid-name
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS autoguider_ref (
+   ref_id integer primary key autoincrement,
+   field varchar(100) not null,
+   telescope varchar(20) not null,
+   ref_image varchar(100) not null,
+   filter varchar(20) not null,
+   valid_from datetime not null,
+   valid_until datetime
+);
+CREATE TABLE IF NOT EXISTS autoguider_log_new (
+   updated timestamp default current_timestamp,
+   night date not null,
+   reference varchar(150) not null,
+   comparison varchar(150) not null,
+   stabilised varchar(5) not null,
+   shift_x double not null,
+   shift_y double not null,
+   pre_pid_x double not null,
+   pre_pid_y double not null,
+   post_pid_x double not null,
+   post_pid_y double not null,
+   std_buff_x double not null,
+   std_buff_y double not null,
+   culled_max_shift_x varchar(5) not null,
+   culled_max_shift_y varchar(5) not null,
+   t_detect float,
+   t_load float,
+   t_measure float,
+   t_pid float,
+   t_guide float,
+   t_db float
+);
+CREATE TABLE IF NOT EXISTS autoguider_info_log (
+   message_id integer primary key autoincrement,
+   updated timestamp default current_timestamp,
+   telescope varchar(20) not null,
+   message varchar(500) not null
+);
+CREATE TABLE IF NOT EXISTS autoguider_stall_log (
+   stall_id integer primary key autoincrement,
+   updated timestamp default current_timestamp,
+   telescope varchar(20) not null,
+   night date,
+   comparison varchar(150),
+   stage varchar(20) not null,
+   elapsed float not null,
+   deadline float not null,
+   aborted varchar(5) not null,
+   dump_file varchar(300)
+);
+"""
+
+def createSchema(path):
+    """
+    Create the ops tables in a SQLite file, if missing
+
+    Parameters
+    ----------
+    path : string
+        Path to the SQLite file
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    with sqlite3.connect(path) as conn:
+        conn.executescript(SQLITE_SCHEMA)
+
+class SqliteCursor(object):
+    """
+    Cursor taking pymysql style queries, with an optional delay
+
+    Parameters
+    ----------
+    cursor : sqlite3.Cursor
+        The real cursor
+    latency : float
+        Seconds to wait before each query
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, cursor, latency):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.cursor = cursor
+        self.latency = latency
+
+    def execute(self, qry, qry_args=None):
+        """
+        Run a query written with %s placeholders
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self.cursor.execute(qry.replace('%s', '?'), qry_args or ())
+
+    def fetchone(self):
+        """
+        Next row of the last query
+        """
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        """
+        All rows of the last query
+        """
+        return self.cursor.fetchall()
+
+class SqliteDb(object):
+    """
+    Connection used like pymysql's, 'with SqliteDb(path) as cur:'
+    yields a cursor and commits on leaving the block
+
+    Parameters
+    ----------
+    path : string
+        Path to the SQLite file, see createSchema
+    latency : float, optional
+        Seconds to wait before each query
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, path, latency=0.):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.path = path
+        self.latency = latency
+        self.conn = None
+
+    def __enter__(self):
+        """
+        Connect and return a cursor
+        """
+        # the watchdog thread logs stalls through its own connection
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        return SqliteCursor(self.conn.cursor(), self.latency)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Commit unless the block failed, then disconnect
+        """
+        if exc_type is None:
+            self.conn.commit()
+        self.conn.close()
+        return False
@@ -0,0 +1,113 @@
+"""
+Crash safe snapshots of the guide loop state
+
+After every frame the worker writes its state (field, filter, reference
+images, PID controllers, rejection buffers and stabilisation counter) to
+STATE_FILE in the night's data directory. The file is replaced
+atomically so a crash can never leave a partial snapshot behind.
+
+When the worker is restarted on the same night and the snapshot is
+recent and for the field/filter currently being observed, it carries on
+from the snapshot rather than going through pull in again.
+"""
+import os
+import json
+import time
+
+# pylint: disable=invalid-name
+
+STATE_FILE = "guider_state.json"
+# bump when the snapshot layout changes, older snapshots are ignored
+# 2: the PID controllers are one PIDBank snapshot under pid
+STATE_VERSION = 2
+# snapshots older than this (seconds) are ignored
+MAX_STATE_AGE = 600
+
+def getStatePath(data_loc):
+    """
+    Get the path of the state snapshot for a night
+
+    Parameters
+    ----------
+    data_loc : string
+        Path to the night's data directory
+
+    Returns
+    -------
+    state_path : string
+        Path to the snapshot file
+
+    Raises
+    ------
+    None
+    """
+    return os.path.join(data_loc, STATE_FILE)
+
+def saveState(state_path, state):
+    """
+    Atomically write a state snapshot
+
+    Parameters
+    ----------
+    state_path : string
+        Path to the snapshot file
+    state : dict
+        JSON serialisable guide loop state
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    state = dict(state, version=STATE_VERSION, saved=time.time())
+    tmp_path = "{}.tmp".format(state_path)
+    try:
+        with open(tmp_path, 'w') as sf:
+            json.dump(state, sf, default=float)
+        os.replace(tmp_path, state_path)
+    except OSError:
+        # snapshots are best effort, never stop guiding for one
+        pass
+
+def loadState(state_path, night, field, filt, max_age=MAX_STATE_AGE):
+    """
+    Load a state snapshot if it can be resumed from
+
+    Parameters
+    ----------
+    state_path : string
+        Path to the snapshot file
+    night : string
+        Current night (YYYY-MM-DD)
+    field : string
+        Field currently being observed
+    filt : string
+        Filter currently in use
+    max_age : float, optional
+        Maximum age of the snapshot in seconds
+
+    Returns
+    -------
+    state : dict | None
+        The snapshot, None if it is missing, unreadable, too old
+        or for a different night, field or filter
+
+    Raises
+    ------
+    None
+    """
+    try:
+        with open(state_path) as sf:
+            state = json.load(sf)
+    except (OSError, ValueError):
+        return None
+    if state.get('version') != STATE_VERSION:
+        return None
+    if time.time() - state.get('saved', 0) > max_age:
+        return None
+    if (state.get('night'), state.get('field'), state.get('filter')) != (night, field, filt):
+        return None
+    return state
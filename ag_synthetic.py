@@ -0,0 +1,390 @@
+"""
+Synthetic defocused star field frames
+
+Writes FITS frames that look enough like the real SPECULOOS/NITES
+images to benchmark and validate the shift measurement without
+shipping real data. Each frame has:
+    - defocused (donut) stars at a known injected shift
+    - bias, sky and read/photon noise
+    - prescan and overscan columns of bias only
+    - optional passing cloud (lower transparency, brighter sky)
+    - optional satellite trails
+    - IMAGE_EXTENSION, FILTER_KEYWORD and FIELD_KEYWORD from the
+      instrument config, plus the true shift in SIM_DX and SIM_DY
+
+The detector geometry is read from the optional config values
+DETECTOR_SHAPE (ny, nx), PRESCAN_WIDTH and OVERSCAN_WIDTH, falling
+back to DEFAULT_GEOMETRY. The stars are rendered all at once from
+precomputed stamp offsets and summed with np.bincount, so a frame
+costs a few vectorised array operations whatever the star count.
+"""
+import os
+import csv
+from datetime import (
+    datetime,
+    timedelta)
+import numpy as np
+from astropy.io import fits
+
+# pylint: disable=invalid-name
+# pylint: disable=too-many-instance-attributes
+# pylint: disable=too-many-arguments
+
+DEFAULT_GEOMETRY = {'DETECTOR_SHAPE': (2048, 2048),
+                    'PRESCAN_WIDTH': 20,
+                    'OVERSCAN_WIDTH': 20}
+SYNTH_N_STARS = 80
+SYNTH_BIAS = 1000.
+SYNTH_SKY = 300.
+SYNTH_READ_NOISE = 8.
+# donut inner and outer radius and edge softness (pixels)
+SYNTH_DONUT = (4., 9., 0.8)
+SYNTH_CLOUD_PROBABILITY = 0.05
+SYNTH_TRAIL_PROBABILITY = 0.02
+SYNTH_TRAIL_COUNTS = 2000.
+SYNTH_TRUTH_FILE = "truth.csv"
+
+def getGeometry(config):
+    """
+    Detector geometry for an instrument
+
+    Parameters
+    ----------
+    config : dict
+        Instrument configuration values, see utils.get_config_values
+
+    Returns
+    -------
+    shape : tuple
+        Shape of the imaging area (ny, nx)
+    prescan : int
+        Number of prescan columns
+    overscan : int
+        Number of overscan columns
+
+    Raises
+    ------
+    None
+    """
+    geometry = dict(DEFAULT_GEOMETRY)
+    geometry.update({key: config[key] for key in DEFAULT_GEOMETRY if key in config})
+    return (tuple(geometry['DETECTOR_SHAPE']), geometry['PRESCAN_WIDTH'],
+            geometry['OVERSCAN_WIDTH'])
+
+class SyntheticField(object):
+    """
+    Render frames of one field of defocused stars
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the imaging area (ny, nx)
+    prescan : int, optional
+        Number of prescan columns
+    overscan : int, optional
+        Number of overscan columns
+    n_stars : int, optional
+        Number of stars in the field
+    donut : tuple, optional
+        Inner radius, outer radius and edge softness of the PSF (pixels)
+    sky : float, optional
+        Sky level (counts)
+    read_noise : float, optional
+        Read noise (counts)
+    seed : int, optional
+        Random number seed, the same seed gives the same stars
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, shape, prescan=0, overscan=0, n_stars=SYNTH_N_STARS,
+                 donut=SYNTH_DONUT, sky=SYNTH_SKY, read_noise=SYNTH_READ_NOISE,
+                 seed=None):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.shape = shape
+        self.prescan = prescan
+        self.overscan = overscan
+        self.sky = sky
+        self.read_noise = read_noise
+        self.r_in, self.r_out, self.softness = donut
+        self.rng = np.random.default_rng(seed)
+        ny, nx = shape
+        half = int(np.ceil(self.r_out + 4*self.softness))
+        self.half = half
+        self.x = self.rng.uniform(half, nx - half, n_stars)
+        self.y = self.rng.uniform(half, ny - half, n_stars)
+        # roughly power law brightness distribution
+        self.flux = 5e4 * 10**self.rng.uniform(0., 2., n_stars)
+        # stamp pixel offsets shared by all stars
+        offsets = np.arange(-half, half + 1)
+        self.stamp_dy, self.stamp_dx = [o.ravel() for o in np.meshgrid(offsets, offsets,
+                                                                        indexing='ij')]
+
+    def _donut(self, r):
+        """
+        Radial profile of an annulus with soft edges
+        """
+        inner = 1. / (1. + np.exp(-(r - self.r_in) / self.softness))
+        outer = 1. / (1. + np.exp(-(r - self.r_out) / self.softness))
+        return inner - outer
+
+    def stars(self, dx, dy, transparency=1.):
+        """
+        Noiseless star light in the imaging area
+
+        Parameters
+        ----------
+        self : the class self object
+        dx, dy : float
+            Shift of the field (pixels)
+        transparency : float, optional
+            Fraction of the star light getting through
+
+        Returns
+        -------
+        image : array
+            Star counts, float32, shape self.shape
+
+        Raises
+        ------
+        None
+        """
+        ny, nx = self.shape
+        xc = self.x + dx
+        yc = self.y + dy
+        # pixel each stamp pixel lands on, stars x stamp pixels
+        px = np.rint(xc).astype(int)[:, None] + self.stamp_dx[None, :]
+        py = np.rint(yc).astype(int)[:, None] + self.stamp_dy[None, :]
+        r = np.hypot(px - xc[:, None], py - yc[:, None])
+        profile = self._donut(r)
+        profile *= (self.flux * transparency / profile.sum(axis=1))[:, None]
+        inside = (px >= 0) & (px < nx) & (py >= 0) & (py < ny)
+        counts = np.bincount(py[inside]*nx + px[inside], weights=profile[inside],
+                             minlength=ny*nx)
+        return counts.reshape(self.shape).astype(np.float32)
+
+    def trail(self, rng, counts=SYNTH_TRAIL_COUNTS, width=1.5):
+        """
+        A satellite trail crossing the imaging area at a random angle
+
+        Parameters
+        ----------
+        self : the class self object
+        rng : np.random.Generator
+            Random number generator
+        counts : float, optional
+            Peak counts of the trail
+        width : float, optional
+            Gaussian width of the trail (pixels)
+
+        Returns
+        -------
+        image : array
+            Trail counts, float32, shape self.shape
+
+        Raises
+        ------
+        None
+        """
+        ny, nx = self.shape
+        theta = rng.uniform(0., np.pi)
+        x0, y0 = rng.uniform(0, nx), rng.uniform(0, ny)
+        y = np.arange(ny, dtype=np.float32)[:, None]
+        x = np.arange(nx, dtype=np.float32)[None, :]
+        distance = np.abs((x - x0)*np.sin(theta) - (y - y0)*np.cos(theta))
+        return (counts * np.exp(-0.5*(distance/width)**2)).astype(np.float32)
+
+    def render(self, dx, dy, transparency=1., trail=False, rng=None):
+        """
+        Render one frame
+
+        Parameters
+        ----------
+        self : the class self object
+        dx, dy : float
+            Shift of the field (pixels)
+        transparency : float, optional
+            Fraction of the light getting through, < 1 for cloud
+        trail : boolean, optional
+            Add a satellite trail?
+        rng : np.random.Generator, optional
+            Random number generator for the noise, defaults to the field's
+
+        Returns
+        -------
+        frame : array
+            Frame including the prescan and overscan columns, uint16
+
+        Raises
+        ------
+        None
+        """
+        rng = rng or self.rng
+        # cloud dims the stars and scatters moonlight/skyglow
+        light = self.stars(dx, dy, transparency)
+        light += self.sky * (1. + 0.5*(1. - transparency))
+        if trail:
+            light += self.trail(rng)
+        # photon noise, gaussian approximation to poisson
+        light += rng.standard_normal(self.shape, dtype=np.float32) * np.sqrt(light)
+        ny, nx = self.shape
+        frame = rng.standard_normal((ny, self.prescan + nx + self.overscan),
+                                    dtype=np.float32) * self.read_noise
+        frame += SYNTH_BIAS
+        frame[:, self.prescan:self.prescan + nx] += light
+        return np.clip(frame, 0, 65535).astype(np.uint16)
+
+def frameHeader(config, field, filt, exptime, utc, dx, dy, transparency, trail):
+    """
+    FITS header for a synthetic frame
+
+    Parameters
+    ----------
+    config : dict
+        Instrument configuration values
+    field : string
+        Name of the field
+    filt : string
+        Name of the filter
+    exptime : float
+        Exposure time (s)
+    utc : datetime
+        Start of the exposure
+    dx, dy : float
+        True shift of the field (pixels)
+    transparency : float
+        Fraction of the light getting through
+    trail : boolean
+        Does the frame have a satellite trail?
+
+    Returns
+    -------
+    header : fits.Header
+        The header
+
+    Raises
+    ------
+    None
+    """
+    header = fits.Header()
+    header[config['FIELD_KEYWORD']] = field
+    header[config['FILTER_KEYWORD']] = filt
+    header['EXPTIME'] = exptime
+    header['DATE-OBS'] = utc.isoformat()
+    header['SIM_DX'] = (float(dx), 'true x shift of the field (pix)')
+    header['SIM_DY'] = (float(dy), 'true y shift of the field (pix)')
+    header['SIM_TRAN'] = (float(transparency), 'simulated transparency')
+    header['SIM_TRL'] = (bool(trail), 'simulated satellite trail')
+    return header
+
+def writeFrame(path, frame, header):
+    """
+    Write a frame under a temporary name then move it into place,
+    so a guider watching the folder never sees a partial file
+    """
+    tmp_path = '{}.part'.format(path)
+    fits.writeto(tmp_path, frame, header, overwrite=True)
+    os.replace(tmp_path, path)
+
+def makeShifts(n_frames, drift=(0.05, -0.03), jitter=0.3, seed=None):
+    """
+    Known shifts for a night: a linear drift plus random jitter
+
+    Parameters
+    ----------
+    n_frames : int
+        Number of frames
+    drift : tuple, optional
+        Drift per frame in x and y (pixels)
+    jitter : float, optional
+        RMS random shift per frame (pixels)
+    seed : int, optional
+        Random number seed
+
+    Returns
+    -------
+    shifts : array
+        Rows of dx, dy per frame
+
+    Raises
+    ------
+    None
+    """
+    rng = np.random.default_rng(seed)
+    steps = np.arange(n_frames)[:, None] * np.asarray(drift)[None, :]
+    return steps + rng.normal(0., jitter, (n_frames, 2))
+
+def makeNight(config, out_dir, n_frames, field='SYNTH-FIELD', filt='I+z',
+              exptime=30., shifts=None, cloud_probability=SYNTH_CLOUD_PROBABILITY,
+              trail_probability=SYNTH_TRAIL_PROBABILITY, shape=None, seed=None):
+    """
+    Write a night of synthetic frames and a table of the true shifts
+
+    Parameters
+    ----------
+    config : dict
+        Instrument configuration values
+    out_dir : string
+        Folder to write the frames to
+    n_frames : int
+        Number of frames
+    field : string, optional
+        Name of the field
+    filt : string, optional
+        Name of the filter
+    exptime : float, optional
+        Exposure time (s), also the cadence of DATE-OBS
+    shifts : array, optional
+        Rows of dx, dy per frame, default makeShifts(n_frames)
+    cloud_probability : float, optional
+        Chance of each frame being clouded
+    trail_probability : float, optional
+        Chance of each frame having a satellite trail
+    shape : tuple, optional
+        Override the imaging area shape (ny, nx) from the config
+    seed : int, optional
+        Random number seed
+
+    Returns
+    -------
+    truth : list
+        (filename, dx, dy, transparency, trail) per frame, also
+        written to SYNTH_TRUTH_FILE in out_dir
+
+    Raises
+    ------
+    None
+    """
+    detector_shape, prescan, overscan = getGeometry(config)
+    synth = SyntheticField(shape or detector_shape, prescan, overscan, seed=seed)
+    rng = np.random.default_rng(seed)
+    shifts = makeShifts(n_frames, seed=seed) if shifts is None else np.asarray(shifts)
+    clouded = rng.random(n_frames) < cloud_probability
+    transparency = np.where(clouded, rng.uniform(0.05, 0.8, n_frames), 1.)
+    trails = rng.random(n_frames) < trail_probability
+    extension = config['IMAGE_EXTENSION'].lstrip('*')
+    utc0 = datetime.utcnow()
+    os.makedirs(out_dir, exist_ok=True)
+    truth = []
+    for i, (dx, dy) in enumerate(shifts):
+        name = '{}-{:04d}-{}{}'.format(field, i, filt, extension)
+        frame = synth.render(dx, dy, transparency[i], trails[i], rng)
+        header = frameHeader(config, field, filt, exptime,
+                             utc0 + timedelta(seconds=i*exptime),
+                             dx, dy, transparency[i], trails[i])
+        writeFrame(os.path.join(out_dir, name), frame, header)
+        truth.append((name, float(dx), float(dy), float(transparency[i]), bool(trails[i])))
+    with open(os.path.join(out_dir, SYNTH_TRUTH_FILE), 'w', newline='') as tf:
+        writer = csv.writer(tf)
+        writer.writerow(['filename', 'dx', 'dy', 'transparency', 'trail'])
+        writer.writerows(truth)
+    return truth
@@ -0,0 +1,234 @@
+"""
+Guide loop stall watchdog
+
+The guide loop can hang in a stage, e.g. polling IsPulseGuiding,
+opening a locked FITS file or waiting on the database. StageTimer (see
+guide_log.py) tells the Watchdog when each stage starts and ends and a
+background thread checks the running stage against its deadline.
+
+When a stage overruns the watchdog, once per stage:
+   1. Appends the stacks of all threads to a dump file
+   2. Optionally aborts the frame by raising FrameStalled in the
+      guide loop thread
+   3. Calls on_stall(stage, elapsed, dump_path, aborted), e.g. to
+      record the stall in the database
+
+The abort is an asynchronous exception, so it is only delivered when
+the guide loop thread next runs Python code. A COM or socket call that
+never returns cannot be interrupted. Polling loops are interrupted,
+and so are database calls once their timeout expires.
+"""
+import time
+import ctypes
+import threading
+import faulthandler
+from datetime import datetime
+
+# pylint: disable=invalid-name
+
+# default seconds allowed per stage, stages not listed are not watched
+DEFAULT_DEADLINES = {'load': 30.,
+                     'measure': 60.,
+                     'pid': 5.,
+                     'guide': 60.,
+                     'db': 30.}
+WATCHDOG_INTERVAL = 1.0
+WATCHDOG_DUMP_FILE = "watchdog.log"
+
+class FrameStalled(Exception):
+    """
+    Raised in the guide loop thread when a stalled frame is aborted
+    """
+
+def _setAsyncExc(thread_id, exception):
+    """
+    Raise exception in another thread, None clears a pending one
+    """
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread_id),
+                                                      ctypes.py_object(exception)
+                                                      if exception else None)
+
+class Watchdog(object):
+    """
+    Watch the stages of the guide loop for stalls
+
+    Parameters
+    ----------
+    deadlines : dict
+        Stage name -> maximum duration in seconds
+    on_stall : callable, optional
+        Called as on_stall(stage, elapsed, dump_path, aborted)
+        from the watchdog thread when a stage overruns
+    abort : boolean, optional
+        Abort stalled frames by raising FrameStalled?
+        Default = False
+    dump_path : string, optional
+        File the thread stacks are appended to
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, deadlines, on_stall=None, abort=False,
+                 dump_path=WATCHDOG_DUMP_FILE):
+        """
+        Initialise the class and start watching
+
+        See class docstring above
+        """
+        self.deadlines = deadlines
+        self.on_stall = on_stall
+        self.abort = abort
+        self.dump_path = dump_path
+        self.lock = threading.Lock()
+        self.loop_thread_id = threading.get_ident()
+        self.stage = None
+        self.owner = None
+        self.stage_start = None
+        self.reported = False
+        self.aborting = False
+        self.thread = threading.Thread(target=self.watch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enter(self, stage, owner=None):
+        """
+        Mark the start of a stage, called from the guide loop thread
+
+        Nested stages are not watched separately, the outer stage
+        keeps its deadline. A stage still set by a different owner
+        was left behind by an aborted frame whose exit() never ran,
+        it is dropped along with any abort still pending for it
+
+        Parameters
+        ----------
+        self : the class self object
+        stage : string
+            Name of the stage
+        owner : object, optional
+            Who is timing the stage, e.g. the frame's StageTimer
+
+        Returns
+        -------
+        entered : boolean
+            True if this call started watching the stage
+
+        Raises
+        ------
+        None
+        """
+        with self.lock:
+            if self.stage is not None:
+                if owner is None or owner is self.owner:
+                    return False
+                if self.aborting:
+                    _setAsyncExc(self.loop_thread_id, None)
+                    self.aborting = False
+            self.stage = stage
+            self.owner = owner
+            self.stage_start = time.monotonic()
+            self.reported = False
+            return True
+
+    def exit(self):
+        """
+        Mark the end of the current stage, called from the guide loop thread
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        FrameStalled
+            If the stage was aborted by the watchdog, so the abort
+            always surfaces at the end of the stalled stage
+        """
+        with self.lock:
+            self.stage = None
+            self.owner = None
+            aborting, self.aborting = self.aborting, False
+        if aborting:
+            # clear any exception not yet delivered and raise it here instead
+            _setAsyncExc(self.loop_thread_id, None)
+            raise FrameStalled('Frame aborted by the stall watchdog')
+
+    def dumpStacks(self, stage, elapsed):
+        """
+        Append the stacks of all threads to the dump file
+
+        Parameters
+        ----------
+        self : the class self object
+        stage : string
+            Name of the stalled stage
+        elapsed : float
+            Seconds spent in the stage so far
+
+        Returns
+        -------
+        dump_path : string | None
+            Path to the dump file, None if it could not be written
+
+        Raises
+        ------
+        None
+        """
+        try:
+            with open(self.dump_path, 'a') as df:
+                df.write('\n[{}] stage {} stalled for {:.1f}s (deadline {:.1f}s)\n'.format(
+                    datetime.utcnow().isoformat(), stage, elapsed, self.deadlines[stage]))
+                df.flush()
+                faulthandler.dump_traceback(file=df, all_threads=True)
+        except OSError:
+            return None
+        return self.dump_path
+
+    def watch(self):
+        """
+        Check the running stage against its deadline until the
+        process exits
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        while True:
+            time.sleep(WATCHDOG_INTERVAL)
+            with self.lock:
+                stage, reported = self.stage, self.reported
+                if stage is None or reported or stage not in self.deadlines:
+                    continue
+                elapsed = time.monotonic() - self.stage_start
+                if elapsed <= self.deadlines[stage]:
+                    continue
+                self.reported = True
+                stage_start = self.stage_start
+            # dump the stacks before aborting so they show where it hung
+            dump_path = self.dumpStacks(stage, elapsed)
+            aborted = False
+            with self.lock:
+                if self.abort and self.stage == stage and self.stage_start == stage_start:
+                    self.aborting = aborted = True
+                    _setAsyncExc(self.loop_thread_id, FrameStalled)
+            if self.on_stall is not None:
+                try:
+                    self.on_stall(stage, elapsed, dump_path, aborted)
+                except Exception as err: # pylint: disable=broad-except
+                    print('Stall callback failed: {}'.format(err))
@@ -0,0 +1,658 @@
+"""
+Script to archive closed nights out of the live autoguider log tables
+
+autoguider_log_new and autoguider_info_log grow by one row per frame
+and several rows per message. This script keeps them small:
+
+   1. Find nights in autoguider_log_new older than --keep_nights
+   2. For each one, write its autoguider_log_new rows and the
+      autoguider_info_log rows from local midday to midday to a
+      compressed per-night archive file (night_TELESCOPE_YYYYMMDD.npz)
+   3. Verify the archive can be read back, then delete the rows
+      from the live tables in a single transaction
+   4. Optionally (--partition) partition autoguider_log_new by month
+      of night so queries on recent nights only touch recent data
+
+Several telescopes can share one ops database, so only the given
+telescope's rows are touched: autoguider_info_log by its telescope
+column and autoguider_log_new by the telescope of the reference image
+in autoguider_ref. Each telescope gets its own archive files, so
+they can share an --archive_dir.
+
+The getGuideLog and getInfoMessages helpers read from both the live
+tables and the archives, so tools can query the full history without
+caring where the rows are stored.
+"""
+import os
+import glob as g
+import argparse as ap
+from datetime import (
+    date,
+    datetime,
+    timedelta
+    )
+import numpy as np
+import pymysql
+import pymysql.cursors
+from guide_log import STAGES
+from utils import (
+    INSTRUMENT_CONFIGS,
+    get_config_values
+    )
+
+# pylint: disable=invalid-name
+
+# columns of autoguider_log_new rows, live or archived. The stage
+# timings were added later and are NaN in older rows and archives
+TIMING_COLUMNS = tuple('t_{}'.format(stage) for stage in STAGES)
+LOG_COLUMNS = ('updated', 'night', 'reference', 'comparison', 'stabilised',
+               'shift_x', 'shift_y', 'pre_pid_x', 'pre_pid_y',
+               'post_pid_x', 'post_pid_y', 'std_buff_x', 'std_buff_y',
+               'culled_max_shift_x', 'culled_max_shift_y') + TIMING_COLUMNS
+INFO_COLUMNS = ('message_id', 'updated', 'telescope', 'message')
+ARCHIVE_PREFIX = "night_"
+# default archive folder, under the instrument's BASE_DIR
+ARCHIVE_SUBDIR = "autoguider_archive"
+FETCH_CHUNK = 10000
+# autoguider_log_new has no telescope column, its rows belong
+# to the telescope whose reference image they were measured against
+TELESCOPE_LOG_ROWS = "reference IN (SELECT ref_image FROM autoguider_ref WHERE telescope = %s)"
+
+def argParse():
+    """
+    Parse the command line arguments
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    args : argparse object
+        Contains the command line arguments
+
+    Raises
+    ------
+    None
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('telescope',
+                   help='Name of telescope',
+                   choices=sorted(INSTRUMENT_CONFIGS))
+    p.add_argument('--keep_nights',
+                   help='Number of recent nights to keep in the live tables',
+                   type=int,
+                   default=30)
+    p.add_argument('--archive_dir',
+                   help='Folder for the archive files (default = BASE_DIR\\autoguider_archive)')
+    p.add_argument('--partition',
+                   help='Partition autoguider_log_new by month of night',
+                   action='store_true')
+    p.add_argument('--dry_run',
+                   help='Report what would be archived, but change nothing',
+                   action='store_true')
+    return p.parse_args()
+
+def connectDb(db_info, autocommit=True):
+    """
+    Open a connection to the ops database
+
+    Parameters
+    ----------
+    db_info : dict
+        Database connection info with keys host, user,
+        database and password
+    autocommit : boolean
+        Commit each statement automatically?
+        Default = True
+
+    Returns
+    -------
+    conn : pymysql.connections.Connection
+        Open database connection
+
+    Raises
+    ------
+    None
+    """
+    return pymysql.connect(host=db_info['host'], user=db_info['user'],
+                           db=db_info['database'], password=db_info['password'],
+                           autocommit=autocommit)
+
+def rowsToArray(columns, rows):
+    """
+    Convert database rows to a NumPy structured array
+
+    Dates become datetime64, strings become fixed width unicode
+    and NULL numerical values become NaN
+
+    Parameters
+    ----------
+    columns : array like
+        Names of the columns in each row
+    rows : array like
+        Rows as returned by cursor.fetchall()
+
+    Returns
+    -------
+    records : np.ndarray
+        Structured array with one field per column
+
+    Raises
+    ------
+    None
+    """
+    arrays = []
+    for i in range(len(columns)):
+        values = [row[i] for row in rows]
+        example = next((v for v in values if v is not None), None)
+        if isinstance(example, datetime):
+            arrays.append(np.array(values, dtype='datetime64[s]'))
+        elif isinstance(example, date):
+            arrays.append(np.array(values, dtype='datetime64[D]'))
+        elif isinstance(example, str):
+            arrays.append(np.array(['' if v is None else v for v in values], dtype=str))
+        else:
+            arrays.append(np.array([np.nan if v is None else v for v in values], dtype=float))
+    return np.rec.fromarrays(arrays, names=list(columns)).view(np.ndarray)
+
+def concatenateArrays(parts):
+    """
+    Join structured arrays whose string columns may differ in width
+
+    Parameters
+    ----------
+    parts : array like
+        Structured arrays with the same field names
+
+    Returns
+    -------
+    records : np.ndarray
+        The joined array, strings widened to fit all parts
+
+    Raises
+    ------
+    None
+    """
+    dtype = np.result_type(*[part.dtype for part in parts])
+    return np.concatenate([part.astype(dtype) for part in parts])
+
+def addMissingColumns(records, columns):
+    """
+    Add any missing numerical columns to a structured array, as NaN
+
+    Parameters
+    ----------
+    records : np.ndarray
+        Structured array, e.g. from an older archive
+    columns : array like
+        Columns that must be present
+
+    Returns
+    -------
+    records : np.ndarray
+        The array with all columns present
+
+    Raises
+    ------
+    None
+    """
+    missing = [column for column in columns if column not in records.dtype.names]
+    if not missing:
+        return records
+    upgraded = np.empty(len(records), dtype=records.dtype.descr + [(m, '<f8') for m in missing])
+    for name in records.dtype.names:
+        upgraded[name] = records[name]
+    for name in missing:
+        upgraded[name] = np.nan
+    return upgraded
+
+def nextMonth(month):
+    """
+    Return the first day of the month after a given date
+
+    Parameters
+    ----------
+    month : datetime.date
+        Any day in the current month
+
+    Returns
+    -------
+    next_month : datetime.date
+        First day of the following month
+
+    Raises
+    ------
+    None
+    """
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def getArchivePath(archive_dir, telescope, night):
+    """
+    Return the archive file path for a telescope's night
+
+    Parameters
+    ----------
+    archive_dir : string
+        Folder holding the archive files
+    telescope : string
+        Name of the telescope
+    night : datetime.date
+        Night to archive
+
+    Returns
+    -------
+    archive_path : string
+        Path to the night's archive file
+
+    Raises
+    ------
+    None
+    """
+    return os.path.join(archive_dir, "{}{}_{}.npz".format(ARCHIVE_PREFIX, telescope,
+                                                          night.strftime('%Y%m%d')))
+
+def getNightWindow(night):
+    """
+    Return the local time window covering a night
+
+    Parameters
+    ----------
+    night : datetime.date
+        Night of interest
+
+    Returns
+    -------
+    start : datetime
+        Midday local time on the night
+    end : datetime
+        Midday local time the following day
+
+    Raises
+    ------
+    None
+    """
+    start = datetime(night.year, night.month, night.day, 12)
+    return start, start + timedelta(days=1)
+
+def getClosedNights(db_info, telescope, keep_nights):
+    """
+    Find the nights in autoguider_log_new that can be archived
+
+    Parameters
+    ----------
+    db_info : dict
+        Database connection info
+    telescope : string
+        Name of the telescope
+    keep_nights : int
+        Number of recent nights to keep live. Tonight
+        is always kept
+
+    Returns
+    -------
+    nights : list
+        datetime.date objects for each closed night
+
+    Raises
+    ------
+    None
+    """
+    cutoff = date.today() - timedelta(days=max(keep_nights, 1))
+    qry = """
+        SELECT DISTINCT night
+        FROM autoguider_log_new
+        WHERE night < %s
+        AND {}
+        ORDER BY night
+        """.format(TELESCOPE_LOG_ROWS)
+    conn = connectDb(db_info)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(qry, (cutoff, telescope))
+            nights = [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+    return nights
+
+def archiveNight(db_info, telescope, archive_dir, night, dry_run=False):
+    """
+    Move one night from the live tables into an archive file
+
+    Rows are only deleted once the archive has been written and
+    read back with matching row counts. If an archive for the
+    night already exists (e.g. late rows), the new rows are merged
+    into it.
+
+    Parameters
+    ----------
+    db_info : dict
+        Database connection info
+    telescope : string
+        Name of the telescope, only its rows are archived
+    archive_dir : string
+        Folder holding the archive files
+    night : datetime.date
+        Night to archive
+    dry_run : boolean
+        Report only, do not write or delete anything
+        Default = False
+
+    Returns
+    -------
+    n_log : int
+        Number of autoguider_log_new rows archived
+    n_info : int
+        Number of autoguider_info_log rows archived
+
+    Raises
+    ------
+    None
+    """
+    window_start, window_end = getNightWindow(night)
+    log_qry = "SELECT {} FROM autoguider_log_new WHERE night = %s AND {}".format(
+        ", ".join(LOG_COLUMNS), TELESCOPE_LOG_ROWS)
+    info_qry = """
+        SELECT {}
+        FROM autoguider_info_log
+        WHERE updated >= %s
+        AND updated < %s
+        AND telescope = %s
+        """.format(", ".join(INFO_COLUMNS))
+    conn = connectDb(db_info, autocommit=False)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(log_qry, (night, telescope))
+            log = rowsToArray(LOG_COLUMNS, cur.fetchall())
+            cur.execute(info_qry, (window_start, window_end, telescope))
+            info = rowsToArray(INFO_COLUMNS, cur.fetchall())
+        if dry_run:
+            return len(log), len(info)
+        archive_path = getArchivePath(archive_dir, telescope, night)
+        if os.path.exists(archive_path):
+            old_log, old_info = loadArchive(archive_path)
+            log = concatenateArrays([old_log, log]) if len(log) else old_log
+            info = concatenateArrays([old_info, info]) if len(info) else old_info
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir)
+        # write to a temporary file and swap, never leave half an archive
+        tmp_path = "{}.tmp.npz".format(archive_path[:-4])
+        np.savez_compressed(tmp_path, log=log, info=info)
+        check_log, check_info = loadArchive(tmp_path)
+        if len(check_log) != len(log) or len(check_info) != len(info):
+            print('ERROR: archive check failed for {}, leaving live rows'.format(night))
+            os.remove(tmp_path)
+            return 0, 0
+        os.replace(tmp_path, archive_path)
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM autoguider_log_new WHERE night = %s AND {}".format(
+                TELESCOPE_LOG_ROWS), (night, telescope))
+            if len(info):
+                cur.execute("""
+                    DELETE FROM autoguider_info_log
+                    WHERE message_id BETWEEN %s AND %s
+                    AND updated >= %s
+                    AND updated < %s
+                    AND telescope = %s
+                    """, (int(info['message_id'].min()), int(info['message_id'].max()),
+                          window_start, window_end, telescope))
+        conn.commit()
+    except pymysql.MySQLError:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return len(log), len(info)
+
+def partitionLogTable(db_info):
+    """
+    Partition autoguider_log_new by month of night
+
+    On the first run the table is partitioned from its earliest
+    night up to next month, with a catch all p_future partition.
+    Subsequent runs split p_future to add any missing months.
+
+    Parameters
+    ----------
+    db_info : dict
+        Database connection info
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    # always have next month ready, p_future catches anything later
+    last = nextMonth(nextMonth(date.today()))
+    conn = connectDb(db_info)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT partition_name
+                FROM information_schema.partitions
+                WHERE table_schema = %s
+                AND table_name = 'autoguider_log_new'
+                AND partition_name IS NOT NULL
+                """, (db_info['database'], ))
+            existing = {row[0] for row in cur.fetchall()}
+            monthly = [datetime.strptime(p[1:], '%Y%m').date() for p in existing if p != 'p_future']
+            if monthly:
+                bound = nextMonth(nextMonth(max(monthly)))
+            else:
+                cur.execute("SELECT MIN(night) FROM autoguider_log_new")
+                earliest = cur.fetchone()[0] or date.today()
+                bound = nextMonth(earliest)
+            # each bound is the first day after the partition's month
+            months = []
+            while bound <= last:
+                months.append(bound)
+                bound = nextMonth(bound)
+            if not months:
+                return
+            # partition pYYYYMM holds nights before the first of the following month
+            parts = ", ".join(["PARTITION p{} VALUES LESS THAN (TO_DAYS('{}'))".format(
+                (m - timedelta(days=1)).strftime('%Y%m'), m.isoformat()) for m in months])
+            parts += ", PARTITION p_future VALUES LESS THAN MAXVALUE"
+            if existing:
+                qry = "ALTER TABLE autoguider_log_new REORGANIZE PARTITION p_future INTO ({})".format(parts)
+            else:
+                qry = "ALTER TABLE autoguider_log_new PARTITION BY RANGE (TO_DAYS(night)) ({})".format(parts)
+            print(qry)
+            cur.execute(qry)
+    finally:
+        conn.close()
+
+def loadArchive(archive_path):
+    """
+    Load a night archive file
+
+    Parameters
+    ----------
+    archive_path : string
+        Path to the night's archive file
+
+    Returns
+    -------
+    log : np.ndarray
+        Archived autoguider_log_new rows
+    info : np.ndarray
+        Archived autoguider_info_log rows
+
+    Raises
+    ------
+    None
+    """
+    with np.load(archive_path) as archive:
+        return addMissingColumns(archive['log'], TIMING_COLUMNS), archive['info']
+
+def _archivesInRange(archive_dir, telescope, night_start, night_end):
+    """
+    List a telescope's archive files for nights in a given range
+
+    Parameters
+    ----------
+    archive_dir : string
+        Folder holding the archive files
+    telescope : string
+        Name of the telescope
+    night_start : datetime.date | None
+        First night to include, None for no lower limit
+    night_end : datetime.date | None
+        Last night to include, None for no upper limit
+
+    Returns
+    -------
+    archive_paths : list
+        Paths to the matching archive files
+
+    Raises
+    ------
+    None
+    """
+    archive_paths = []
+    prefix = "{}{}_".format(ARCHIVE_PREFIX, telescope)
+    for archive_path in sorted(g.glob(os.path.join(archive_dir, "{}*.npz".format(prefix)))):
+        stem = os.path.split(archive_path)[1][len(prefix):-4]
+        try:
+            night = datetime.strptime(stem, '%Y%m%d').date()
+        except ValueError:
+            continue
+        if (night_start is None or night >= night_start) and \
+            (night_end is None or night <= night_end):
+            archive_paths.append(archive_path)
+    return archive_paths
+
+def getGuideLog(db_info, telescope, archive_dir, night_start=None, night_end=None):
+    """
+    Get autoguider_log_new rows for a range of nights, reading
+    the live table and any archives transparently
+
+    Live rows are streamed from the server in chunks, so a
+    long history is only held in memory as arrays
+
+    Parameters
+    ----------
+    db_info : dict
+        Database connection info
+    telescope : string
+        Name of the telescope
+    archive_dir : string | None
+        Folder holding the telescope's archive files,
+        None to read the live table only
+    night_start : datetime.date, optional
+        First night to include, default no lower limit
+    night_end : datetime.date, optional
+        Last night to include, default no upper limit
+
+    Returns
+    -------
+    log : np.ndarray
+        Structured array of LOG_COLUMNS, ordered by updated
+
+    Raises
+    ------
+    None
+    """
+    conditions, qry_args = [TELESCOPE_LOG_ROWS], [telescope]
+    if night_start is not None:
+        conditions.append("night >= %s")
+        qry_args.append(night_start)
+    if night_end is not None:
+        conditions.append("night <= %s")
+        qry_args.append(night_end)
+    qry = """
+        SELECT {}
+        FROM autoguider_log_new
+        WHERE {}
+        """.format(", ".join(LOG_COLUMNS), " AND ".join(conditions))
+    parts = []
+    conn = connectDb(db_info)
+    try:
+        with conn.cursor(pymysql.cursors.SSCursor) as cur:
+            cur.execute(qry, qry_args)
+            while True:
+                rows = cur.fetchmany(FETCH_CHUNK)
+                if not rows:
+                    break
+                parts.append(rowsToArray(LOG_COLUMNS, rows))
+    finally:
+        conn.close()
+    if archive_dir is not None:
+        for archive_path in _archivesInRange(archive_dir, telescope, night_start, night_end):
+            parts.append(loadArchive(archive_path)[0][list(LOG_COLUMNS)])
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return rowsToArray(LOG_COLUMNS, [])
+    log = concatenateArrays(parts)
+    return log[np.argsort(log['updated'], kind='stable')]
+
+def getInfoMessages(db_info, telescope, archive_dir, night_start, night_end):
+    """
+    Get autoguider_info_log rows for a range of nights, reading
+    the live table and any archives transparently
+
+    Parameters
+    ----------
+    db_info : dict
+        Database connection info
+    telescope : string
+        Name of the telescope
+    archive_dir : string
+        Folder holding the telescope's archive files
+    night_start : datetime.date
+        First night to include
+    night_end : datetime.date
+        Last night to include
+
+    Returns
+    -------
+    info : np.ndarray
+        Structured array of INFO_COLUMNS, ordered by message_id
+
+    Raises
+    ------
+    None
+    """
+    window_start = getNightWindow(night_start)[0]
+    window_end = getNightWindow(night_end)[1]
+    qry = """
+        SELECT {}
+        FROM autoguider_info_log
+        WHERE updated >= %s
+        AND updated < %s
+        AND telescope = %s
+        """.format(", ".join(INFO_COLUMNS))
+    conn = connectDb(db_info)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(qry, (window_start, window_end, telescope))
+            parts = [rowsToArray(INFO_COLUMNS, cur.fetchall())]
+    finally:
+        conn.close()
+    for archive_path in _archivesInRange(archive_dir, telescope, night_start, night_end):
+        info = loadArchive(archive_path)[1]
+        parts.append(info[info['telescope'] == telescope])
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return rowsToArray(INFO_COLUMNS, [])
+    info = concatenateArrays(parts)
+    return info[np.argsort(info['message_id'], kind='stable')]
+
+if __name__ == "__main__":
+    args = argParse()
+    # equivalent to 'from <instrument config> import *'
+    globals().update(get_config_values(args.telescope))
+    db_info = {'host': DB_HOST, 'user': DB_USER,
+               'database': DB_DATABASE, 'password': DB_PASS}
+    archive_dir = args.archive_dir or os.path.join(BASE_DIR, ARCHIVE_SUBDIR)
+    nights = getClosedNights(db_info, args.telescope, args.keep_nights)
+    print('Found {} closed nights to archive'.format(len(nights)))
+    for night in nights:
+        n_log, n_info = archiveNight(db_info, args.telescope, archive_dir, night,
+                                     dry_run=args.dry_run)
+        print('{}: archived {} shifts and {} messages'.format(night, n_log, n_info))
+    if args.partition and not args.dry_run:
+        partitionLogTable(db_info)
@@ -0,0 +1,271 @@
+"""
+Script to backfill the autoguider_log_new table from old guider.log files
+
+Older nights only exist as per-night guider.log text files under
+BASE_DIR\\YYYYMMDD. This script:
+
+   1. Finds the night directories in the requested range
+   2. Parses their guider.log files in parallel
+   3. Skips any rows already present in autoguider_log_new
+   4. Loads the remaining rows with executemany in large transactions
+
+The updated column is taken from the binary guide log timestamps if
+available, otherwise from the comparison image modification time, falling
+back to the modification time of the guider.log file itself. Stage
+timings (t_* columns) are imported from logs that have them.
+"""
+import os
+import sys
+import glob as g
+import argparse as ap
+from datetime import datetime
+from multiprocessing import Pool
+import numpy as np
+import pymysql
+from guide_log import (
+    STAGES,
+    getBinaryLogPath,
+    readGuideLog
+    )
+from utils import (
+    INSTRUMENT_CONFIGS,
+    get_config_values
+    )
+
+# pylint: disable=invalid-name
+
+# number of columns in a guider.log row, see acp_ag.logShiftsToFile
+N_LOG_COLUMNS = 14
+
+def argParse():
+    """
+    Parse the command line arguments
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    args : argparse object
+        Contains the command line arguments
+
+    Raises
+    ------
+    None
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('telescope',
+                   help='Name of telescope',
+                   choices=sorted(INSTRUMENT_CONFIGS))
+    p.add_argument('--start_night',
+                   help='First night to import (YYYYMMDD)',
+                   default='00000000')
+    p.add_argument('--end_night',
+                   help='Last night to import (YYYYMMDD)',
+                   default='99999999')
+    p.add_argument('--nproc',
+                   help='Number of parallel log parsers',
+                   type=int,
+                   default=os.cpu_count())
+    p.add_argument('--batch_size',
+                   help='Number of rows per insert transaction',
+                   type=int,
+                   default=5000)
+    p.add_argument('--dry_run',
+                   help='Parse the logs and report, but do not insert',
+                   action='store_true')
+    return p.parse_args()
+
+def findGuiderLogs(base_dir, data_subdir, logfile, start_night, end_night):
+    """
+    Find the guider.log files for the nights in a given range
+
+    Parameters
+    ----------
+    base_dir : string
+        ACP data base directory, containing YYYYMMDD folders
+    data_subdir : string
+        Subdirectory of each night folder holding the data
+    logfile : string
+        Name of the guider log file
+    start_night : string
+        First night to include, YYYYMMDD
+    end_night : string
+        Last night to include, YYYYMMDD
+
+    Returns
+    -------
+    logfiles : list
+        Paths to the guider logs, in night order
+
+    Raises
+    ------
+    None
+    """
+    logfiles = []
+    for night_dir in sorted(g.glob(os.path.join(base_dir, '[0-9]' * 8))):
+        night = os.path.split(night_dir)[1]
+        if night < start_night or night > end_night:
+            continue
+        log_loc = os.path.join(night_dir, data_subdir, logfile)
+        if os.path.exists(log_loc):
+            logfiles.append(log_loc)
+    return logfiles
+
+def parseGuiderLog(logfile):
+    """
+    Parse a guider.log file into rows ready for autoguider_log_new
+
+    Parameters
+    ----------
+    logfile : string
+        Path to the guider log to parse
+
+    Returns
+    -------
+    rows : list
+        List of tuples in the column order of insertRows
+
+    Raises
+    ------
+    None
+    """
+    log_dir = os.path.split(logfile)[0]
+    log_mtime = os.path.getmtime(logfile)
+    # prefer the full precision timestamps from the binary log
+    frame_times = {}
+    binary_logfile = getBinaryLogPath(logfile)
+    if os.path.exists(binary_logfile):
+        try:
+            records = readGuideLog(binary_logfile)
+            frame_times = dict(zip(np.char.decode(records['comparison']).tolist(),
+                                   records['timestamp'].tolist()))
+        except ValueError:
+            pass
+    rows = []
+    with open(logfile) as lf:
+        for line in lf:
+            # columns are joined with double spaces, single spaces
+            # can appear inside file names
+            cols = line.rstrip('\n').split('  ')
+            if cols[0] == 'night' or len(cols) < N_LOG_COLUMNS:
+                continue
+            # newer logs have the stage timings after the fixed columns
+            timing_cols = cols[N_LOG_COLUMNS:N_LOG_COLUMNS+len(STAGES)]
+            cols = cols[:N_LOG_COLUMNS]
+            try:
+                values = [float(c) for c in cols[4:12]]
+                timings = [float(c) for c in timing_cols]
+            except ValueError:
+                continue
+            timings = [None if t != t else t for t in timings]
+            timings += [None] * (len(STAGES) - len(timings))
+            comparison = cols[2]
+            try:
+                frame_time = frame_times[comparison]
+            except KeyError:
+                try:
+                    frame_time = os.path.getmtime(os.path.join(log_dir, comparison))
+                except OSError:
+                    frame_time = log_mtime
+            updated = datetime.fromtimestamp(frame_time).strftime('%Y-%m-%d %H:%M:%S')
+            rows.append(tuple([updated] + cols[:4] + values + cols[12:14] + timings))
+    return rows
+
+def getExistingRows(nights):
+    """
+    Get the (night, comparison) pairs already in autoguider_log_new
+
+    Parameters
+    ----------
+    nights : array like
+        Night strings (YYYY-MM-DD) being imported
+
+    Returns
+    -------
+    existing : set
+        Set of (night, comparison) tuples
+
+    Raises
+    ------
+    None
+    """
+    if not nights:
+        return set()
+    qry = """
+        SELECT night, comparison
+        FROM autoguider_log_new
+        WHERE night BETWEEN %s AND %s
+        """
+    qry_args = (min(nights), max(nights))
+    with pymysql.connect(host=DB_HOST, db=DB_DATABASE,
+                         user=DB_USER, password=DB_PASS) as cur:
+        cur.execute(qry, qry_args)
+        results = cur.fetchall()
+    return {(str(row[0]), row[1]) for row in results}
+
+def insertRows(rows, batch_size):
+    """
+    Insert rows into autoguider_log_new, one transaction per batch
+
+    Parameters
+    ----------
+    rows : list
+        Rows as returned by parseGuiderLog
+    batch_size : int
+        Number of rows to insert per transaction
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    qry = """
+        INSERT INTO autoguider_log_new
+        (updated, night, reference, comparison, stabilised, shift_x, shift_y,
+         pre_pid_x, pre_pid_y, post_pid_x, post_pid_y, std_buff_x,
+         std_buff_y, culled_max_shift_x, culled_max_shift_y,
+         t_detect, t_load, t_measure, t_pid, t_guide, t_db)
+        VALUES
+        (%s, %s, %s, %s, %s, %s, %s, %s,
+         %s, %s, %s, %s, %s, %s, %s,
+         %s, %s, %s, %s, %s, %s)
+        """
+    conn = pymysql.connect(host=DB_HOST, db=DB_DATABASE,
+                           user=DB_USER, password=DB_PASS,
+                           autocommit=False)
+    try:
+        cur = conn.cursor()
+        for i in range(0, len(rows), batch_size):
+            cur.executemany(qry, rows[i:i+batch_size])
+            conn.commit()
+            print('Inserted {}/{} rows'.format(min(i+batch_size, len(rows)), len(rows)))
+    except pymysql.MySQLError:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    args = argParse()
+    # equivalent to 'from <instrument config> import *'
+    globals().update(get_config_values(args.telescope))
+    logfiles = findGuiderLogs(BASE_DIR, DATA_SUBDIR, LOGFILE,
+                              args.start_night, args.end_night)
+    print('Found {} guider logs'.format(len(logfiles)))
+    if not logfiles:
+        sys.exit(0)
+    with Pool(max(1, args.nproc)) as pool:
+        parsed = pool.map(parseGuiderLog, logfiles)
+    rows = [row for night_rows in parsed for row in night_rows]
+    existing = getExistingRows(sorted({row[1] for row in rows}))
+    new_rows = [row for row in rows if (row[1], row[3]) not in existing]
+    print('Parsed {} rows, {} already in the database, {} to insert'.format(len(rows),
+                                                                         len(rows)-len(new_rows),
+                                                                         len(new_rows)))
+    if new_rows and not args.dry_run:
+        insertRows(new_rows, args.batch_size)
@@ -7,14 +7,25 @@ around the sky in a cross pattern, taking an image at each
 location. DONUTS is then used to measure the shift and
 determine the camera orientation and pulseGuide conversion
 factors
+
+The calibration can be rehearsed against the simulator with
+--backend sim --sim_dir FOLDER, see ag_simulator.py
 """
+import os
 import sys
 import time
 import argparse as ap
 from collections import defaultdict
 import numpy as np
-import win32com.client
 from donuts import Donuts
+from ag_hardware import (
+    BACKENDS,
+    getBackend
+    )
+from utils import (
+    INSTRUMENT_CONFIGS,
+    get_config_values
+    )
 
 # pylint: disable=invalid-name
 # pylint: disable=redefined-outer-name
@@ -26,21 +37,32 @@ def argParse():
     p = ap.ArgumentParser()
     p.add_argument('instrument',
                    help='name of the instrument to calibrate',
-                   choices=['nites', 'io',
-                            'callisto', 'europa',
-                            'ganymede', 'saintex',
-                            'artemis', 'rcos20'])
+                   choices=sorted(INSTRUMENT_CONFIGS))
     p.add_argument('--pulse_time',
                    help='time (ms) to pulse the mount during calibration',
+                   type=int,
                    default=5000)
-    return p.parse_args()
+    p.add_argument('--backend',
+                   help='telescope and camera backend',
+                   choices=BACKENDS,
+                   default='com')
+    p.add_argument('--sim_dir',
+                   help='folder to replace BASE_DIR with --backend sim')
+    p.add_argument('--sim_speedup',
+                   help='simulated seconds per real second',
+                   type=float,
+                   default=1.)
+    args = p.parse_args()
+    if args.backend == 'sim' and not args.sim_dir:
+        p.error('--sim_dir is required with --backend sim')
+    return args
 
-def connectTelescope():
+def connectTelescope(hardware):
     """
     A reusable way to connect to ACP telescope
     """
     print("Connecting to telescope...")
-    myScope = win32com.client.Dispatch("ACP.Telescope")
+    myScope = hardware.telescope()
     try:
         SCOPE_READY = myScope.connected
         print('Telescope connected')
@@ -49,7 +71,7 @@ def connectTelescope():
         SCOPE_READY = False
     return myScope, SCOPE_READY
 
-def connectCamera():
+def connectCamera(hardware):
     """
     A reusable way of checking camera connection
 
@@ -58,7 +80,7 @@ def connectCamera():
     connected or not. Annoying!
     """
     print("Connecting to camera...")
-    myCamera = win32com.client.Dispatch("MaxIm.CCDCamera")
+    myCamera = hardware.camera()
     try:
         myCamera.LinkEnabled = True
         myCamera.DisableAutoShutdown = True
@@ -123,63 +145,26 @@ def newFilename(data_dir, direction, pulse_time,
     """
     Generate new FITS image name
     """
-    fname = "{}\\step_{:03d}_d{}_{}ms{}".format(data_dir, image_id, direction,
-                                                pulse_time, IMAGE_EXTENSION)
+    fname = os.path.join(data_dir, "step_{:03d}_d{}_{}ms{}".format(image_id, direction,
+                                                                   pulse_time, IMAGE_EXTENSION))
     image_id += 1
     return fname, image_id
 
 if __name__ == "__main__":
     args = argParse()
-    if args.instrument == 'io':
-        from speculoos_io import (
-            BASE_DIR,
-            IMAGE_EXTENSION
-            )
-    elif args.instrument == 'callisto':
-        from speculoos_callisto import (
-            BASE_DIR,
-            IMAGE_EXTENSION
-            )
-    elif args.instrument == 'europa':
-        from speculoos_europa import (
-            BASE_DIR,
-            IMAGE_EXTENSION
-            )
-    elif args.instrument == 'ganymede':
-        from speculoos_ganymede import (
-            BASE_DIR,
-            IMAGE_EXTENSION
-            )
-    elif args.instrument == 'saintex':
-        from saintex import (
-            BASE_DIR,
-            IMAGE_EXTENSION
-            )
-    elif args.instrument == 'artemis':
-        from speculoos_artemis import (
-            BASE_DIR,
-            IMAGE_EXTENSION
-            )
-    elif args.instrument == 'nites':
-        from nites import (
-            BASE_DIR,
-            IMAGE_EXTENSION
-            )
-    elif args.instrument == 'rcos20':
-        from rcos20 import (
-            BASE_DIR,
-            IMAGE_EXTENSION
-            )
-    else:
-        sys.exit(1)
+    config = get_config_values(args.instrument)
+    BASE_DIR = args.sim_dir if args.backend == 'sim' else config['BASE_DIR']
+    IMAGE_EXTENSION = config['IMAGE_EXTENSION'].lstrip('*')
     # set up objects to hold calib info
     DIRECTION_STORE = defaultdict(list)
     SCALE_STORE = defaultdict(list)
-    data_dir = "{}\\donuts_calibration".format(BASE_DIR)
+    data_dir = os.path.join(BASE_DIR, "donuts_calibration")
+    os.makedirs(data_dir, exist_ok=True)
     image_id = 0
     # connect to hardware
-    myScope, SCOPE_READY = connectTelescope()
-    myCamera, CAMERA_READY = connectCamera()
+    hardware = getBackend(args.backend, config, speedup=args.sim_speedup)
+    myScope, SCOPE_READY = connectTelescope(hardware)
+    myCamera, CAMERA_READY = connectCamera(hardware)
     # start the calibration run
     print("Starting calibration run...")
     ref_image, image_id = newFilename(data_dir, 'R', 0, image_id, IMAGE_EXTENSION)
@@ -1,15 +1,65 @@
 """
 Code to start and stop the donuts second thread
+
+ACP runs this script before and after every target, so start, stop
+and ping go over the process handler's command socket (ag_command.py)
+and only import what they need. Pyro4 is imported only for the
+status, reload and shutdown actions. See tools/bench_client_startup.py
+
+'reload' pushes new tuning parameters to the running guider, either
+re-read from the instrument's config file or given with --set, e.g.
+
+    $> python donuts_process.py reload --instrument europa --set SIGMA_BUFFER=8
+
+'profile' profiles the running guider for a number of frames and
+writes the results to the night directory, e.g.
+
+    $> python donuts_process.py profile --frames 20 --mode sample
 """
 import sys
 import argparse as ap
-import Pyro4
-from utils import (
-    ag_status,
-    log_debug
-    )
+from ag_command import sendCommand
 
 # pylint: disable=invalid-name
+# pylint: disable=import-outside-toplevel
+
+def print_status(status, metrics):
+    """
+    Print the guiding state and metrics from the process handler
+    """
+    from datetime import datetime
+    print('Instrument: {}'.format(status['instrument']))
+    print('Autoguiding: {} [PID: {}] [Warm PIDs: {}]'.format(status['guiding'],
+                                                            status['pid'],
+                                                            status['warm_pids']))
+    if status['cores'] or status['priority']:
+        print('Cores: {} Priority: {}'.format(status['cores'], status['priority']))
+    if status['last_profile']:
+        print('Last profile: {}'.format(status['last_profile']))
+    if status['last_stall']:
+        stall = status['last_stall']
+        print('Last stall: [{}] {} stage after {:.1f}s{} Stacks: {}'.format(
+            datetime.utcfromtimestamp(stall['time']).isoformat(), stall['stage'],
+            stall['elapsed'], ' (frame aborted)' if stall['aborted'] else '',
+            stall['dump_file']))
+    if status['config_overrides']:
+        print('Config overrides: {}'.format(status['config_overrides']))
+    if status['last_stop_latency'] is not None:
+        print('Last stop took {:.3f}s'.format(status['last_stop_latency']))
+    print('\nRecent corrections:')
+    for row in status['recent_corrections']:
+        print('[{}]: {} Shift: X: {:.3f} Y: {:.3f} PostPID: X: {:.3f} Y: {:.3f}'.format(
+            datetime.utcfromtimestamp(row['time']), row['comparison'],
+            row['shift_x'], row['shift_y'], row['post_pid_x'], row['post_pid_y']))
+    print('\nLast {} frames ({} stabilised):'.format(metrics['n_frames'], metrics['n_stabilised']))
+    if metrics['rms_x'] is not None:
+        print('\tRMS: X: {:.3f} Y: {:.3f} pix'.format(metrics['rms_x'], metrics['rms_y']))
+    for stage, lat in sorted(metrics['latency'].items()):
+        print('\t{:<8s} p50={:.3f}s p90={:.3f}s max={:.3f}s'.format(stage, lat['p50'],
+                                                                   lat['p90'], lat['max']))
+    print('\nRecent messages:')
+    for row in reversed(status['messages']):
+        print('[{}]: {}'.format(datetime.utcfromtimestamp(row['time']), row['message']))
 
 def arg_parse():
     """
@@ -17,43 +67,82 @@ def arg_parse():
     """
     p = ap.ArgumentParser()
     p.add_argument('action',
-                   help='\'start\' | \'stop\' the donuts process (or \'shutdown\' donuts process handler)',
-                   choices=['start', 'stop', 'shutdown'])
+                   help='\'start\' | \'stop\' the donuts process (or \'shutdown\' donuts process handler, '
+                        'print its \'status\', \'reload\' the guiding config, '
+                        '\'profile\' the guider or \'ping\' it)',
+                   choices=['start', 'stop', 'shutdown', 'status', 'reload', 'profile', 'ping'])
+    p.add_argument('--instrument',
+                   help='instrument to act on, needed when the handler '
+                        'supervises more than one')
+    p.add_argument('--set',
+                   help='KEY=VALUE config override for reload, VALUE is JSON. '
+                        'Without --set, reload re-reads the config file',
+                   action='append',
+                   default=[],
+                   dest='updates')
+    p.add_argument('--frames',
+                   help='number of frames to profile',
+                   type=int,
+                   default=20)
+    p.add_argument('--mode',
+                   help='profiler to use',
+                   choices=['cprofile', 'sample'],
+                   default='cprofile')
     p.add_argument('--nodebug',
                    help='Enable debugging mode',
                    action='store_true')
     return p.parse_args()
 
-if __name__ == "__main__":
-    args = arg_parse()
-    # do some debug logging
-    if args.nodebug:
-        log_debug(args)
+def parse_updates(updates):
+    """
+    Turn KEY=VALUE strings into a config update dict, None if empty
+    """
+    import json
+    if not updates:
+        return None
+    parsed = {}
+    for update in updates:
+        key, _, value = update.partition('=')
+        parsed[key.strip()] = json.loads(value)
+    return parsed
+
+def call_handler(action, instrument, updates=None, frames=20, mode='cprofile'):
+    """
+    Run a status, reload, profile or shutdown action on the handler through Pyro
+    """
+    import Pyro4
+    from utils import ag_status
     try:
         ag = Pyro4.Proxy('PYRO:donuts@localhost:9234')
+        if action == 'shutdown':
+            return ag.shutdown()
+        if action == 'reload':
+            return ag.reload_config(instrument, updates)
+        if action == 'profile':
+            return ag.profile(instrument, frames, mode)
+        instruments = [instrument] if instrument else ag.list_instruments()
+        for inst in instruments:
+            print_status(ag.get_status(inst), ag.get_metrics(inst))
+            print()
+        return ag_status.success
     except (Pyro4.errors.CommunicationError, ConnectionRefusedError):
+        return ag_status.pyro_connection_error
+
+if __name__ == "__main__":
+    args = arg_parse()
+    if args.action in ('start', 'stop', 'ping'):
+        status = sendCommand(args.action, args.instrument)
+        # do some debug logging
         if args.nodebug:
-            log_debug("Pyro communications error, exiting with status = {}".format(ag_status.pyro_connection_error))
-        ag = None
-        sys.exit(ag_status.pyro_connection_error)
-    if args.action == 'start' and ag:
-        status = ag.start_ag()
-        if args.nodebug:
-            log_debug("AG start called, returning status = {}".format(status))
-        sys.exit(status)
-    elif args.action == 'stop' and ag:
-        status = ag.stop_ag()
-        if args.nodebug:
-            log_debug("AG stop called, returning status = {}".format(status))
-        sys.exit(status)
-    elif args.action == 'shutdown' and ag:
-        ag_stopped, ag_shutdown = ag.shutdown()
-        if args.nodebug:
-            log_debug("AG shutdown called: ")
-            log_debug("\t AG stop returned status = {}".format(ag_stopped))
-            log_debug("\t AG shutdown returned status = {}".format(ag_shutdown))
-    else:
-        status = ag_status.unknown
-        if args.nodebug:
-            log_debug("Unknown request, returning status = {}".format(status))
+            from utils import log_debug
+            log_debug(args)
+            log_debug("AG {} called, returning status = {}".format(args.action, status))
         sys.exit(status)
+    result = call_handler(args.action, args.instrument, parse_updates(args.updates),
+                          args.frames, args.mode)
+    if args.nodebug:
+        from utils import log_debug
+        log_debug(args)
+        log_debug("AG {} called, returning {}".format(args.action, result))
+    if args.action in ('status', 'reload', 'profile'):
+        sys.exit(result)
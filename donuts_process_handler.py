@@ -6,8 +6,48 @@ It will run all the time anspawn AG processes when requested.
 If this code is not running, the AG requests will not be met
 and the ACP plans will continue with no guiding.
 
+One handler can supervise several instruments, e.g. all four SPECULOOS
+South telescopes on one machine:
+
+    $> python donuts_process_handler.py io europa callisto ganymede --affinity
+
+Each instrument gets its own Autoguider Pyro object (donuts_INSTRUMENT)
+and the Supervisor object (donuts) forwards start/stop/status requests
+to them using an instrument argument, which may be omitted when only one
+instrument is supervised. With --affinity each guiding process is pinned
+to its own core (core 0 is left for ACP and MaxIm) and --priority raises
+its scheduling priority.
+
+To avoid paying the import cost of acp_ag.py on every start, a pool of
+instrument agnostic warm workers (acp_ag.py --warm) is kept idle in the
+background and shared by all instruments. start_ag hands the job to one
+of them, telling it which instrument to guide, and immediately starts
+warming a replacement.
+
+Each worker's stdout is drained by a StatusReader thread (see
+ag_channel.py). The latest frame and recent messages are kept in
+memory and shown by printStatus without querying the database.
+The exposed get_status and get_metrics methods serve the same state,
+plus latency and RMS aggregates over a ring of recent frames, to
+donuts_process.py status and any other Pyro client.
+
+reload_config pushes validated tuning parameters (see ag_config.py)
+to a running worker over its stdin. They are applied between frames
+and also replayed to any later worker for the same instrument.
+profile asks a running worker to profile its next N frames.
+
+Every status message also feeds the Prometheus style counters and
+histograms in ag_metrics.py, served as plain text on localhost:9236.
+
+Start and stop requests from ACP arrive on a plain local socket
+(see ag_command.py) served by CommandServer, so the short lived
+client started by ACP does not need to import Pyro4.
+
 
 Pyro4 URI = PYRO:donuts@localhost:9234
+Pyro4 URI = PYRO:donuts_INSTRUMENT@localhost:9234
+Command socket = localhost:9235
+Metrics page = http://localhost:9236/metrics
 """
 import os
 import sys
@@ -15,18 +55,105 @@ import time
 import signal
 import threading
 import argparse as ap
+import socketserver
 import subprocess as sp
+from collections import deque
+from datetime import datetime
 import psutil
 import Pyro4
-import pymysql
-from utils import ag_status
+from utils import (
+    ag_status,
+    load_config,
+    INSTRUMENT_CONFIGS
+    )
+from ag_channel import StatusReader
+from ag_config import (
+    validateConfig,
+    getReloadableConfig,
+    formatConfigCommand
+    )
+from ag_profiler import (
+    validateProfileRequest,
+    formatProfileCommand
+    )
+from ag_metrics import (
+    GuideMetrics,
+    MetricsServer
+    )
+from ag_command import (
+    COMMAND_HOST,
+    COMMAND_PORT,
+    parseCommand
+    )
 
 # pylint: disable=invalid-name
-# pylint: disable=wildcard-import
-# pylint: disable=unused-wildcard-import
+# pylint: disable=too-many-instance-attributes
 
 AG_ON_TIME = 10
 AG_OFF_TIME = 30
+N_RECENT_MESSAGES = 10
+N_RECENT_CORRECTIONS = 10
+N_METRIC_FRAMES = 200
+# seconds to wait on the guiding process after each stop escalation
+STOP_TIMEOUT = 5
+PYRO_HOST = 'localhost'
+PYRO_PORT = 9234
+
+# psutil priority class names on Windows, nice values elsewhere
+PRIORITIES = {'normal': ('NORMAL_PRIORITY_CLASS', 0),
+              'above_normal': ('ABOVE_NORMAL_PRIORITY_CLASS', -5),
+              'high': ('HIGH_PRIORITY_CLASS', -10)}
+
+def percentile(values, q):
+    """
+    Return the q'th percentile of a list of values
+
+    Parameters
+    ----------
+    values : array like
+        Values to summarise
+    q : float
+        Percentile, 0 to 100
+
+    Returns
+    -------
+    value : float | None
+        Linearly interpolated percentile, None if no values
+
+    Raises
+    ------
+    None
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q / 100.
+    lo = int(pos)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+def rms(values):
+    """
+    Return the standard deviation of a list of values
+
+    Parameters
+    ----------
+    values : array like
+        Values to summarise
+
+    Returns
+    -------
+    rms : float | None
+        Population standard deviation, None if no values
+
+    Raises
+    ------
+    None
+    """
+    if not values:
+        return None
+    mean = sum(values) / len(values)
+    return (sum((v - mean)**2 for v in values) / len(values))**0.5
 
 def argParse():
     """
@@ -47,25 +174,283 @@ def argParse():
     """
     p = ap.ArgumentParser()
     p.add_argument('instrument',
-                   help='select an instrument',
-                   choices=['io', 'callisto', 'europa',
-                            'ganymede', 'saintex',
-                            'artemis', 'nites', 'rcos20'])
+                   help='select one or more instruments',
+                   nargs='+',
+                   choices=sorted(INSTRUMENT_CONFIGS))
+    p.add_argument('--warm_workers',
+                   help='number of shared warm guiding processes to keep ready',
+                   type=int,
+                   default=1)
+    p.add_argument('--affinity',
+                   help='pin each instrument\'s guiding process to its own core',
+                   action='store_true')
+    p.add_argument('--priority',
+                   help='scheduling priority of the guiding processes',
+                   choices=sorted(PRIORITIES))
     return p.parse_args()
 
+def assignCores(instruments):
+    """
+    Give each instrument its own core, leaving core 0 for
+    ACP, MaxIm and this handler where possible
+
+    Parameters
+    ----------
+    instruments : array like
+        Names of the instruments being supervised
+
+    Returns
+    -------
+    cores : dict
+        Instrument name -> list of core indices
+
+    Raises
+    ------
+    None
+    """
+    n_cpu = psutil.cpu_count() or 1
+    available = list(range(1, n_cpu)) if n_cpu > 1 else [0]
+    return {instrument: [available[i % len(available)]]
+            for i, instrument in enumerate(instruments)}
+
+class WorkerPool(object):
+    """
+    Shared pool of acp_ag.py guiding processes
+
+    Warm workers are started without an instrument and are told
+    which instrument to guide when they are handed a job, so one
+    pool serves every instrument on the machine
+
+    Parameters
+    ----------
+    python_path : string
+        Path to the python executable
+    donuts_path : string
+        Path to the DONUTS_ACP folder
+    n_warm : int
+        Number of warm workers to keep ready
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, python_path, donuts_path, n_warm=1):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.python_path = python_path
+        self.donuts_path = donuts_path
+        self.n_warm = n_warm
+        self.lock = threading.Lock()
+        self.warm_procs = []
+        self.owners = {}
+
+    def spawn(self, instrument=None):
+        """
+        Launch a new acp_ag.py guiding process
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string
+            Instrument to guide. If None the process is launched
+            with --warm, i.e. it imports everything then waits
+            for a start command on stdin
+
+        Returns
+        -------
+        proc : subprocess.Popen
+            The new guiding process
+
+        Raises
+        ------
+        None
+        """
+        cmd = "{} {}\\acp_ag.py".format(self.python_path, self.donuts_path)
+        cmd += " --warm" if instrument is None else " {}".format(instrument)
+        proc = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE, shell=False,
+                        creationflags=sp.CREATE_NEW_PROCESS_GROUP)
+        # always drain stdout so the worker can never block on the pipe
+        StatusReader(proc.pid, proc.stdout, self.routeStatus)
+        return proc
+
+    def routeStatus(self, pid, status):
+        """
+        Pass a status message to the Autoguider owning the worker
+
+        Parameters
+        ----------
+        self : the class self object
+        pid : int
+            Process ID of the worker that sent the message
+        status : dict
+            The decoded status message
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        owner = self.owners.get(pid)
+        if owner is not None:
+            owner.handleStatus(pid, status)
+
+    def warm(self):
+        """
+        Top the pool up to n_warm live warm workers
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        with self.lock:
+            self.warm_procs = [proc for proc in self.warm_procs if proc.poll() is None]
+            while len(self.warm_procs) < self.n_warm:
+                self.warm_procs.append(self.spawn())
+
+    def getWarmPids(self):
+        """
+        Return the process IDs of the live warm workers
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        pids : list
+            Process IDs
+
+        Raises
+        ------
+        None
+        """
+        with self.lock:
+            return [proc.pid for proc in self.warm_procs if proc.poll() is None]
+
+    def start(self, owner):
+        """
+        Start guiding for an Autoguider, using a warm worker
+        if one is ready and cold starting otherwise
+
+        Parameters
+        ----------
+        self : the class self object
+        owner : Autoguider
+            The Autoguider the job is for
+
+        Returns
+        -------
+        proc : subprocess.Popen
+            The now guiding process
+
+        Raises
+        ------
+        None
+        """
+        proc = None
+        with self.lock:
+            while self.warm_procs and proc is None:
+                candidate = self.warm_procs.pop(0)
+                if candidate.poll() is not None:
+                    continue
+                self.owners[candidate.pid] = owner
+                try:
+                    candidate.stdin.write('start {}\n'.format(owner.instrument).encode())
+                    candidate.stdin.flush()
+                    proc = candidate
+                except OSError:
+                    del self.owners[candidate.pid]
+                    candidate.kill()
+        if proc is None:
+            print('No warm worker ready, cold starting guiding process for {}'.format(owner.instrument))
+            proc = self.spawn(owner.instrument)
+            self.owners[proc.pid] = owner
+        # get the next worker importing while this one guides
+        self.warm()
+        return proc
+
+    def release(self, proc):
+        """
+        Forget a finished guiding process
+
+        Parameters
+        ----------
+        self : the class self object
+        proc : subprocess.Popen
+            The finished guiding process
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self.owners.pop(proc.pid, None)
+
+    def retire(self):
+        """
+        Stop all warm workers. Closing their stdin makes them exit
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        with self.lock:
+            procs, self.warm_procs = self.warm_procs, []
+        for proc in procs:
+            if proc.poll() is None:
+                try:
+                    proc.stdin.close()
+                    proc.wait(timeout=5)
+                except (OSError, sp.TimeoutExpired):
+                    proc.kill()
+
 class Autoguider(object):
     """
-    Autoguider class
+    Autoguider class, one per instrument
 
     Parameters
     ----------
     instrument : string
         Name of the telescope we are guiding on
+    pool : WorkerPool
+        Shared pool of guiding processes
     pyro_uri : string
         URI on which to find the Pryo connection
-    daemon : Pyro4.daemon
-        Instance of the Pyro4 daemon. This is used
-        to shutdown the request loop cleanly
+    metrics : GuideMetrics
+        Shared metrics, fed with this instrument's status messages
+    cores : list, optional
+        CPU cores to pin the guiding process to
+    priority : string, optional
+        Scheduling priority of the guiding process, see PRIORITIES
 
     Returns
     -------
@@ -76,7 +461,7 @@ class Autoguider(object):
     ------
     None
     """
-    def __init__(self, instrument, db_info, donuts_info, pyro_uri, daemon):
+    def __init__(self, instrument, pool, pyro_uri, metrics, cores=None, priority=None):
         """
         Initialise the class
 
@@ -85,23 +470,87 @@ class Autoguider(object):
         self.guiding = False
         self.proc = None
         self.instrument = instrument
-        self.db_host = db_info['host']
-        self.db_user = db_info['user']
-        self.db_database = db_info['database']
-        self.db_password = db_info['password']
-        self.python_path = donuts_info['python_path']
-        self.donuts_path = donuts_info['donuts_path']
+        self.pool = pool
         self.pyro_uri = pyro_uri
-        self.daemon = daemon
-        self.print_thread = threading.Thread(target=self.printStatus)
-        self.print_thread.daemon = True
-        self.print_thread.start()
+        self.metrics = metrics
+        self.cores = cores
+        self.priority = priority
+        self.status_lock = threading.Lock()
+        self.last_frame = None
+        self.messages = deque(maxlen=N_RECENT_MESSAGES)
+        self.frames = deque(maxlen=N_METRIC_FRAMES)
+        self.last_stop_latency = None
+        self.config_overrides = {}
+        self.applied_config = None
+        self.last_profile = None
+        self.last_stall = None
+
+    def handleStatus(self, pid, status):
+        """
+        Store a status message streamed from a guiding process
+
+        Parameters
+        ----------
+        self : the class self object
+        pid : int
+            Process ID of the worker that sent the message
+        status : dict
+            The decoded status message
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        status['pid'] = pid
+        with self.status_lock:
+            if status['kind'] == 'frame':
+                self.last_frame = status
+                self.frames.append(status)
+            elif status['kind'] == 'message':
+                self.messages.append(status)
+            elif status['kind'] == 'config':
+                self.applied_config = status
+            elif status['kind'] == 'profile':
+                self.last_profile = status['path']
+            elif status['kind'] == 'stall':
+                self.last_stall = status
+        self.metrics.observe(self.instrument, status)
+
+    def applyPlacement(self, proc):
+        """
+        Pin the guiding process to its cores and set its priority
+
+        Parameters
+        ----------
+        self : the class self object
+        proc : subprocess.Popen
+            The guiding process
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        try:
+            ps_proc = psutil.Process(proc.pid)
+            if self.cores:
+                ps_proc.cpu_affinity(self.cores)
+            if self.priority:
+                win_class, nice = PRIORITIES[self.priority]
+                ps_proc.nice(getattr(psutil, win_class, nice))
+        except (psutil.Error, OSError) as err:
+            print('Could not set placement of {} guiding process: {}'.format(self.instrument, err))
 
     def printStatus(self):
         """
-        Display current status. This method is looped in the
-        Pyro4 request loop, displaying the current status of
-        the guiding system
+        Display the current status of this instrument
 
         Parameters
         ----------
@@ -115,22 +564,17 @@ class Autoguider(object):
         ------
         None
         """
-        while True:
-            # clear screen
-            os.system('cls')
-            # print header
-            print(self.pyro_uri)
-            if self.guiding and self.proc:
-                print('\n[PID: {}]: Autoguiding = {}'.format(self.proc.pid, self.guiding))
-                self.printLastAgCorrection()
-                time.sleep(AG_ON_TIME)
-            else:
-                print('\n[PID: ----]: Autoguiding = {}'.format(self.guiding))
-                time.sleep(AG_OFF_TIME)
+        print('\n{} ({})'.format(self.instrument, self.pyro_uri))
+        if self.guiding and self.proc:
+            print('[PID: {}]: Autoguiding = {}'.format(self.proc.pid, self.guiding))
+            self.printLastAgCorrection()
+        else:
+            print('[PID: ----]: Autoguiding = {}'.format(self.guiding))
 
     def printLastAgCorrection(self):
         """
-        Grab the last autoguider correction and recent info messages
+        Print the last autoguider correction and recent info messages
+        streamed from the guiding process
 
         Parameters
         ----------
@@ -145,21 +589,11 @@ class Autoguider(object):
         None
 
         """
-        qry = """
-            SELECT *
-            FROM autoguider_log_new
-            ORDER BY updated DESC
-            LIMIT 1
-            """
-        with pymysql.connect(host=self.db_host,
-                             db=self.db_database,
-                             user=self.db_user,
-                             password=self.db_password,
-                             cursorclass=pymysql.cursors.DictCursor) as cur:
-            cur.execute(qry)
-            result = cur.fetchone()
+        with self.status_lock:
+            result = self.last_frame
+            messages = list(self.messages)
         if result:
-            print('[{}]: {}:'.format(result['updated'],
+            print('[{}]: {}:'.format(datetime.utcfromtimestamp(result['time']),
                                      result['comparison']))
             print('\tShifts: X: {:.3f} Y: {:.3f}'.format(result['shift_x'],
                                                          result['shift_y']))
@@ -167,30 +601,22 @@ class Autoguider(object):
                                                          result['pre_pid_y']))
             print('\tPostPID: X: {:.3f} Y: {:.3f}'.format(result['post_pid_x'],
                                                           result['post_pid_y']))
+            print('\tBuffer sigma: X: {:.3f} Y: {:.3f}'.format(result['std_buff_x'],
+                                                               result['std_buff_y']))
+            print('\tTimings: {}'.format('  '.join(['{}={:.3f}s'.format(stage, duration)
+                                                     for stage, duration in result['timings'].items()])))
         else:
-            print('No shifts in database')
+            print('No shifts received yet')
 
         print('\nRecent messages:')
-        qry2 = """
-            SELECT * FROM autoguider_info_log
-            ORDER BY message_id DESC
-            LIMIT 10
-            """
-        with pymysql.connect(host=self.db_host,
-                             db=self.db_database,
-                             user=self.db_user,
-                             password=self.db_password,
-                             cursorclass=pymysql.cursors.DictCursor) as cur:
-            cur.execute(qry2)
-            results = cur.fetchall()
-        for row in results:
-            print("[{}]: {}".format(row['updated'],
+        for row in reversed(messages):
+            print("[{}]: {}".format(datetime.utcfromtimestamp(row['time']),
                                     row['message']))
 
     @Pyro4.expose
-    def start_ag(self):
+    def get_status(self):
         """
-        Exposed method to trigger donuts guiding
+        Exposed method to report the current guiding state
 
         Parameters
         ----------
@@ -198,35 +624,47 @@ class Autoguider(object):
 
         Returns
         -------
-        ag_status : int
-            Status of the autoguider after triggering
+        status : dict
+            instrument, guiding flag, worker PIDs (including the
+            shared warm workers), CPU placement, the last frame,
+            the most recent corrections, recent messages and
+            how long the last stop_ag took (seconds) and the
+            live config overrides and when they were last applied
+            and the summary file of the last profile
 
         Raises
         ------
         None
         """
-        if self.proc is None:
-            cmd = "{} {}\\acp_ag.py {}".format(self.python_path, self.donuts_path, self.instrument)
-            self.proc = sp.Popen(cmd, stdout=sp.PIPE, shell=False, creationflags=sp.CREATE_NEW_PROCESS_GROUP)
-            # poll = None means running
-            if self.proc.poll() is None:
-                self.guiding = True
-                print(self.proc.pid)
-                return ag_status.success
-            elif self.proc.poll() == 0:
-                self.guiding = False
-                return ag_status.failed
-            else:
-                self.guiding = False
-                return ag_status.unknown
-        else:
-            print('Already a guiding process running, cannot run 2, skipping!')
-            return ag_status.already_running
+        with self.status_lock:
+            frames = list(self.frames)[-N_RECENT_CORRECTIONS:]
+            messages = list(self.messages)
+            last_frame = self.last_frame
+        proc = self.proc
+        return {'instrument': self.instrument,
+                'guiding': self.guiding,
+                'pid': proc.pid if proc else None,
+                'warm_pids': self.pool.getWarmPids(),
+                'cores': self.cores,
+                'priority': self.priority,
+                'last_stop_latency': self.last_stop_latency,
+                'last_frame': last_frame,
+                'recent_corrections': [{'time': f['time'],
+                                        'comparison': f['comparison'],
+                                        'shift_x': f['shift_x'],
+                                        'shift_y': f['shift_y'],
+                                        'post_pid_x': f['post_pid_x'],
+                                        'post_pid_y': f['post_pid_y']} for f in frames],
+                'messages': [{'time': m['time'], 'message': m['message']} for m in messages],
+                'config_overrides': dict(self.config_overrides),
+                'config_applied': self.applied_config['time'] if self.applied_config else None,
+                'last_profile': self.last_profile,
+                'last_stall': self.last_stall}
 
     @Pyro4.expose
-    def stop_ag(self):
+    def get_metrics(self):
         """
-        Exposed method to stop donuts guiding
+        Exposed method to report aggregates over the recent frames
 
         Parameters
         ----------
@@ -234,91 +672,669 @@ class Autoguider(object):
 
         Returns
         -------
-        ag_status : int
-            Status of the autoguider stop request
+        metrics : dict
+            n_frames, shift RMS of the stabilised frames, mean
+            absolute corrections and p50/p90/max latency per stage
+            (seconds), including the total over all stages
 
         Raises
         ------
         None
         """
-        if self.proc:
-            if self.proc.poll() is None:
-                guiding_pid = int(self.proc.pid)
-                print('Killing AG script pid={}'.format(self.proc.pid))
-                os.kill(self.proc.pid, signal.CTRL_BREAK_EVENT)
-                time.sleep(5)
-                # get running python processes - check it is dead
-                pyproc = [int(p.pid) for p in psutil.process_iter() if 'python' in p.name()]
-                if guiding_pid not in pyproc:
-                    self.guiding = False
-                    self.proc = None
-                    return ag_status.success
-                else:
-                    print('Guiding process {} not dead!'.format(guiding_pid))
-                    self.guiding = True
-                    return ag_status.failed
-        else:
-            print('No process to kill')
-            return ag_status.success
+        with self.status_lock:
+            frames = list(self.frames)
+        stable = [f for f in frames if f['stabilised'] == 'y']
+        timings = {}
+        for f in frames:
+            for stage, duration in f['timings'].items():
+                timings.setdefault(stage, []).append(duration)
+            timings.setdefault('total', []).append(sum(f['timings'].values()))
+        latency = {stage: {'p50': percentile(values, 50),
+                           'p90': percentile(values, 90),
+                           'max': max(values)} for stage, values in timings.items()}
+        n = len(frames)
+        return {'instrument': self.instrument,
+                'n_frames': n,
+                'n_stabilised': len(stable),
+                'rms_x': rms([f['shift_x'] for f in stable]),
+                'rms_y': rms([f['shift_y'] for f in stable]),
+                'mean_abs_pid_x': sum(abs(f['post_pid_x']) for f in frames) / n if n else None,
+                'mean_abs_pid_y': sum(abs(f['post_pid_y']) for f in frames) / n if n else None,
+                'latency': latency}
 
-    @Pyro4.expose
-    #@Pyro4.oneway
-    def shutdown(self):
+    def sendCommand(self, line):
         """
-        Exposed method to shutdown the donuts process handler (this script)
+        Write a command line to the guiding process' stdin
 
         Parameters
         ----------
         self : the class self object
+        line : string
+            Encoded command, see ag_config.py and ag_profiler.py
 
         Returns
         -------
-        None
+        sent : boolean
+            Was the command written to a running process?
 
         Raises
         ------
         None
         """
-        print('Shutting down the donuts process handler...')
-        # check for a guiding process, just in case
-        ag_stopped = self.stop_ag()
-        ag_shutdown = self.daemon.shutdown()
-        return ag_stopped, ag_shutdown
+        proc = self.proc
+        if proc is None or proc.poll() is not None:
+            return False
+        try:
+            proc.stdin.write(line.encode())
+            proc.stdin.flush()
+        except OSError:
+            return False
+        return True
 
-if __name__ == "__main__":
+    @Pyro4.expose
+    def reload_config(self, updates=None):
+        """
+        Exposed method to change tuning parameters while guiding
+
+        Parameters
+        ----------
+        self : the class self object
+        updates : dict, optional
+            Parameter name -> new value. If None, the reloadable
+            parameters are re-read from the instrument's config file
+            and any earlier overrides are dropped
+
+        Returns
+        -------
+        ag_status : int
+            success if the update is valid (it is applied at the next
+            frame if guiding, else at the next start), failed if not
+
+        Raises
+        ------
+        None
+        """
+        try:
+            if updates is None:
+                update = validateConfig(getReloadableConfig(self.instrument))
+                self.config_overrides = {}
+            else:
+                update = validateConfig(dict(updates))
+                self.config_overrides.update(update)
+        except (ValueError, ImportError, SyntaxError) as err:
+            print('Rejected config update for {}: {}'.format(self.instrument, err))
+            return ag_status.failed
+        self.sendCommand(formatConfigCommand(update))
+        return ag_status.success
+
+    @Pyro4.expose
+    def profile(self, frames=20, mode='cprofile'):
+        """
+        Exposed method to profile the guiding process for a number
+        of frames. The results are written to the night directory
+
+        Parameters
+        ----------
+        self : the class self object
+        frames : int, optional
+            Number of frames to profile
+        mode : string, optional
+            cprofile or sample, see ag_profiler.py
+
+        Returns
+        -------
+        ag_status : int
+            success if the request was sent, failed if it is
+            invalid or the instrument is not guiding
+
+        Raises
+        ------
+        None
+        """
+        try:
+            request = validateProfileRequest({'frames': frames, 'mode': mode})
+        except ValueError as err:
+            print('Rejected profile request for {}: {}'.format(self.instrument, err))
+            return ag_status.failed
+        if not self.sendCommand(formatProfileCommand(**request)):
+            return ag_status.failed
+        return ag_status.success
+
+    @Pyro4.expose
+    def start_ag(self):
+        """
+        Exposed method to trigger donuts guiding
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        ag_status : int
+            Status of the autoguider after triggering
+
+        Raises
+        ------
+        None
+        """
+        if self.proc is None:
+            self.proc = self.pool.start(self)
+            self.applyPlacement(self.proc)
+            if self.config_overrides:
+                self.sendCommand(formatConfigCommand(self.config_overrides))
+            # poll = None means running
+            if self.proc.poll() is None:
+                self.guiding = True
+                print(self.proc.pid)
+                return ag_status.success
+            elif self.proc.poll() == 0:
+                self.guiding = False
+                return ag_status.failed
+            else:
+                self.guiding = False
+                return ag_status.unknown
+        else:
+            print('Already a guiding process running, cannot run 2, skipping!')
+            return ag_status.already_running
+
+    @Pyro4.expose
+    def stop_ag(self):
+        """
+        Exposed method to stop donuts guiding
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        ag_status : int
+            Status of the autoguider stop request
+
+        Raises
+        ------
+        None
+        """
+        if self.proc:
+            t0 = time.perf_counter()
+            exited = self.waitForExit(self.proc)
+            self.last_stop_latency = time.perf_counter() - t0
+            print('Guiding process {} stop took {:.3f}s'.format(self.proc.pid,
+                                                                self.last_stop_latency))
+            if exited:
+                self.pool.release(self.proc)
+                self.guiding = False
+                self.proc = None
+                return ag_status.success
+            else:
+                print('Guiding process {} not dead!'.format(self.proc.pid))
+                self.guiding = True
+                return ag_status.failed
+        else:
+            print('No process to kill')
+            return ag_status.success
+
+    @staticmethod
+    def waitForExit(proc):
+        """
+        Stop a guiding process, escalating until it has exited
+
+        CTRL_BREAK is sent first so the worker can flush its logs,
+        then terminate and finally kill. Each step waits on the
+        process handle for up to STOP_TIMEOUT seconds and returns
+        as soon as the process has gone
+
+        Parameters
+        ----------
+        proc : subprocess.Popen
+            The guiding process to stop
+
+        Returns
+        -------
+        exited : boolean
+            True if the process has exited
+
+        Raises
+        ------
+        None
+        """
+        steps = (('CTRL_BREAK', lambda: os.kill(proc.pid, signal.CTRL_BREAK_EVENT)),
+                 ('terminate', proc.terminate),
+                 ('kill', proc.kill))
+        for name, step in steps:
+            if proc.poll() is not None:
+                return True
+            print('Stopping AG script pid={} ({})'.format(proc.pid, name))
+            try:
+                step()
+            except OSError:
+                # already exited between the poll and the signal
+                pass
+            try:
+                proc.wait(timeout=STOP_TIMEOUT)
+                return True
+            except sp.TimeoutExpired:
+                continue
+        return proc.poll() is not None
+
+class Supervisor(object):
+    """
+    Front end for all instruments handled by this process
+
+    Parameters
+    ----------
+    autoguiders : dict
+        Instrument name -> Autoguider
+    pool : WorkerPool
+        Shared pool of guiding processes
+    pyro_uri : string
+        URI on which to find the Pryo connection
+    daemon : Pyro4.daemon
+        Instance of the Pyro4 daemon. This is used
+        to shutdown the request loop cleanly
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, autoguiders, pool, pyro_uri, daemon):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.autoguiders = autoguiders
+        self.pool = pool
+        self.pyro_uri = pyro_uri
+        self.daemon = daemon
+        self.print_thread = threading.Thread(target=self.printStatus)
+        self.print_thread.daemon = True
+        self.print_thread.start()
+        self.pool.warm()
+
+    def printStatus(self):
+        """
+        Display current status. This method is looped in the
+        Pyro4 request loop, displaying the current status of
+        the guiding system
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        while True:
+            # clear screen
+            os.system('cls')
+            # print header
+            print(self.pyro_uri)
+            print('Warm workers: {}'.format(self.pool.getWarmPids()))
+            for ag in self.autoguiders.values():
+                ag.printStatus()
+            if any(ag.guiding for ag in self.autoguiders.values()):
+                time.sleep(AG_ON_TIME)
+            else:
+                time.sleep(AG_OFF_TIME)
+
+    def select(self, instrument):
+        """
+        Pick the Autoguider for a request
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string | None
+            Name of the instrument. If only one instrument is
+            supervised it is used whatever name is given, so a
+            UserActions script shared by several telescopes
+            still works with a single instrument handler
+
+        Returns
+        -------
+        ag : Autoguider
+            The selected Autoguider
+
+        Raises
+        ------
+        ValueError
+            If the instrument is unknown or ambiguous
+        """
+        if len(self.autoguiders) == 1:
+            ag = next(iter(self.autoguiders.values()))
+            if instrument is not None and instrument != ag.instrument:
+                print('WARNING: request for {} sent to {}, the only supervised '
+                      'instrument'.format(instrument, ag.instrument))
+            return ag
+        try:
+            return self.autoguiders[instrument]
+        except KeyError:
+            raise ValueError('Unknown instrument {}, choose from {}'.format(instrument,
+                                                                           sorted(self.autoguiders)))
+
+    @Pyro4.expose
+    def list_instruments(self):
+        """
+        Exposed method to list the supervised instruments
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        instruments : list
+            Instrument names
+
+        Raises
+        ------
+        None
+        """
+        return sorted(self.autoguiders)
+
+    @Pyro4.expose
+    def start_ag(self, instrument=None):
+        """
+        Exposed method to trigger donuts guiding on an instrument
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string, optional
+            Instrument to guide, optional with one instrument
+
+        Returns
+        -------
+        ag_status : int
+            Status of the autoguider after triggering
+
+        Raises
+        ------
+        None
+        """
+        try:
+            ag = self.select(instrument)
+        except ValueError as err:
+            print(err)
+            return ag_status.unknown
+        return ag.start_ag()
+
+    @Pyro4.expose
+    def stop_ag(self, instrument=None):
+        """
+        Exposed method to stop donuts guiding on an instrument
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string, optional
+            Instrument to stop, optional with one instrument
+
+        Returns
+        -------
+        ag_status : int
+            Status of the autoguider stop request
+
+        Raises
+        ------
+        None
+        """
+        try:
+            ag = self.select(instrument)
+        except ValueError as err:
+            print(err)
+            return ag_status.unknown
+        return ag.stop_ag()
+
+    @Pyro4.expose
+    def reload_config(self, instrument=None, updates=None):
+        """
+        Exposed method to change an instrument's tuning parameters
+        while guiding, see Autoguider.reload_config
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string, optional
+            Instrument to update, optional with one instrument
+        updates : dict, optional
+            Parameter name -> new value, None to re-read the config file
+
+        Returns
+        -------
+        ag_status : int
+            Status of the reload request
+
+        Raises
+        ------
+        None
+        """
+        try:
+            ag = self.select(instrument)
+        except ValueError as err:
+            print(err)
+            return ag_status.unknown
+        return ag.reload_config(updates)
+
+    @Pyro4.expose
+    def profile(self, instrument=None, frames=20, mode='cprofile'):
+        """
+        Exposed method to profile an instrument's guiding process,
+        see Autoguider.profile
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string, optional
+            Instrument to profile, optional with one instrument
+        frames : int, optional
+            Number of frames to profile
+        mode : string, optional
+            cprofile or sample
+
+        Returns
+        -------
+        ag_status : int
+            Status of the profile request
+
+        Raises
+        ------
+        None
+        """
+        try:
+            ag = self.select(instrument)
+        except ValueError as err:
+            print(err)
+            return ag_status.unknown
+        return ag.profile(frames, mode)
+
+    @Pyro4.expose
+    def get_status(self, instrument=None):
+        """
+        Exposed method to report an instrument's guiding state,
+        see Autoguider.get_status
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string, optional
+            Instrument of interest, optional with one instrument
+
+        Returns
+        -------
+        status : dict
+            See Autoguider.get_status
+
+        Raises
+        ------
+        ValueError
+            If the instrument is unknown or ambiguous
+        """
+        return self.select(instrument).get_status()
+
+    @Pyro4.expose
+    def get_metrics(self, instrument=None):
+        """
+        Exposed method to report an instrument's guiding metrics,
+        see Autoguider.get_metrics
+
+        Parameters
+        ----------
+        self : the class self object
+        instrument : string, optional
+            Instrument of interest, optional with one instrument
+
+        Returns
+        -------
+        metrics : dict
+            See Autoguider.get_metrics
+
+        Raises
+        ------
+        ValueError
+            If the instrument is unknown or ambiguous
+        """
+        return self.select(instrument).get_metrics()
+
+    @Pyro4.expose
+    #@Pyro4.oneway
+    def shutdown(self):
+        """
+        Exposed method to shutdown the donuts process handler (this script)
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        ag_stopped : int
+            Worst stop status over all instruments
+        ag_shutdown : None
+            Return value of the daemon shutdown
+
+        Raises
+        ------
+        None
+        """
+        print('Shutting down the donuts process handler...')
+        # check for guiding processes, just in case
+        ag_stopped = max([ag.stop_ag() for ag in self.autoguiders.values()])
+        self.pool.retire()
+        ag_shutdown = self.daemon.shutdown()
+        return ag_stopped, ag_shutdown
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """
+    Answer one command line from a control client, see ag_command.py
+    """
+    def handle(self):
+        """
+        Run the requested action on the supervisor and reply
+        with its ag_status
+
+        Parameters
+        ----------
+        self : the class self object
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        line = self.rfile.readline().decode('utf-8', errors='replace')
+        action, instrument = parseCommand(line)
+        supervisor = self.server.supervisor
+        if action == 'start':
+            status = supervisor.start_ag(instrument)
+        elif action == 'stop':
+            status = supervisor.stop_ag(instrument)
+        elif action == 'ping':
+            status = ag_status.success
+        else:
+            status = ag_status.unknown
+        self.wfile.write('{}\n'.format(status).encode())
+
+class CommandServer(socketserver.ThreadingTCPServer):
+    """
+    Local socket server for start/stop requests from ACP
+
+    Parameters
+    ----------
+    supervisor : Supervisor
+        The object the commands are run on
+    host : string, optional
+        Address to listen on
+    port : int, optional
+        Port to listen on
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, supervisor, host=COMMAND_HOST, port=COMMAND_PORT):
+        """
+        Initialise the class and start serving in a background thread
+
+        See class docstring above
+        """
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), CommandHandler)
+        self.supervisor = supervisor
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+if __name__ == "__main__":
     args = argParse()
-    if args.instrument == 'nites':
-        from nites import *
-    elif args.instrument == 'io':
-        from speculoos_io import *
-    elif args.instrument == 'callisto':
-        from speculoos_callisto import *
-    elif args.instrument == 'europa':
-        from speculoos_europa import *
-    elif args.instrument == 'ganymede':
-        from speculoos_ganymede import *
-    elif args.instrument == 'saintex':
-        from saintex import *
-    elif args.instrument == 'artemis':
-        from speculoos_artemis import *
-    elif args.instrument == 'rcos20':
-        from rcos20 import *
-    else:
-        sys.exit(1)
-
-    # need to generate database connection info and the location
-    # of python and the autoguiding code - build from imports
-    db_info = {'host': DB_HOST, 'user': DB_USER,
-               'database':DB_DATABASE, 'password': DB_PASS}
-    donuts_info = {'python_path': PYTHONPATH,
-                   'donuts_path': DONUTSPATH}
+    instruments = list(dict.fromkeys(args.instrument))
+    configs = {instrument: load_config(instrument) for instrument in instruments}
+
+    # the location of python and the autoguiding code come from
+    # the first instrument's config, they are shared on one machine
+    first = configs[instruments[0]]
+    pool = WorkerPool(first.PYTHONPATH, first.DONUTSPATH, args.warm_workers)
+    cores = assignCores(instruments) if args.affinity else {}
+    metrics = GuideMetrics()
 
     sys.excepthook = Pyro4.util.excepthook
-    daemon = Pyro4.Daemon(host='localhost', port=9234)
-    ag = Autoguider(args.instrument, db_info, donuts_info,
-                    'PYRO:donuts@localhost:9234', daemon)
-    uri = daemon.register(ag, objectId='donuts')
+    daemon = Pyro4.Daemon(host=PYRO_HOST, port=PYRO_PORT)
+    autoguiders = {}
+    for instrument in instruments:
+        object_id = 'donuts_{}'.format(instrument)
+        ag_uri = 'PYRO:{}@{}:{}'.format(object_id, PYRO_HOST, PYRO_PORT)
+        autoguiders[instrument] = Autoguider(instrument, pool, ag_uri, metrics,
+                                             cores.get(instrument), args.priority)
+        daemon.register(autoguiders[instrument], objectId=object_id)
+    supervisor = Supervisor(autoguiders, pool,
+                            'PYRO:donuts@{}:{}'.format(PYRO_HOST, PYRO_PORT), daemon)
+    uri = daemon.register(supervisor, objectId='donuts')
+    command_server = CommandServer(supervisor)
+    metrics_server = MetricsServer(metrics)
     daemon.requestLoop()
+    for server in (command_server, metrics_server):
+        server.shutdown()
+        server.server_close()
     print('Exiting Donuts process handler')
     daemon.close()
     print('Daemon closed')
@@ -0,0 +1,382 @@
+"""
+Fixed record binary guide log
+
+Each guide frame is stored as one record of GUIDE_LOG_DTYPE. Records
+are buffered in memory and appended to disc in chunks, after a small
+fixed size header that identifies the file and record layout. The
+binary log is written next to the text guider.log and can be loaded
+with np.memmap without any string parsing.
+
+Header layout (BINARY_LOG_HEADER_SIZE bytes, little endian):
+    magic        8 bytes  b'DONUTSAG'
+    version      uint16
+    header_size  uint16
+    record_size  uint32
+    padding      zeros to header_size
+
+The per-frame stage durations are measured with StageTimer, which
+accumulates monotonic clock spans around each stage of the guide loop.
+"""
+import os
+import time
+import struct
+from contextlib import contextmanager
+import numpy as np
+
+# pylint: disable=invalid-name
+
+BINARY_LOG_MAGIC = b'DONUTSAG'
+BINARY_LOG_VERSION = 1
+BINARY_LOG_HEADER_SIZE = 64
+BINARY_LOG_EXTENSION = ".bin"
+BINARY_LOG_CHUNK = 10
+_HEADER_STRUCT = struct.Struct('<8sHHI')
+
+# stages of the guide loop timed per frame:
+#   detect  : image written to disc -> image noticed by the guider
+#   load    : opening the FITS file, to read its header and test load it
+#   measure : Donuts measure_shift
+#   pid     : PID update and clamping to the maximum shift, the
+#             sigma buffer rejection before it is not timed
+#   guide   : PulseGuide calls and waiting for them to finish
+#   db      : database writes for the frame, the info messages logged
+#             while it is processed plus its autoguider_log_new insert.
+#             The t_db column of that row is read just before the
+#             insert so only covers the info messages, guider.log and
+#             guider.bin include the insert
+STAGES = ('detect', 'load', 'measure', 'pid', 'guide', 'db')
+
+GUIDE_LOG_DTYPE = np.dtype([('timestamp', '<f8'),
+                            ('night', 'S10'),
+                            ('reference', 'S150'),
+                            ('comparison', 'S150'),
+                            ('stabilised', 'u1'),
+                            ('shift_x', '<f8'),
+                            ('shift_y', '<f8'),
+                            ('pre_pid_x', '<f8'),
+                            ('pre_pid_y', '<f8'),
+                            ('post_pid_x', '<f8'),
+                            ('post_pid_y', '<f8'),
+                            ('std_buff_x', '<f8'),
+                            ('std_buff_y', '<f8'),
+                            ('culled_max_shift_x', 'u1'),
+                            ('culled_max_shift_y', 'u1')] + \
+                           [('t_{}'.format(stage), '<f4') for stage in STAGES])
+
+class StageTimer(object):
+    """
+    Per-frame durations of the guide loop stages
+
+    Spans use the monotonic perf_counter clock. Repeated spans of
+    the same stage in one frame (e.g. X and Y pulses) are summed.
+    If a watchdog is given it is told when each span starts and ends,
+    see ag_watchdog.py
+
+    Parameters
+    ----------
+    watchdog : Watchdog, optional
+        Stall watchdog to notify
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, watchdog=None):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.durations = {}
+        self.watchdog = watchdog
+
+    @contextmanager
+    def span(self, stage):
+        """
+        Time the enclosed block as part of a stage
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage, see STAGES
+
+        Yields
+        ------
+        None
+
+        Raises
+        ------
+        FrameStalled
+            If the watchdog aborted the stage
+        """
+        watched = self.watchdog is not None and self.watchdog.enter(stage, owner=self)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            # leave the watchdog first, an abort delivered late
+            # must not skip it and leave the stage set
+            try:
+                if watched:
+                    self.watchdog.exit()
+            finally:
+                self.add(stage, time.perf_counter() - t0)
+
+    def add(self, stage, duration):
+        """
+        Add a duration measured elsewhere to a stage
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage, see STAGES
+        duration : float
+            Duration in seconds
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self.durations[stage] = self.durations.get(stage, 0.0) + duration
+
+    def getColumns(self):
+        """
+        Durations for every stage in STAGES order, None if not timed
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        durations : list
+            Duration in seconds of each stage
+
+        Raises
+        ------
+        None
+        """
+        return [self.durations.get(stage) for stage in STAGES]
+
+def getBinaryLogPath(logfile):
+    """
+    Return the binary log path that sits next to a text log
+
+    Parameters
+    ----------
+    logfile : string
+        Path to the text guide log, e.g. guider.log
+
+    Returns
+    -------
+    binary_logfile : string
+        Path to the binary guide log, e.g. guider.bin
+
+    Raises
+    ------
+    None
+    """
+    return "{}{}".format(os.path.splitext(logfile)[0], BINARY_LOG_EXTENSION)
+
+def _packHeader():
+    """
+    Build the binary log header
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    header : bytes
+        BINARY_LOG_HEADER_SIZE bytes of header
+
+    Raises
+    ------
+    None
+    """
+    header = _HEADER_STRUCT.pack(BINARY_LOG_MAGIC, BINARY_LOG_VERSION,
+                                 BINARY_LOG_HEADER_SIZE, GUIDE_LOG_DTYPE.itemsize)
+    return header.ljust(BINARY_LOG_HEADER_SIZE, b'\x00')
+
+def _checkHeader(binary_logfile):
+    """
+    Read and validate the header of a binary guide log
+
+    Parameters
+    ----------
+    binary_logfile : string
+        Path to the binary guide log
+
+    Returns
+    -------
+    header_size : int
+        Offset in bytes to the first record
+
+    Raises
+    ------
+    ValueError
+        If the file is not a binary guide log of a known version
+    """
+    with open(binary_logfile, 'rb') as blf:
+        raw = blf.read(_HEADER_STRUCT.size)
+    if len(raw) < _HEADER_STRUCT.size:
+        raise ValueError('{} has a truncated header'.format(binary_logfile))
+    magic, version, header_size, record_size = _HEADER_STRUCT.unpack(raw)
+    if magic != BINARY_LOG_MAGIC:
+        raise ValueError('{} is not a binary guide log'.format(binary_logfile))
+    if version != BINARY_LOG_VERSION or record_size != GUIDE_LOG_DTYPE.itemsize:
+        raise ValueError('{} has unsupported version {} (record size {})'.format(binary_logfile,
+                                                                                 version,
+                                                                                 record_size))
+    return header_size
+
+class BinaryGuideLog(object):
+    """
+    Chunked writer for the binary guide log
+
+    Parameters
+    ----------
+    binary_logfile : string
+        Path to the binary guide log
+    chunk_size : int
+        Number of records to buffer before writing to disc
+        Default = BINARY_LOG_CHUNK
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, binary_logfile, chunk_size=BINARY_LOG_CHUNK):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.binary_logfile = binary_logfile
+        self.chunk_size = chunk_size
+        self.buffer = []
+
+    def append(self, timestamp, log_list, timings):
+        """
+        Add a frame to the log, flushing to disc if the chunk is full
+
+        Parameters
+        ----------
+        timestamp : float
+            Unix time (UTC) the frame was detected
+        log_list : array like
+            List of items logged for this frame, see the
+            logShiftsToFile docstring in acp_ag.py for the order.
+            Numerical values are taken at full precision
+        timings : dict
+            Duration in seconds of each stage in STAGES. Missing
+            stages are stored as NaN
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        night, ref, check, stabilised = log_list[:4]
+        values = [float(v) for v in log_list[4:12]]
+        culled_x, culled_y = log_list[12:14]
+        record = (timestamp, night.encode(), ref.encode(), check.encode(),
+                  stabilised == 'y', *values, culled_x == 'y', culled_y == 'y',
+                  *[timings.get(stage, np.nan) for stage in STAGES])
+        self.buffer.append(record)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any buffered records to disc
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        if not self.buffer:
+            return
+        records = np.array(self.buffer, dtype=GUIDE_LOG_DTYPE)
+        with open(self.binary_logfile, 'ab') as blf:
+            if blf.tell() == 0:
+                blf.write(_packHeader())
+            records.tofile(blf)
+        self.buffer = []
+
+def readGuideLog(binary_logfile):
+    """
+    Memory map a binary guide log
+
+    A partially written trailing record is ignored
+
+    Parameters
+    ----------
+    binary_logfile : string
+        Path to the binary guide log
+
+    Returns
+    -------
+    records : np.memmap | np.ndarray
+        Read only array of GUIDE_LOG_DTYPE records
+
+    Raises
+    ------
+    ValueError
+        If the file is not a binary guide log of a known version
+    """
+    header_size = _checkHeader(binary_logfile)
+    n_records = (os.path.getsize(binary_logfile) - header_size) // GUIDE_LOG_DTYPE.itemsize
+    if n_records <= 0:
+        return np.empty(0, dtype=GUIDE_LOG_DTYPE)
+    return np.memmap(binary_logfile, dtype=GUIDE_LOG_DTYPE, mode='r',
+                     offset=header_size, shape=(n_records, ))
+
+def readGuideLogs(binary_logfiles):
+    """
+    Load and concatenate several binary guide logs, e.g. a season
+
+    Parameters
+    ----------
+    binary_logfiles : array like
+        Paths to the binary guide logs
+
+    Returns
+    -------
+    records : np.ndarray
+        Array of GUIDE_LOG_DTYPE records, sorted by timestamp
+
+    Raises
+    ------
+    ValueError
+        If any file is not a binary guide log of a known version
+    """
+    logs = [readGuideLog(binary_logfile) for binary_logfile in binary_logfiles]
+    if not logs:
+        return np.empty(0, dtype=GUIDE_LOG_DTYPE)
+    records = np.concatenate(logs)
+    return records[np.argsort(records['timestamp'], kind='stable')]
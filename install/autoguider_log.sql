@@ -27,5 +27,11 @@ CREATE TABLE autoguider_log_new (
    std_buff_x double not null,
    std_buff_y double not null,
    culled_max_shift_x varchar(5) not null,
-   culled_max_shift_y varchar(5) not null
+   culled_max_shift_y varchar(5) not null,
+   t_detect float,
+   t_load float,
+   t_measure float,
+   t_pid float,
+   t_guide float,
+   t_db float
 );
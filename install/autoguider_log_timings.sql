@@ -0,0 +1,14 @@
+-- Per-frame stage durations (seconds) for autoguider_log_new,
+-- see STAGES in guide_log.py. Run once on existing databases:
+--    mysql -u USER -p DATABASE < autoguider_log_timings.sql
+-- t_db is read just before the frame's own row is inserted, so
+-- here it only covers the info messages logged for the frame.
+-- guider.log and guider.bin also include the insert. Rows from
+-- before this migration have NULL timings
+ALTER TABLE autoguider_log_new
+   ADD COLUMN t_detect float,
+   ADD COLUMN t_load float,
+   ADD COLUMN t_measure float,
+   ADD COLUMN t_pid float,
+   ADD COLUMN t_guide float,
+   ADD COLUMN t_db float;
@@ -0,0 +1,17 @@
+-- Guide loop stalls caught by the watchdog, see ag_watchdog.py.
+-- Run once on existing databases:
+--    mysql -u USER -p DATABASE < autoguider_stall_log.sql
+-- elapsed is the time spent in the stage when the stall was
+-- detected, dump_file holds the stacks of all threads at the time
+CREATE TABLE autoguider_stall_log (
+   stall_id mediumint not null auto_increment primary key,
+   updated timestamp default current_timestamp on update current_timestamp,
+   telescope varchar(20) not null,
+   night date,
+   comparison varchar(150),
+   stage varchar(20) not null,
+   elapsed float not null,
+   deadline float not null,
+   aborted varchar(5) not null,
+   dump_file varchar(300)
+);
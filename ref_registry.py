@@ -0,0 +1,238 @@
+"""
+In-process registry of the currently valid autoguider reference images
+
+All valid rows (valid_until IS NULL) of autoguider_ref for a telescope
+are loaded in one query at startup and lookups are then served from
+memory. The admin scripts setnewrefimage.py and stopcurrentrefimage.py
+increment a change counter file in AUTOGUIDER_REF_DIR whenever they
+modify autoguider_ref. The registry checks the counter file before
+each lookup (a single stat call) and reloads itself if it has changed.
+"""
+import os
+from datetime import datetime
+
+# pylint: disable=invalid-name
+
+REF_VERSION_FILE = "ref_version.txt"
+
+def getRefVersionFile(ref_dir):
+    """
+    Return the path to the reference image change counter file
+
+    Parameters
+    ----------
+    ref_dir : string
+        Path to the autoguider reference image directory
+
+    Returns
+    -------
+    version_file : string
+        Path to the change counter file
+
+    Raises
+    ------
+    None
+    """
+    return os.path.join(ref_dir, REF_VERSION_FILE)
+
+def bumpRefVersion(ref_dir):
+    """
+    Increment the reference image change counter. This must be
+    called by anything that modifies the autoguider_ref table so
+    running guiders know to reload their reference registry
+
+    Parameters
+    ----------
+    ref_dir : string
+        Path to the autoguider reference image directory
+
+    Returns
+    -------
+    version : int
+        The new value of the change counter
+
+    Raises
+    ------
+    None
+    """
+    version_file = getRefVersionFile(ref_dir)
+    try:
+        with open(version_file) as vf:
+            version = int(vf.read().strip() or 0)
+    except (IOError, ValueError):
+        version = 0
+    version += 1
+    if not os.path.exists(ref_dir):
+        os.mkdir(ref_dir)
+    with open(version_file, 'w') as vf:
+        vf.write("{}\n".format(version))
+    return version
+
+class ReferenceRegistry(object):
+    """
+    Cache of the valid reference images for one telescope
+
+    Parameters
+    ----------
+    telescope : string
+        Name of the telescope whose references are cached
+    ref_dir : string
+        Path to the autoguider reference image directory
+    db_connect : callable
+        Function returning a context manager that yields a
+        database cursor, e.g. acp_ag.openDb with its arguments
+        already applied
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
+    """
+    def __init__(self, telescope, ref_dir, db_connect):
+        """
+        Initialise the class
+
+        See class docstring above
+        """
+        self.telescope = telescope
+        self.ref_dir = ref_dir
+        self.db_connect = db_connect
+        self.version_file = getRefVersionFile(ref_dir)
+        self.version_stamp = None
+        self.refs = {}
+
+    def _getVersionStamp(self):
+        """
+        Return a cheap fingerprint of the change counter file
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stamp : tuple | None
+            (mtime_ns, size) of the counter file, None if missing
+
+        Raises
+        ------
+        None
+        """
+        try:
+            st = os.stat(self.version_file)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def load(self):
+        """
+        Load all currently valid reference images for this
+        telescope in a single query
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        n_refs : int
+            Number of reference images loaded
+
+        Raises
+        ------
+        None
+        """
+        # take the stamp first so a change during the query triggers a reload
+        self.version_stamp = self._getVersionStamp()
+        tnow = datetime.utcnow().isoformat().split('.')[0].replace('T', ' ')
+        qry = """
+            SELECT field, filter, ref_image
+            FROM autoguider_ref
+            WHERE telescope = %s
+            AND valid_from < %s
+            AND valid_until IS NULL
+            ORDER BY ref_id
+            """
+        qry_args = (self.telescope, tnow)
+        with self.db_connect() as cur:
+            cur.execute(qry, qry_args)
+            results = cur.fetchall()
+        # newer rows win if a field/filter has several active references
+        self.refs = {(row[0], row[1]): row[2] for row in results}
+        return len(self.refs)
+
+    def isStale(self):
+        """
+        Check if the reference table has been changed since
+        the registry was last loaded
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stale : boolean
+            True if the registry needs reloading
+
+        Raises
+        ------
+        None
+        """
+        return self._getVersionStamp() != self.version_stamp
+
+    def lookup(self, field, filt):
+        """
+        Return the current reference image for a field/filter
+
+        Parameters
+        ----------
+        field : string
+            name of the current field
+        filt : string
+            name of the current filter
+
+        Returns
+        -------
+        ref_image : string
+            path to the reference image
+            returns None if no reference image found
+
+        Raises
+        ------
+        None
+        """
+        if self.isStale():
+            self.load()
+        try:
+            ref_image = self.refs[(field, filt)]
+        except KeyError:
+            return None
+        return os.path.join(self.ref_dir, ref_image)
+
+    def add(self, field, filt, ref_image):
+        """
+        Record a reference image that this process has just
+        added to the database
+
+        Parameters
+        ----------
+        field : string
+            name of the current field
+        filt : string
+            name of the current filter
+        ref_image : string
+            name of the new reference image
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        None
+        """
+        self.refs[(field, filt)] = os.path.split(ref_image)[1]
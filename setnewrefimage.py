@@ -17,6 +17,7 @@ from shutil import (
     )
 from datetime import datetime
 import pymysql
+from ref_registry import bumpRefVersion
 
 # pylint: disable=invalid-name
 # pylint: disable=wildcard-import
@@ -220,6 +221,8 @@ def checkForPreviousRefImage(field, telescope, filt):
                 o_filt = results[0][4]
                 disableRefImage(o_ref_id, o_field, o_telescope,
                                 o_ref_image, o_filt)
+                # tell any running guiders to reload their references
+                bumpRefVersion(AUTOGUIDER_REF_DIR)
                 o_ref_loc = "{}\\{}".format(AUTOGUIDER_REF_DIR, o_ref_image)
                 o_ref_loc_new = "{}\\old\\".format(AUTOGUIDER_REF_DIR)
                 print('Moving {} --> {}'.format(o_ref_loc, o_ref_loc_new))
@@ -270,6 +273,7 @@ def addNewRefImage(ref_image, field, telescope, filt):
         cur.execute(qry, qry_args)
     print('Copying {} --> {}'.format(ref_image, AUTOGUIDER_REF_DIR))
     copyImage(ref_image, AUTOGUIDER_REF_DIR)
+    bumpRefVersion(AUTOGUIDER_REF_DIR)
 
 
 if __name__ == "__main__":
@@ -294,4 +298,4 @@ if __name__ == "__main__":
         sys.exit(1)
     checkForPreviousRefImage(args.field, args.telescope, args.filt)
     addNewRefImage(args.ref_image, args.field, args.telescope, args.filt)
-    print('Remember to restart and currently active guiding jobs after applying new reference images!')
+    print('Running guiding jobs will pick up the new reference image at the next field change')
@@ -14,6 +14,7 @@ import argparse as ap
 from shutil import move
 from datetime import datetime
 import pymysql
+from ref_registry import bumpRefVersion
 
 # pylint: disable=invalid-name
 # pylint: disable=wildcard-import
@@ -191,6 +192,8 @@ def checkForPreviousRefImage(field, telescope, filt):
                 o_filt = results[0][4]
                 disableRefImage(o_ref_id, o_field, o_telescope,
                                 o_ref_image, o_filt)
+                # tell any running guiders to reload their references
+                bumpRefVersion(AUTOGUIDER_REF_DIR)
                 o_ref_loc = "{}\\{}".format(AUTOGUIDER_REF_DIR, o_ref_image)
                 o_ref_loc_new = "{}\\old\\".format(AUTOGUIDER_REF_DIR)
                 print('Moving {} --> {}'.format(o_ref_loc, o_ref_loc_new))
@@ -224,4 +227,4 @@ if __name__ == "__main__":
     else:
         sys.exit(1)
     checkForPreviousRefImage(args.field, args.telescope, args.filt)
-    print('Remember to restart Donuts guiding job after disabling reference images!')
+    print('Running guiding jobs will make a new reference image at the next field change')
@@ -0,0 +1,117 @@
+"""
+Benchmark the start up and round trip time of donuts_process.py
+
+ACP waits on a fresh donuts_process.py process for every start/stop,
+so its total run time is what delays the observing plan. This runs the
+client repeatedly with the 'ping' action and compares it against a bare
+interpreter start, failing if the median exceeds the time budget, e.g.
+
+    $> python bench_client_startup.py --repeats 20 --budget 0.1
+
+Without a process handler running use --stand_in, which answers the
+pings from a local stand-in command server.
+"""
+import os
+import sys
+import time
+import argparse as ap
+import socketserver
+import threading
+import statistics
+import subprocess as sp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ag_command import (
+    COMMAND_HOST,
+    COMMAND_PORT
+    )
+
+# pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'donuts_process.py')
+
+def argParse():
+    """
+    Parse command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('--repeats',
+                   help='number of client runs to time',
+                   type=int,
+                   default=20)
+    p.add_argument('--budget',
+                   help='maximum allowed median client run time (s)',
+                   type=float,
+                   default=0.1)
+    p.add_argument('--stand_in',
+                   help='answer the pings from a local stand-in server',
+                   action='store_true')
+    return p.parse_args()
+
+class PingHandler(socketserver.StreamRequestHandler):
+    """
+    Reply success (0) to every command
+    """
+    def handle(self):
+        self.rfile.readline()
+        self.wfile.write(b'0\n')
+
+def timeRuns(cmd, repeats):
+    """
+    Time repeated runs of a command
+
+    Parameters
+    ----------
+    cmd : list
+        Command to run
+    repeats : int
+        Number of runs
+
+    Returns
+    -------
+    times : list
+        Wall clock time of each run (s)
+    codes : set
+        Exit codes seen
+
+    Raises
+    ------
+    None
+    """
+    times, codes = [], set()
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        codes.add(sp.call(cmd, stdout=sp.DEVNULL))
+        times.append(time.perf_counter() - t0)
+    return times, codes
+
+def report(label, times):
+    """
+    Print a one line summary of run times
+    """
+    p90 = sorted(times)[int(0.9*(len(times) - 1))]
+    print('{:<12s} min={:.3f}s median={:.3f}s p90={:.3f}s'.format(label, min(times),
+                                                                 statistics.median(times),
+                                                                 p90))
+
+if __name__ == "__main__":
+    args = argParse()
+    if args.stand_in:
+        server = socketserver.ThreadingTCPServer((COMMAND_HOST, COMMAND_PORT), PingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    baseline, _ = timeRuns([sys.executable, '-c', 'pass'], args.repeats)
+    client, exit_codes = timeRuns([sys.executable, CLIENT, 'ping'], args.repeats)
+    report('interpreter', baseline)
+    report('client', client)
+    overhead = statistics.median(client) - statistics.median(baseline)
+    print('Client overhead: {:.3f}s, exit codes: {}'.format(overhead, sorted(exit_codes)))
+    if exit_codes != {0}:
+        # a refused connection fails fast, so the timing is meaningless
+        print('FAIL: the process handler did not answer every ping, '
+              'no round trip was measured (use --stand_in if no daemon is running)')
+        sys.exit(1)
+    if statistics.median(client) > args.budget:
+        print('FAIL: median client time exceeds budget of {:.3f}s'.format(args.budget))
+        sys.exit(1)
+    print('PASS: within budget of {:.3f}s'.format(args.budget))
@@ -0,0 +1,382 @@
+"""
+End-to-end guide loop latency benchmark
+
+Runs the real acp_ag.py guide loop against the simulated mount
+(--backend sim), a SQLite stand-in for MySQL (--sim_db) and synthetic
+frames (ag_synthetic.py). The frames are rendered up front and then
+moved into the night folder one at a time, so the simulator's camera
+does not share the guider's CPU. For each scenario it reports:
+    - frame arrival -> first guide pulse sent latency percentiles
+    - guider CPU time per frame
+    - guider peak RSS
+    - mean time per guide loop stage, from the status stream
+
+Scenarios vary the number of files already in the night folder, the
+image size, how often the field changes and the database latency. The
+results are written as JSON so releases can be compared, e.g.
+
+    $> python bench_guide_latency.py io --out bench_v2.json --compare bench_v1.json
+
+Peak RSS comes from os.wait4, so is only reported on Linux and macOS.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import platform
+import tempfile
+import argparse as ap
+import subprocess as sp
+from datetime import (
+    date,
+    datetime,
+    timedelta)
+import numpy as np
+import psutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ag_channel import StatusReader
+from ag_synthetic import (
+    SyntheticField,
+    frameHeader,
+    getGeometry,
+    makeShifts,
+    writeFrame
+    )
+from utils import (
+    INSTRUMENT_CONFIGS,
+    get_config_values
+    )
+
+# pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+
+DONUTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+GUIDER = os.path.join(DONUTS_DIR, 'acp_ag.py')
+STARTUP_TIMEOUT = 120
+PERCENTILES = (50, 90, 99)
+
+# name -> files already in the folder, image shape, frames per field, db delay (s)
+SCENARIOS = {'baseline': {'dir_size': 0, 'shape': (1024, 1024), 'field_block': 0, 'db_latency': 0.},
+             'dir_1000': {'dir_size': 1000, 'shape': (1024, 1024), 'field_block': 0, 'db_latency': 0.},
+             'dir_10000': {'dir_size': 10000, 'shape': (1024, 1024), 'field_block': 0, 'db_latency': 0.},
+             'image_512': {'dir_size': 0, 'shape': (512, 512), 'field_block': 0, 'db_latency': 0.},
+             'image_2048': {'dir_size': 0, 'shape': (2048, 2048), 'field_block': 0, 'db_latency': 0.},
+             'field_switch_5': {'dir_size': 0, 'shape': (1024, 1024), 'field_block': 5, 'db_latency': 0.},
+             'db_10ms': {'dir_size': 0, 'shape': (1024, 1024), 'field_block': 0, 'db_latency': 0.01},
+             'db_100ms': {'dir_size': 0, 'shape': (1024, 1024), 'field_block': 0, 'db_latency': 0.1}}
+
+def argParse():
+    """
+    Parse command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('instrument',
+                   help='instrument config to guide with',
+                   choices=sorted(INSTRUMENT_CONFIGS))
+    p.add_argument('--scenarios',
+                   help='scenarios to run (default all)',
+                   nargs='+',
+                   choices=sorted(SCENARIOS),
+                   default=sorted(SCENARIOS))
+    p.add_argument('--n_frames',
+                   help='frames per scenario',
+                   type=int,
+                   default=50)
+    p.add_argument('--cadence',
+                   help='minimum time between frames (s)',
+                   type=float,
+                   default=0.)
+    p.add_argument('--frame_timeout',
+                   help='time to wait for the guider to finish a frame (s)',
+                   type=float,
+                   default=30.)
+    p.add_argument('--work_dir',
+                   help='folder for the simulated nights (default a temporary folder)')
+    p.add_argument('--out',
+                   help='JSON file to write the results to',
+                   default='bench_guide_latency.json')
+    p.add_argument('--compare',
+                   help='earlier results to compare against')
+    p.add_argument('--verbose',
+                   help='echo the guider output',
+                   action='store_true')
+    return p.parse_args()
+
+def nightFolder(base_dir, data_subdir):
+    """
+    Tonight's data folder, by the same rule as acp_ag.getNightDir
+    """
+    d = date.today() - timedelta(days=0 if datetime.now().hour >= 12 else 1)
+    night_dir = os.path.join(base_dir, "{:d}{:02d}{:02d}".format(d.year, d.month, d.day))
+    return os.path.join(night_dir, data_subdir) if data_subdir else night_dir
+
+def stageFrames(config, stage_dir, n_frames, shape, field_block, filt='I+z'):
+    """
+    Render the scenario's frames into a staging folder
+
+    Parameters
+    ----------
+    config : dict
+        Instrument configuration values
+    stage_dir : string
+        Folder to render the frames into
+    n_frames : int
+        Number of frames
+    shape : tuple
+        Imaging area shape (ny, nx)
+    field_block : int
+        Frames per field before switching to the next, 0 for one field
+    filt : string, optional
+        Name of the filter
+
+    Returns
+    -------
+    names : list
+        Frame file names, in delivery order
+
+    Raises
+    ------
+    None
+    """
+    _, prescan, overscan = getGeometry(config)
+    extension = config['IMAGE_EXTENSION'].lstrip('*')
+    fields = {}
+    shifts = makeShifts(n_frames, seed=1)
+    rng = np.random.default_rng(2)
+    utc0 = datetime.utcnow()
+    names = []
+    for i, (dx, dy) in enumerate(shifts):
+        # alternate between two fields, so later blocks reuse the references
+        field = 'BENCH-{}'.format('AB'[(i // field_block) % 2] if field_block else 'A')
+        if field not in fields:
+            fields[field] = SyntheticField(shape, prescan, overscan, seed=len(fields))
+        name = '{}-{:05d}-{}{}'.format(field, i, filt, extension)
+        header = frameHeader(config, field, filt, 30., utc0 + timedelta(seconds=30*i),
+                             dx, dy, 1., False)
+        writeFrame(os.path.join(stage_dir, name),
+                   fields[field].render(dx, dy, rng=rng), header)
+        names.append(name)
+    return names
+
+def fillFolder(night_dir, stage_dir, first_name, n_files, extension):
+    """
+    Put n_files old frames of the first field in the night folder,
+    hard linked where possible to save space
+    """
+    if not n_files:
+        return
+    filler = os.path.join(stage_dir, 'filler{}'.format(extension))
+    shutil.copyfile(os.path.join(stage_dir, first_name), filler)
+    for i in range(n_files):
+        path = os.path.join(night_dir, 'FILL-{:05d}{}'.format(i, extension))
+        try:
+            os.link(filler, path)
+        except OSError:
+            shutil.copyfile(filler, path)
+
+def waitFor(statuses, condition, timeout):
+    """
+    Wait for a status message matching condition
+
+    Returns the message, None on timeout. Messages that do not
+    match are used up
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            status = statuses.get(timeout=max(deadline - time.monotonic(), 0.))
+        except queue.Empty:
+            return None
+        if condition(status):
+            return status
+
+def frameDone(status):
+    """
+    Has the guider finished with a frame? Either it was measured,
+    dropped or taken as a new reference image
+    """
+    return status['kind'] in ('frame', 'dropped') or \
+        (status['kind'] == 'message' and status['message'].startswith('Ref_File'))
+
+def peakRss(proc, ps_proc):
+    """
+    Stop the guider and return its peak RSS (MB), None if unknown
+    """
+    peak = getattr(ps_proc.memory_info(), 'peak_wset', None)
+    proc.terminate()
+    if peak is None and hasattr(os, 'wait4'):
+        _, _, usage = os.wait4(proc.pid, 0)
+        proc.returncode = -1
+        # ru_maxrss is in kB on Linux, bytes on macOS
+        peak = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    else:
+        proc.wait()
+    return peak / 1024.**2 if peak is not None else None
+
+def summarise(values):
+    """
+    Mean, percentiles and max of a list of values, None if empty
+    """
+    if not values:
+        return None
+    summary = {'mean': float(np.mean(values)), 'max': float(np.max(values))}
+    for q in PERCENTILES:
+        summary['p{}'.format(q)] = float(np.percentile(values, q))
+    return summary
+
+def runScenario(instrument, name, scenario, n_frames, cadence, frame_timeout,
+                work_dir, verbose=False):
+    """
+    Run the guider through one scenario and measure it
+
+    Parameters
+    ----------
+    instrument : string
+        Instrument config to guide with
+    name : string
+        Scenario name
+    scenario : dict
+        Scenario settings, see SCENARIOS
+    n_frames : int
+        Number of frames to deliver
+    cadence : float
+        Minimum time between frames (s)
+    frame_timeout : float
+        Time to wait for the guider to finish a frame (s)
+    work_dir : string
+        Folder for this run's files
+    verbose : boolean, optional
+        Echo the guider output?
+
+    Returns
+    -------
+    result : dict
+        The scenario settings and measurements
+
+    Raises
+    ------
+    RuntimeError
+        If the guider does not start up
+    """
+    config = get_config_values(instrument)
+    extension = config['IMAGE_EXTENSION'].lstrip('*')
+    base_dir = os.path.join(work_dir, name)
+    stage_dir = os.path.join(base_dir, 'staging')
+    night_dir = nightFolder(base_dir, config['DATA_SUBDIR'])
+    events = os.path.join(base_dir, 'events.jsonl')
+    for folder in (stage_dir, night_dir):
+        os.makedirs(folder, exist_ok=True)
+    print('[{}] rendering {} frames...'.format(name, n_frames))
+    names = stageFrames(config, stage_dir, n_frames, scenario['shape'], scenario['field_block'])
+    fillFolder(night_dir, stage_dir, names[0], scenario['dir_size'], extension)
+
+    cmd = [sys.executable, GUIDER, instrument, '--backend', 'sim', '--sim_dir', base_dir,
+           '--sim_frames', '0', '--sim_events', events,
+           '--sim_db', os.path.join(base_dir, 'ops.sqlite'),
+           '--sim_db_latency', str(scenario['db_latency'])]
+    proc = sp.Popen(cmd, cwd=DONUTS_DIR, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.STDOUT)
+    statuses = queue.Queue()
+    StatusReader(proc.pid, proc.stdout, lambda pid, status: statuses.put(status), echo=verbose)
+    ps_proc = psutil.Process(proc.pid)
+    # with old frames in the folder the newest becomes the reference first
+    if scenario['dir_size']:
+        ready = lambda s: s['kind'] == 'message' and s['message'].startswith('Ref_File')
+    else:
+        ready = lambda s: s['kind'] == 'message' and s['message'].startswith('Loaded')
+    if waitFor(statuses, ready, STARTUP_TIMEOUT) is None:
+        proc.kill()
+        raise RuntimeError('{}: guider did not start, try --verbose'.format(name))
+
+    print('[{}] guiding...'.format(name))
+    cpu0 = sum(ps_proc.cpu_times()[:2])
+    arrivals, stage_times = [], {}
+    for frame_name in names:
+        t0 = time.time()
+        os.replace(os.path.join(stage_dir, frame_name), os.path.join(night_dir, frame_name))
+        arrivals.append(t0)
+        status = waitFor(statuses, frameDone, frame_timeout)
+        if status is not None and status['kind'] == 'frame':
+            for stage, duration in status['timings'].items():
+                stage_times.setdefault(stage, []).append(duration)
+        time.sleep(max(cadence - (time.time() - t0), 0.))
+    cpu = sum(ps_proc.cpu_times()[:2]) - cpu0
+    peak_rss = peakRss(proc, ps_proc)
+
+    # first pulse after each frame arrives, before the next one
+    pulses = []
+    if os.path.exists(events):
+        with open(events) as ef:
+            pulses = sorted(json.loads(line)['time'] for line in ef if line.strip())
+    latencies = []
+    bounds = arrivals[1:] + [float('inf')]
+    for arrival, next_arrival in zip(arrivals, bounds):
+        sent = [t for t in pulses if arrival <= t < next_arrival]
+        if sent:
+            latencies.append(sent[0] - arrival)
+    return {'settings': {key: list(value) if isinstance(value, tuple) else value
+                         for key, value in scenario.items()},
+            'n_frames': len(arrivals),
+            'n_guided': len(latencies),
+            'latency_s': summarise(latencies),
+            'cpu_per_frame_s': cpu / max(len(arrivals), 1),
+            'peak_rss_mb': peak_rss,
+            'stage_mean_s': {stage: float(np.mean(times)) for stage, times in stage_times.items()}}
+
+def compare(results, old_path):
+    """
+    Print the change in latency and CPU against earlier results
+    """
+    with open(old_path) as of:
+        old = json.load(of)['scenarios']
+    print('\n{:<16s} {:>22s} {:>22s} {:>22s}'.format('scenario', 'p50 latency (s)',
+                                                     'p90 latency (s)', 'CPU/frame (s)'))
+    for name, result in sorted(results.items()):
+        if name not in old or not result['latency_s'] or not old[name]['latency_s']:
+            continue
+        cols = []
+        for new_value, old_value in ((result['latency_s']['p50'], old[name]['latency_s']['p50']),
+                                     (result['latency_s']['p90'], old[name]['latency_s']['p90']),
+                                     (result['cpu_per_frame_s'], old[name]['cpu_per_frame_s'])):
+            cols.append('{:.3f} -> {:.3f} ({:+.0f}%)'.format(old_value, new_value,
+                                                            100*(new_value/old_value - 1)
+                                                            if old_value else 0.))
+        print('{:<16s} {:>22s} {:>22s} {:>22s}'.format(name, *cols))
+
+if __name__ == "__main__":
+    args = argParse()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='donuts_bench_')
+    results = {}
+    for scenario_name in args.scenarios:
+        results[scenario_name] = runScenario(args.instrument, scenario_name,
+                                             SCENARIOS[scenario_name], args.n_frames,
+                                             args.cadence, args.frame_timeout,
+                                             work_dir, args.verbose)
+        latency = results[scenario_name]['latency_s']
+        print('[{}] guided {}/{} frames, latency p50={} p90={}, CPU/frame={:.3f}s'.format(
+            scenario_name, results[scenario_name]['n_guided'], results[scenario_name]['n_frames'],
+            '{:.3f}s'.format(latency['p50']) if latency else 'n/a',
+            '{:.3f}s'.format(latency['p90']) if latency else 'n/a',
+            results[scenario_name]['cpu_per_frame_s']))
+    report = {'created': datetime.utcnow().isoformat(),
+              'instrument': args.instrument,
+              'n_frames': args.n_frames,
+              'cadence': args.cadence,
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'cpu_count': psutil.cpu_count(),
+              'scenarios': results}
+    try:
+        report['commit'] = sp.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           cwd=DONUTS_DIR).decode().strip()
+    except (OSError, sp.CalledProcessError):
+        report['commit'] = None
+    with open(args.out, 'w') as of:
+        json.dump(report, of, indent=2)
+    print('Results written to {}'.format(args.out))
+    if args.compare:
+        compare(results, args.compare)
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,334 @@
+"""
+Shift measurement micro-benchmark
+
+Times reference preparation and per-frame shift measurement on
+synthetic frames (see ag_synthetic.py) over a grid of image size,
+region of interest, binning, pixel dtype, thread count and measurement
+engine, and checks each measured shift against the injected one, e.g.
+
+    $> python bench_measure_shift.py --sizes 1024 2048 --binning 1 2 --threads 1 4
+
+Engines:
+    donuts     : Donuts.measure_shift, as used by acp_ag.py
+    phase_corr : full frame FFT phase correlation in numpy, for comparison
+
+Both report the correction that brings the comparison image back onto
+the reference, i.e. minus the injected shift. Thread counts are applied
+through the usual BLAS/OpenMP environment variables, so each thread
+count runs in its own child process. Results are printed as a table
+and written as JSON.
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import itertools
+import shutil
+import argparse as ap
+import subprocess as sp
+
+# pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+
+THREAD_ENV = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+              'NUMEXPR_NUM_THREADS')
+MAX_SHIFT = 5.
+
+def argParse():
+    """
+    Parse command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('--sizes',
+                   help='detector sizes to render (pixels, square)',
+                   type=int,
+                   nargs='+',
+                   default=[1024, 2048])
+    p.add_argument('--rois',
+                   help='central regions of interest to measure (pixels, 0 = full frame)',
+                   type=int,
+                   nargs='+',
+                   default=[0, 512])
+    p.add_argument('--binning',
+                   help='binning factors',
+                   type=int,
+                   nargs='+',
+                   default=[1, 2])
+    p.add_argument('--dtypes',
+                   help='pixel types written to the FITS files',
+                   nargs='+',
+                   choices=['uint16', 'int32', 'float32', 'float64'],
+                   default=['uint16', 'float32'])
+    p.add_argument('--threads',
+                   help='BLAS/OpenMP thread counts',
+                   type=int,
+                   nargs='+',
+                   default=[1])
+    p.add_argument('--engines',
+                   help='shift measurement engines',
+                   nargs='+',
+                   choices=['donuts', 'phase_corr'],
+                   default=['donuts', 'phase_corr'])
+    p.add_argument('--n_frames',
+                   help='comparison frames per grid point',
+                   type=int,
+                   default=10)
+    p.add_argument('--seed',
+                   help='random number seed',
+                   type=int,
+                   default=42)
+    p.add_argument('--out',
+                   help='JSON file to write the results to',
+                   default='bench_measure_shift.json')
+    return p.parse_args()
+
+class DonutsEngine(object):
+    """
+    Donuts.measure_shift
+    """
+    def __init__(self):
+        from donuts import Donuts
+        self.donuts_class = Donuts
+        self.ref = None
+
+    def prepare(self, ref_path):
+        """
+        Build the reference projections
+        """
+        self.ref = self.donuts_class(ref_path)
+
+    def measure(self, path):
+        """
+        Correction (x, y) for one frame
+        """
+        shift = self.ref.measure_shift(path)
+        return shift.x.value, shift.y.value
+
+class PhaseCorrelationEngine(object):
+    """
+    FFT phase correlation of the full frame, with a parabolic
+    fit to the peak for the sub-pixel shift
+    """
+    def __init__(self):
+        self.ref_fft = None
+
+    @staticmethod
+    def _load(path):
+        """
+        Background subtracted frame as float64
+        """
+        data = fits.getdata(path).astype(np.float64)
+        return data - np.median(data)
+
+    def prepare(self, ref_path):
+        """
+        FFT the reference
+        """
+        self.ref_fft = np.conj(np.fft.rfft2(self._load(ref_path)))
+
+    def measure(self, path):
+        """
+        Correction (x, y) for one frame
+        """
+        data = self._load(path)
+        cross = np.fft.rfft2(data) * self.ref_fft
+        corr = np.fft.irfft2(cross / np.maximum(np.abs(cross), 1e-12), s=data.shape)
+        iy, ix = np.unravel_index(np.argmax(corr), corr.shape)
+        shift = []
+        for axis, i in ((1, ix), (0, iy)):
+            n = corr.shape[axis]
+            idx = [iy, ix]
+            values = []
+            for step in (-1, 0, 1):
+                idx[1 - axis] = (i + step) % n
+                values.append(corr[idx[0], idx[1]])
+            denom = values[0] - 2*values[1] + values[2]
+            peak = i + (0.5*(values[0] - values[2])/denom if denom else 0.)
+            # wrap to a signed displacement
+            shift.append(peak - n if peak > n/2 else peak)
+        # the correction is minus the displacement
+        return -shift[0], -shift[1]
+
+ENGINES = {'donuts': DonutsEngine,
+           'phase_corr': PhaseCorrelationEngine}
+
+def prepareFrames(frame_dir, raw_ref, raw_checks, roi, binning, dtype):
+    """
+    Bin, crop and cast rendered frames and write them as FITS
+
+    Parameters
+    ----------
+    frame_dir : string
+        Folder to write to
+    raw_ref : array
+        Rendered reference frame
+    raw_checks : list
+        Rendered comparison frames
+    roi : int
+        Side of the central region to keep (binned pixels), 0 for all
+    binning : int
+        Binning factor
+    dtype : string
+        Pixel type to write
+
+    Returns
+    -------
+    ref_path : string
+        Path to the reference frame
+    check_paths : list
+        Paths to the comparison frames
+
+    Raises
+    ------
+    None
+    """
+    def process(frame):
+        """
+        Bin then crop one frame
+        """
+        ny, nx = frame.shape
+        binned = frame[:ny - ny % binning, :nx - nx % binning].astype(np.float64)
+        binned = binned.reshape(ny // binning, binning, nx // binning, binning).sum(axis=(1, 3))
+        if roi:
+            cy, cx = binned.shape[0] // 2, binned.shape[1] // 2
+            binned = binned[max(cy - roi//2, 0):cy + roi//2, max(cx - roi//2, 0):cx + roi//2]
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            binned = np.clip(binned, 0, np.iinfo(dtype).max)
+        return binned.astype(dtype)
+
+    os.makedirs(frame_dir, exist_ok=True)
+    ref_path = os.path.join(frame_dir, 'ref.fits')
+    fits.writeto(ref_path, process(raw_ref), fits.Header({'EXPTIME': 30.}), overwrite=True)
+    check_paths = []
+    for i, frame in enumerate(raw_checks):
+        path = os.path.join(frame_dir, 'check_{:04d}.fits'.format(i))
+        fits.writeto(path, process(frame), fits.Header({'EXPTIME': 30.}), overwrite=True)
+        check_paths.append(path)
+    return ref_path, check_paths
+
+def timeEngine(engine_name, ref_path, check_paths, expected):
+    """
+    Time an engine over one set of frames and measure its errors
+
+    Parameters
+    ----------
+    engine_name : string
+        Key in ENGINES
+    ref_path : string
+        Reference frame
+    check_paths : list
+        Comparison frames
+    expected : array
+        Expected correction (x, y) per comparison frame
+
+    Returns
+    -------
+    result : dict
+        Timings, throughput and shift errors
+
+    Raises
+    ------
+    None
+    """
+    engine = ENGINES[engine_name]()
+    t0 = time.perf_counter()
+    engine.prepare(ref_path)
+    t_prepare = time.perf_counter() - t0
+    measured, times = [], []
+    for path in check_paths:
+        t0 = time.perf_counter()
+        measured.append(engine.measure(path))
+        times.append(time.perf_counter() - t0)
+    error = np.hypot(*(np.asarray(measured) - expected).T)
+    return {'prepare_s': t_prepare,
+            'measure_mean_s': float(np.mean(times)),
+            'frames_per_s': len(times) / sum(times),
+            'error_rms_pix': float(np.sqrt(np.mean(error**2))),
+            'error_max_pix': float(np.max(error))}
+
+def runGrid(args):
+    """
+    Run every grid point for the current thread count
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments, with a single thread count
+
+    Returns
+    -------
+    results : list
+        One dict per grid point
+
+    Raises
+    ------
+    None
+    """
+    rng = np.random.default_rng(args.seed)
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='donuts_shift_bench_')
+    try:
+        for size in args.sizes:
+            synth = SyntheticField((size, size), seed=args.seed)
+            truth = rng.uniform(-MAX_SHIFT, MAX_SHIFT, (args.n_frames, 2))
+            raw_ref = synth.render(0., 0., rng=rng)
+            raw_checks = [synth.render(dx, dy, rng=rng) for dx, dy in truth]
+            for roi, binning, dtype in itertools.product(args.rois, args.binning, args.dtypes):
+                if roi and roi > size // binning:
+                    continue
+                frame_dir = os.path.join(work_dir, '{}_{}_{}_{}'.format(size, roi, binning, dtype))
+                ref_path, check_paths = prepareFrames(frame_dir, raw_ref, raw_checks,
+                                                      roi, binning, dtype)
+                # corrections are minus the injected shift, in binned pixels
+                expected = -truth / binning
+                for engine_name in args.engines:
+                    result = {'size': size, 'roi': roi, 'binning': binning, 'dtype': dtype,
+                              'threads': args.threads[0], 'engine': engine_name}
+                    result.update(timeEngine(engine_name, ref_path, check_paths, expected))
+                    results.append(result)
+                    print('{size:>6d} {roi:>5d} {binning:>4d} {dtype:>8s} {threads:>4d} '
+                          '{engine:>11s} {prepare_s:>9.4f} {frames_per_s:>9.2f} '
+                          '{error_rms_pix:>8.3f}'.format(**result), file=sys.stderr)
+                shutil.rmtree(frame_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+if __name__ == "__main__":
+    args = argParse()
+    if len(args.threads) > 1:
+        # thread pools are sized when numpy is imported, so each
+        # thread count gets a fresh process that writes its own results
+        results = []
+        for n_threads in args.threads:
+            env = dict(os.environ, **{name: str(n_threads) for name in THREAD_ENV})
+            # one thread count and a private output file per child
+            child_out = '{}.threads{}'.format(args.out, n_threads)
+            cmd = [sys.executable, os.path.abspath(__file__),
+                   '--sizes'] + [str(s) for s in args.sizes] + \
+                  ['--rois'] + [str(r) for r in args.rois] + \
+                  ['--binning'] + [str(b) for b in args.binning] + \
+                  ['--dtypes'] + args.dtypes + ['--engines'] + args.engines + \
+                  ['--threads', str(n_threads), '--n_frames', str(args.n_frames),
+                   '--seed', str(args.seed), '--out', child_out]
+            sp.check_call(cmd, env=env)
+            with open(child_out) as cf:
+                results.extend(json.load(cf)['results'])
+            os.remove(child_out)
+    else:
+        # set before numpy is imported, overriding the shell so the
+        # results are labelled with the thread count actually used
+        for name in THREAD_ENV:
+            os.environ[name] = str(args.threads[0])
+        import numpy as np
+        from astropy.io import fits
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        from ag_synthetic import SyntheticField
+        print('{:>6s} {:>5s} {:>4s} {:>8s} {:>4s} {:>11s} {:>9s} {:>9s} {:>8s}'.format(
+            'size', 'roi', 'bin', 'dtype', 'thr', 'engine', 'prep (s)', 'frames/s', 'err rms'),
+              file=sys.stderr)
+        results = runGrid(args)
+    with open(args.out, 'w') as of:
+        json.dump({'results': results}, of, indent=2)
+    print('Results written to {}'.format(args.out))
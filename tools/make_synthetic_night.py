@@ -0,0 +1,82 @@
+"""
+Write a night of synthetic frames for an instrument
+
+The frames match the instrument's config (IMAGE_EXTENSION, header
+keywords and detector geometry) and carry a known shift, with the
+truth table written alongside as truth.csv, e.g.
+
+    $> python make_synthetic_night.py io /tmp/synth/20240101 --n_frames 1000
+
+See ag_synthetic.py for what goes into each frame.
+"""
+import os
+import sys
+import time
+import argparse as ap
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ag_synthetic import (
+    SYNTH_CLOUD_PROBABILITY,
+    SYNTH_TRAIL_PROBABILITY,
+    makeNight
+    )
+from utils import (
+    INSTRUMENT_CONFIGS,
+    get_config_values
+    )
+
+# pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+
+def argParse():
+    """
+    Parse command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('instrument',
+                   help='instrument whose config the frames match',
+                   choices=sorted(INSTRUMENT_CONFIGS))
+    p.add_argument('out_dir',
+                   help='folder to write the frames to')
+    p.add_argument('--n_frames',
+                   help='number of frames',
+                   type=int,
+                   default=100)
+    p.add_argument('--field',
+                   help='name of the field',
+                   default='SYNTH-FIELD')
+    p.add_argument('--filter',
+                   help='name of the filter',
+                   default='I+z')
+    p.add_argument('--exptime',
+                   help='exposure time (s)',
+                   type=float,
+                   default=30.)
+    p.add_argument('--shape',
+                   help='override the detector shape (ny nx)',
+                   type=int,
+                   nargs=2)
+    p.add_argument('--clouds',
+                   help='chance of each frame being clouded',
+                   type=float,
+                   default=SYNTH_CLOUD_PROBABILITY)
+    p.add_argument('--trails',
+                   help='chance of each frame having a satellite trail',
+                   type=float,
+                   default=SYNTH_TRAIL_PROBABILITY)
+    p.add_argument('--seed',
+                   help='random number seed',
+                   type=int)
+    return p.parse_args()
+
+if __name__ == "__main__":
+    args = argParse()
+    t0 = time.perf_counter()
+    truth = makeNight(get_config_values(args.instrument), args.out_dir, args.n_frames,
+                      field=args.field, filt=args.filter, exptime=args.exptime,
+                      cloud_probability=args.clouds, trail_probability=args.trails,
+                      shape=tuple(args.shape) if args.shape else None, seed=args.seed)
+    elapsed = time.perf_counter() - t0
+    print('Wrote {} frames to {} in {:.1f}s ({:.1f} ms/frame)'.format(len(truth), args.out_dir,
+                                                                     elapsed,
+                                                                     1000*elapsed/max(len(truth), 1)))
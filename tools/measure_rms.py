@@ -3,10 +3,49 @@ Take a measure of the RMS from the AG log file
 
 This may be intrinsically different from the real RMS
 measured by tracking a star post-facto
+
+Binary guide logs (guider.bin) are preferred when present,
+several can be given at once to measure a whole season, e.g.
+
+    $> python measure_rms.py 2019*/guider.bin
 """
+import os
+import sys
+import argparse as ap
 import numpy as np
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from guide_log import readGuideLogs
+
+# pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+
+def argParse():
+    """
+    Parse command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('logs',
+                   help='binary guide logs to load (default = guider.bin or guider.log)',
+                   nargs='*')
+    p.add_argument('--stabilised',
+                   help='only include frames after field stabilisation',
+                   action='store_true')
+    return p.parse_args()
+
 if __name__ == "__main__":
-    x, y = np.loadtxt('guider.log', usecols=[3, 4], unpack=True)
+    args = argParse()
+    if args.logs:
+        records = readGuideLogs(args.logs)
+    elif os.path.exists('guider.bin'):
+        records = readGuideLogs(['guider.bin'])
+    else:
+        records = None
+    if records is not None:
+        if args.stabilised:
+            records = records[records['stabilised'] == 1]
+        x, y = records['shift_x'], records['shift_y']
+        print("Frames: {}".format(len(records)))
+    else:
+        x, y = np.loadtxt('guider.log', usecols=[3, 4], unpack=True)
     print("RMS: X={:.3f} pix - Y={:.3f} pix".format(np.std(x), np.std(y)))
-
@@ -1,101 +1,326 @@
 """
-Script to measure the RMS of a given field using the database
+Script to measure the RMS of the guiding per field/filter using the database
+
+The shifts are read per telescope with archive_autoguider_logs.getGuideLog,
+which streams autoguider_log_new into NumPy arrays and adds any nights
+archived out of it (--archive_dir). They are labelled from autoguider_ref
+and grouped per field/filter with vectorised operations. Raw and sigma
+clipped RMS values are computed for every group at once.
+
+Figures are rendered headless in a process pool and closed as soon as
+they are saved. A single multi-page PDF summary can be written instead
+of, or as well as, the per-field PNG files.
 """
-from collections import (
-    defaultdict,
-    OrderedDict
-    )
-import matplotlib.pyplot as plt
+import os
+import sys
+import argparse as ap
+from datetime import date
+from multiprocessing import Pool
 import numpy as np
 import pymysql
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from archive_autoguider_logs import (
+    concatenateArrays,
+    getGuideLog
+    )
 
 # pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+
+def argParse():
+    """
+    Parse command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('--host', help='database host', default='localhost')
+    p.add_argument('--db', help='database name', default='spec_ops')
+    p.add_argument('--user', help='database user', default='speculoos')
+    p.add_argument('--password', help='database password', default='spec_ops')
+    p.add_argument('--telescope', help='only include references from this telescope')
+    p.add_argument('--night_start',
+                   help='first night to include (YYYY-MM-DD)',
+                   type=date.fromisoformat)
+    p.add_argument('--night_end',
+                   help='last night to include (YYYY-MM-DD)',
+                   type=date.fromisoformat)
+    p.add_argument('--archive_dir',
+                   help='folder of nights archived by archive_autoguider_logs.py, '
+                        'without it only the live table is read')
+    p.add_argument('--clip_sigma',
+                   help='sigma clipping level for the clipped RMS',
+                   type=float,
+                   default=5.0)
+    p.add_argument('--no_plots',
+                   help='print the RMS table only, skip the per-field figures',
+                   action='store_true')
+    p.add_argument('--summary',
+                   help='also write all figures to this multi-page PDF')
+    p.add_argument('--nproc',
+                   help='number of processes used to render the figures',
+                   type=int,
+                   default=os.cpu_count())
+    p.add_argument('--dpi',
+                   help='resolution of the per-field figures',
+                   type=int,
+                   default=300)
+    return p.parse_args()
+
+def fetchShifts(db_info, archive_dir=None, telescope=None, night_start=None, night_end=None):
+    """
+    Fetch the raw shifts for every field/filter, from the
+    live guide log and any archived nights
+
+    Parameters
+    ----------
+    db_info : dict
+        Database connection info with keys host, user,
+        database and password
+    archive_dir : string, optional
+        Folder holding the archive files, None for
+        the live table only
+    telescope : string, optional
+        Only include references from this telescope
+    night_start : datetime.date, optional
+        First night to include
+    night_end : datetime.date, optional
+        Last night to include
+
+    Returns
+    -------
+    keys : np.ndarray
+        field/filter label of each row
+    shift_x : np.ndarray
+        Raw X shift of each row
+    shift_y : np.ndarray
+        Raw Y shift of each row
+
+    Raises
+    ------
+    None
+    """
+    conn = pymysql.connect(host=db_info['host'], db=db_info['database'],
+                           user=db_info['user'], password=db_info['password'])
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT ref_image, field, filter, telescope FROM autoguider_ref")
+            refs = cur.fetchall()
+    finally:
+        conn.close()
+    labels = {ref: '{} {}'.format(field, filt) for ref, field, filt, _ in refs}
+    telescopes = [telescope] if telescope else sorted({tel for *_, tel in refs if tel})
+    parts = [getGuideLog(db_info, tel, archive_dir, night_start, night_end) for tel in telescopes]
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return np.array([], dtype=str), np.array([]), np.array([])
+    log = concatenateArrays(parts)
+    log = log[np.argsort(log['updated'], kind='stable')]
+    # label each distinct reference once rather than every row,
+    # archived rows may outlive their autoguider_ref entry
+    references, index = np.unique(log['reference'], return_inverse=True)
+    keys = np.array([labels.get(reference, reference) for reference in references],
+                    dtype=str)[index]
+    return keys, log['shift_x'].astype(float), log['shift_y'].astype(float)
+
+def groupedStd(group, values, n_groups, mask=None):
+    """
+    Standard deviation of values within each group
+
+    Parameters
+    ----------
+    group : np.ndarray
+        Integer group index of each value
+    values : np.ndarray
+        Values to measure
+    n_groups : int
+        Total number of groups
+    mask : np.ndarray, optional
+        Boolean array of values to include
+
+    Returns
+    -------
+    std : np.ndarray
+        Standard deviation per group, NaN for empty groups
 
-def getUniqueObjectIds():
+    Raises
+    ------
+    None
     """
+    weights = np.ones_like(values) if mask is None else mask.astype(float)
+    n = np.bincount(group, weights=weights, minlength=n_groups)
+    s1 = np.bincount(group, weights=values*weights, minlength=n_groups)
+    s2 = np.bincount(group, weights=values**2*weights, minlength=n_groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / n
+        var = np.clip(s2 / n - mean**2, 0, None)
+    return np.sqrt(var)
+
+def measureRms(keys, shift_x, shift_y, clip_sigma):
+    """
+    Compute raw and sigma clipped RMS per field/filter
+
+    As before, values are clipped if they lie outside
+    +/- clip_sigma * raw RMS of their group
+
+    Parameters
+    ----------
+    keys : np.ndarray
+        field/filter label of each row
+    shift_x : np.ndarray
+        Raw X shift of each row
+    shift_y : np.ndarray
+        Raw Y shift of each row
+    clip_sigma : float
+        Sigma clipping level
+
+    Returns
+    -------
+    labels : np.ndarray
+        Unique field/filter labels
+    group : np.ndarray
+        Index into labels for each row
+    stats : dict
+        n, rms_x, rms_y, rms_x_c and rms_y_c arrays, one value per label
+
+    Raises
+    ------
+    None
+    """
+    labels, group = np.unique(keys, return_inverse=True)
+    n_groups = len(labels)
+    rms_x = groupedStd(group, shift_x, n_groups)
+    rms_y = groupedStd(group, shift_y, n_groups)
+    mask_x = np.abs(shift_x) < clip_sigma*rms_x[group]
+    mask_y = np.abs(shift_y) < clip_sigma*rms_y[group]
+    stats = {'n': np.bincount(group, minlength=n_groups),
+             'rms_x': rms_x,
+             'rms_y': rms_y,
+             'rms_x_c': groupedStd(group, shift_x, n_groups, mask_x),
+             'rms_y_c': groupedStd(group, shift_y, n_groups, mask_y)}
+    return labels, group, stats
+
+def plotField(label, xx, yy, rms_x, rms_y, rms_x_c, rms_y_c):
+    """
+    Plot the shifts of one field/filter
+
+    Parameters
+    ----------
+    label : string
+        field/filter label used for the title
+    xx : np.ndarray
+        X shifts in time order
+    yy : np.ndarray
+        Y shifts in time order
+    rms_x, rms_y : float
+        Raw RMS values
+    rms_x_c, rms_y_c : float
+        Sigma clipped RMS values
+
+    Returns
+    -------
+    fig : matplotlib.figure.Figure
+        The figure, the caller must close it
+
+    Raises
+    ------
+    None
     """
-    qry = """
-        SELECT
-        distinct(field)
-        FROM autoguider_ref
-        """
-    with pymysql.connect(host='localhost', db='spec_ops',
-                         user='speculoos', password='spec_ops') as cur:
-        cur.execute(qry)
-        results = cur.fetchall()
-    object_ids = []
-    for row in results:
-        object_ids.append(row[0])
-    return object_ids
-
-def getReferenceImagesForField(field):
+    fig, ax = plt.subplots(1, figsize=(10, 5))
+    ax.plot(xx, 'r.')
+    ax.plot(yy, 'b.')
+    ax.legend(("RMS_x={:.3f} ({:.3f}) pix".format(rms_x, rms_x_c),
+               "RMS_y={:.3f} ({:.3f}) pix".format(rms_y, rms_y_c)),
+              fontsize=16)
+    ax.set_xlabel('Image number', fontsize=16)
+    ax.set_ylabel('Offset (pixels)', fontsize=16)
+    ax.set_title(label, fontsize=16)
+    fig.subplots_adjust(bottom=0.10, top=0.95, left=0.10, right=0.97)
+    return fig
+
+def renderField(job):
     """
+    Render one field/filter figure to PNG, run in a worker process
+
+    Parameters
+    ----------
+    job : tuple
+        (dpi, plotField arguments...)
+
+    Returns
+    -------
+    filename : string
+        Name of the saved figure
+
+    Raises
+    ------
+    None
     """
-    qry = """
-        SELECT
-        ref_image, filter
-        FROM autoguider_ref
-        WHERE field=%s
-        """
-    qry_args = (field, )
-    with pymysql.connect(host='localhost', db='spec_ops',
-                         user='speculoos', password='spec_ops') as cur:
-        cur.execute(qry, qry_args)
-        results = cur.fetchall()
-    ref_filts = {row[0]: row[1] for row in results}
-    return ref_filts
-
-def getAgStats(ref_image):
+    dpi, plot_args = job[0], job[1:]
+    filename = '{}_donuts.png'.format(plot_args[0].replace(' ', '_'))
+    fig = plotField(*plot_args)
+    fig.savefig(filename, dpi=dpi)
+    plt.close(fig)
+    return filename
+
+def writeSummary(pdf_file, jobs):
     """
+    Write all field/filter figures to a single multi-page PDF
+
+    Parameters
+    ----------
+    pdf_file : string
+        Name of the PDF to write
+    jobs : iterable
+        plotField arguments for each page
+
+    Returns
+    -------
+    None
+
+    Raises
+    ------
+    None
     """
-    qry = """
-        SELECT
-        solution_x, solution_y
-        FROM autoguider_log
-        WHERE reference=%s
-        """
-    qry_args = (ref_image, )
-    with pymysql.connect(host='localhost', db='spec_ops',
-                         user='speculoos', password='spec_ops') as cur:
-        cur.execute(qry, qry_args)
-        results = cur.fetchall()
-    return results
+    with PdfPages(pdf_file) as pdf:
+        for plot_args in jobs:
+            fig = plotField(*plot_args)
+            pdf.savefig(fig)
+            plt.close(fig)
 
 if __name__ == "__main__":
-    object_ids = getUniqueObjectIds()
-    x = OrderedDict()
-    y = OrderedDict()
-    for object_id in object_ids:
-        x[object_id] = defaultdict(list)
-        y[object_id] = defaultdict(list)
-        ref_filts = getReferenceImagesForField(object_id)
-        for ref in ref_filts:
-            stats = getAgStats(ref)
-            for i, row in enumerate(stats):
-                x[object_id][ref_filts[ref]].append(float(row[0]))
-                y[object_id][ref_filts[ref]].append(float(row[1]))
-    # now plot the values and do stats
-    for object_id in x:
-        for filt in x[object_id]:
-            xx = np.array(x[object_id][filt])
-            yy = np.array(y[object_id][filt])
-            fig, ax = plt.subplots(1, figsize=(10, 5))
-            ax.plot(xx, 'r.')
-            ax.plot(yy, 'b.')
-            rms_x = np.std(xx)
-            rms_y = np.std(yy)
-
-            # get stats on clipped data
-            n_x = np.where((xx > -5*rms_x) & (xx < 5*rms_x))
-            n_y = np.where((yy > -5*rms_y) & (yy < 5*rms_y))
-            rms_x_c = np.std(xx[n_x])
-            rms_y_c = np.std(yy[n_y])
-
-            ax.legend(("RMS_x={:.3f} ({:.3f}) pix".format(rms_x, rms_x_c),
-                       "RMS_y={:.3f} ({:.3f}) pix".format(rms_y, rms_y_c)),
-                      fontsize=16)
-            ax.set_xlabel('Image number', fontsize=16)
-            ax.set_ylabel('Offset (pixels)', fontsize=16)
-            ax.set_title('{} {}'.format(object_id, filt), fontsize=16)
-            fig.subplots_adjust(bottom=0.10, top=0.95, left=0.10, right=0.97)
-            fig.savefig('{}_{}_donuts.png'.format(object_id, filt), dpi=300)
+    args = argParse()
+    db_info = {'host': args.host, 'database': args.db,
+               'user': args.user, 'password': args.password}
+    if not args.archive_dir:
+        print('Reading the live guide log only, use --archive_dir to include archived nights')
+    keys, shift_x, shift_y = fetchShifts(db_info, args.archive_dir, args.telescope,
+                                         args.night_start, args.night_end)
+    labels, group, stats = measureRms(keys, shift_x, shift_y, args.clip_sigma)
+    print("{:<40s} {:>7s} {:>8s} {:>8s} {:>8s} {:>8s}".format('field filter', 'n',
+                                                              'rms_x', 'rms_y',
+                                                              'rms_x_c', 'rms_y_c'))
+    for i, label in enumerate(labels):
+        print("{:<40s} {:>7d} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}".format(label, stats['n'][i],
+                                                                          stats['rms_x'][i],
+                                                                          stats['rms_y'][i],
+                                                                          stats['rms_x_c'][i],
+                                                                          stats['rms_y_c'][i]))
+    # rows stay in time order within each group
+    order = np.argsort(group, kind='stable')
+    bounds = np.cumsum(stats['n'])[:-1]
+    plot_jobs = [(labels[i], xx, yy, stats['rms_x'][i], stats['rms_y'][i],
+                  stats['rms_x_c'][i], stats['rms_y_c'][i])
+                 for i, (xx, yy) in enumerate(zip(np.split(shift_x[order], bounds),
+                                                  np.split(shift_y[order], bounds)))]
+    if not args.no_plots and plot_jobs:
+        with Pool(max(1, min(args.nproc, len(plot_jobs)))) as pool:
+            for filename in pool.imap_unordered(renderField,
+                                                [(args.dpi, ) + job for job in plot_jobs]):
+                print('Saved {}'.format(filename))
+    if args.summary:
+        writeSummary(args.summary, plot_jobs)
+        print('Saved {}'.format(args.summary))
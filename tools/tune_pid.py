@@ -0,0 +1,413 @@
+"""
+Tune the PID loop coefficients offline from logged guiding
+
+Replaces the on-sky PID plans (PID_plans/, one night cycling through
+P/I values on one field). For each instrument:
+
+    1. The raw shifts and applied corrections are read from
+       autoguider_log_new and the nights archived out of it by
+       archive_autoguider_logs.py, for the references of that telescope
+    2. The uncorrected motion of the field is rebuilt by adding the
+       corrections already sent back onto the measured shifts
+    3. A drift plus noise model is fitted to it: a linear drift per
+       field, a random walk and white (seeing/measurement) noise
+    4. The guide loop is simulated on motion drawn from that model for
+       every (P, I, D) on a grid, all candidates at once in NumPy, and
+       the residual RMS of each is measured
+    5. The candidate with the lowest residual RMS is recommended per
+       axis, alongside the RMS the configured PID_COEFFS give
+
+e.g.
+
+    $> python tune_pid.py io europa --night_start 2024-01-01
+
+The simulation follows acp_ag.py: a shift moves by minus the correction
+sent, frames with a shift over MAX_ERROR_PIXELS leave the PID alone and
+corrections over it are not sent. The candidates and simulated runs are
+one PID.PIDBank. Stabilisation and the buffer rejection are not
+modelled, the first --burn_in frames are ignored.
+Time is counted in frames, so the drift is in pixels per frame.
+"""
+import os
+import sys
+import json
+import argparse as ap
+from datetime import date
+import numpy as np
+import pymysql
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PID import PIDBank
+from archive_autoguider_logs import (
+    ARCHIVE_SUBDIR,
+    getGuideLog
+    )
+from utils import (
+    INSTRUMENT_CONFIGS,
+    get_config_values
+    )
+
+# pylint: disable=invalid-name
+# pylint: disable=wrong-import-position
+
+def argParse():
+    """
+    Parse command line arguments
+    """
+    p = ap.ArgumentParser()
+    p.add_argument('instruments',
+                   help='instruments to tune, default all',
+                   nargs='*',
+                   choices=sorted(INSTRUMENT_CONFIGS))
+    p.add_argument('--night_start',
+                   help='first night to include (YYYY-MM-DD)',
+                   type=date.fromisoformat)
+    p.add_argument('--night_end',
+                   help='last night to include (YYYY-MM-DD)',
+                   type=date.fromisoformat)
+    p.add_argument('--archive_dir',
+                   help='folder of nights archived by archive_autoguider_logs.py '
+                        '(default = BASE_DIR\\autoguider_archive of each instrument)')
+    p.add_argument('--p_values',
+                   help='P coefficients to try',
+                   type=float,
+                   nargs='+',
+                   default=[round(v, 2) for v in np.arange(0.1, 1.31, 0.1)])
+    p.add_argument('--i_values',
+                   help='I coefficients to try',
+                   type=float,
+                   nargs='+',
+                   default=[0.0, 0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5])
+    p.add_argument('--d_values',
+                   help='D coefficients to try',
+                   type=float,
+                   nargs='+',
+                   default=[0.0, 0.1, 0.2, 0.5])
+    p.add_argument('--min_frames',
+                   help='shortest run of frames on one reference used to fit the model',
+                   type=int,
+                   default=50)
+    p.add_argument('--n_frames',
+                   help='frames per simulated run',
+                   type=int,
+                   default=500)
+    p.add_argument('--n_runs',
+                   help='simulated runs per candidate',
+                   type=int,
+                   default=50)
+    p.add_argument('--burn_in',
+                   help='frames at the start of each run left out of the RMS',
+                   type=int,
+                   default=20)
+    p.add_argument('--seed',
+                   help='random number seed',
+                   type=int,
+                   default=42)
+    p.add_argument('--out',
+                   help='JSON file to write the models and recommendations to')
+    return p.parse_args()
+
+def fetchGuiding(config, instrument, archive_dir, night_start=None, night_end=None):
+    """
+    Fetch the logged shifts and corrections of one telescope,
+    from the live guide log and its archives
+
+    Parameters
+    ----------
+    config : dict
+        Instrument configuration values, for the database details
+    instrument : string
+        Telescope name used in autoguider_ref
+    archive_dir : string
+        Folder holding the telescope's archive files
+    night_start : datetime.date, optional
+        First night to include
+    night_end : datetime.date, optional
+        Last night to include
+
+    Returns
+    -------
+    data : dict
+        Arrays in time order: run (index of the run of consecutive
+        frames on one night and reference), shift_x, shift_y,
+        post_pid_x, post_pid_y and stabilised (boolean)
+
+    Raises
+    ------
+    None
+    """
+    db_info = {'host': config['DB_HOST'], 'user': config['DB_USER'],
+               'database': config['DB_DATABASE'], 'password': config['DB_PASS']}
+    log = getGuideLog(db_info, instrument, archive_dir, night_start, night_end)
+    if len(log):
+        keys = np.char.add(log['night'].astype(str), log['reference'].astype(str))
+        values = np.column_stack([log[column] for column in ('shift_x', 'shift_y',
+                                                             'post_pid_x', 'post_pid_y')])
+        stabilised = log['stabilised'] == 'y'
+    else:
+        values = np.empty((0, 4))
+        keys, stabilised = np.array([], dtype=str), np.array([], dtype=bool)
+    # a new run starts whenever the night or reference changes
+    run = np.cumsum(np.concatenate([[True], keys[1:] != keys[:-1]])) - 1 if len(keys) else keys
+    return {'run': run.astype(int),
+            'shift_x': values[:, 0], 'shift_y': values[:, 1],
+            'post_pid_x': values[:, 2], 'post_pid_y': values[:, 3],
+            'stabilised': stabilised}
+
+def uncorrectedMotion(run, shift, post_pid, stabilised, max_error, max_error_stabil):
+    """
+    Rebuild the motion of the field without guiding
+
+    Each frame's shift is the motion so far minus every correction
+    already sent during the run, so adding those back gives the motion
+
+    Parameters
+    ----------
+    run : np.ndarray
+        Run index of each frame, runs are contiguous
+    shift : np.ndarray
+        Measured shift of each frame
+    post_pid : np.ndarray
+        Correction calculated after each frame
+    stabilised : np.ndarray
+        Was the field stabilised at each frame
+    max_error : float
+        MAX_ERROR_PIXELS, larger corrections are not sent
+    max_error_stabil : float
+        MAX_ERROR_STABIL_PIXELS, the same during stabilisation
+
+    Returns
+    -------
+    motion : np.ndarray
+        Uncorrected motion at each frame
+
+    Raises
+    ------
+    None
+    """
+    limit = np.where(stabilised, max_error, max_error_stabil)
+    applied = np.where(np.abs(post_pid) <= limit, post_pid, 0.)
+    total = np.concatenate([[0.], np.cumsum(applied)])
+    # index of the first frame of each frame's run
+    start = np.searchsorted(run, run, side='left')
+    return shift + total[:-1] - total[start]
+
+def robustVariance(values):
+    """
+    Variance from the median absolute deviation, so the
+    odd clouded or trailed frame does not inflate it
+    """
+    if len(values) == 0:
+        return 0.
+    return (1.4826 * np.median(np.abs(values - np.median(values))))**2
+
+def fitDriftNoise(run, motion, min_frames):
+    """
+    Fit a linear drift per run plus a random walk and white noise
+
+    With the drift removed, the variance of the differences between
+    frames k apart is 2*white**2 + k*walk**2, so the lag 1 and lag 2
+    differences give both noise terms
+
+    Parameters
+    ----------
+    run : np.ndarray
+        Run index of each frame
+    motion : np.ndarray
+        Uncorrected motion of each frame, see uncorrectedMotion
+    min_frames : int
+        Runs shorter than this are left out
+
+    Returns
+    -------
+    model : dict | None
+        drift (pixels per frame of each run used), walk and white
+        (noise RMS in pixels), n_runs and n_frames used, None if
+        no run is long enough
+
+    Raises
+    ------
+    None
+    """
+    n_runs = run.max() + 1 if len(run) else 0
+    n = np.bincount(run, minlength=n_runs)
+    keep = (n >= min_frames)[run]
+    if not keep.any():
+        return None
+    start = np.searchsorted(run, run, side='left')
+    k = (np.arange(len(run)) - start).astype(float)
+    # least squares line per run, from grouped sums
+    sk = np.bincount(run, k, n_runs)
+    sm = np.bincount(run, motion, n_runs)
+    skk = np.bincount(run, k*k, n_runs)
+    skm = np.bincount(run, k*motion, n_runs)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (n*skm - sk*sm) / (n*skk - sk**2)
+        intercept = (sm - slope*sk) / n
+    residual = motion - intercept[run] - slope[run]*k
+    lag_var = []
+    for lag in (1, 2):
+        same_run = (run[lag:] == run[:-lag]) & keep[lag:]
+        lag_var.append(robustVariance((residual[lag:] - residual[:-lag])[same_run]))
+    walk2 = max(lag_var[1] - lag_var[0], 0.)
+    white2 = max((2*lag_var[0] - lag_var[1]) / 2., 0.)
+    used = np.unique(run[keep])
+    return {'drift': slope[used],
+            'walk': float(np.sqrt(walk2)),
+            'white': float(np.sqrt(white2)),
+            'n_runs': int(len(used)),
+            'n_frames': int(keep.sum())}
+
+def simulateMotion(model, n_runs, n_frames, rng):
+    """
+    Draw uncorrected motion from a fitted model
+
+    Parameters
+    ----------
+    model : dict
+        See fitDriftNoise
+    n_runs : int
+        Number of runs to draw
+    n_frames : int
+        Frames per run
+    rng : np.random.Generator
+        Random number generator
+
+    Returns
+    -------
+    motion : np.ndarray
+        Shape (n_runs, n_frames), drift rates are resampled
+        from the fitted runs
+
+    Raises
+    ------
+    None
+    """
+    k = np.arange(n_frames)
+    drift = rng.choice(model['drift'], n_runs)[:, np.newaxis] * k
+    walk = np.cumsum(rng.normal(0., model['walk'], (n_runs, n_frames)), axis=1)
+    white = rng.normal(0., model['white'], (n_runs, n_frames))
+    return drift + walk + white
+
+def simulatePid(motion, kp, ki, kd, set_point, max_error, burn_in):
+    """
+    Run the guide loop for many PID candidates at once
+
+    Parameters
+    ----------
+    motion : np.ndarray
+        Uncorrected motion, shape (n_runs, n_frames)
+    kp, ki, kd : np.ndarray
+        Coefficients of each candidate, shape (n_candidates,)
+    set_point : float
+        PID set point, see PID_COEFFS
+    max_error : float
+        MAX_ERROR_PIXELS
+    burn_in : int
+        Frames at the start of each run left out of the RMS
+
+    Returns
+    -------
+    rms : np.ndarray
+        Residual shift RMS of each candidate, shape (n_candidates,)
+
+    Raises
+    ------
+    None
+    """
+    kp, ki, kd = (np.asarray(c, dtype=float)[:, np.newaxis] for c in (kp, ki, kd))
+    # one controller per candidate and run
+    bank = PIDBank(kp, ki, kd, set_point, shape=(kp.shape[0], motion.shape[0]))
+    corrected = np.zeros(bank.shape)
+    sum_sq = np.zeros(bank.shape)
+    for i in range(motion.shape[1]):
+        shift = motion[:, i] - corrected
+        if i >= burn_in:
+            sum_sq += shift**2
+        # culled frames do not reach the PID, as in acp_ag.py
+        correction = bank.update(shift, active=np.abs(shift) <= max_error) * -1
+        # and guide() does not send corrections over the limit
+        corrected += np.where(np.abs(correction) <= max_error, correction, 0.)
+    return np.sqrt(sum_sq.mean(axis=1) / max(motion.shape[1] - burn_in, 1))
+
+def tuneAxis(model, coeffs, set_point, max_error, args, rng):
+    """
+    Find the best PID coefficients on a grid for one axis
+
+    Parameters
+    ----------
+    model : dict
+        See fitDriftNoise
+    coeffs : dict
+        Configured coefficients, p, i and d
+    set_point : float
+        PID set point
+    max_error : float
+        MAX_ERROR_PIXELS
+    args : argparse.Namespace
+        Grid and simulation settings
+    rng : np.random.Generator
+        Random number generator
+
+    Returns
+    -------
+    result : dict
+        Recommended p, i, d and rms, and the current rms
+
+    Raises
+    ------
+    None
+    """
+    grid = np.array(np.meshgrid(args.p_values, args.i_values, args.d_values,
+                                indexing='ij')).reshape(3, -1)
+    # the configured coefficients go last, on the same simulated motion
+    grid = np.column_stack([grid, [coeffs['p'], coeffs['i'], coeffs['d']]])
+    motion = simulateMotion(model, args.n_runs, args.n_frames, rng)
+    rms = simulatePid(motion, grid[0], grid[1], grid[2], set_point, max_error, args.burn_in)
+    best = int(np.nanargmin(rms[:-1]))
+    return {'p': float(grid[0, best]), 'i': float(grid[1, best]), 'd': float(grid[2, best]),
+            'rms': float(rms[best]), 'current_rms': float(rms[-1])}
+
+if __name__ == "__main__":
+    args = argParse()
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    for instrument in args.instruments or sorted(INSTRUMENT_CONFIGS):
+        config = get_config_values(instrument)
+        archive_dir = args.archive_dir or os.path.join(config['BASE_DIR'], ARCHIVE_SUBDIR)
+        try:
+            data = fetchGuiding(config, instrument, archive_dir,
+                                args.night_start, args.night_end)
+        except pymysql.MySQLError as err:
+            print('{}: cannot read the guide log: {}'.format(instrument, err))
+            continue
+        results[instrument] = {}
+        for axis in ('x', 'y'):
+            motion = uncorrectedMotion(data['run'], data['shift_{}'.format(axis)],
+                                       data['post_pid_{}'.format(axis)], data['stabilised'],
+                                       config['MAX_ERROR_PIXELS'],
+                                       config['MAX_ERROR_STABIL_PIXELS'])
+            model = fitDriftNoise(data['run'], motion, args.min_frames)
+            if model is None:
+                print('{} {}: no runs of {} frames or more, skipping'.format(instrument, axis,
+                                                                          args.min_frames))
+                continue
+            result = tuneAxis(model, config['PID_COEFFS'][axis],
+                              config['PID_COEFFS']['set_{}'.format(axis)],
+                              config['MAX_ERROR_PIXELS'], args, rng)
+            # keep the per run drift rates out of the JSON
+            model['drift_rms'] = float(np.sqrt(np.mean(model.pop('drift')**2)))
+            print('{} {}: drift {drift_rms:.4f} pix/frame walk {walk:.3f} white {white:.3f} '
+                  '({n_runs} runs, {n_frames} frames)'.format(instrument, axis, **model))
+            print('{} {}: P={p:.2f} I={i:.2f} D={d:.2f} rms {rms:.3f} pix '
+                  '(configured {current_rms:.3f} pix)'.format(instrument, axis, **result))
+            results[instrument][axis] = {'model': model, 'recommended': result}
+        if len(results[instrument]) == 2:
+            rec = {axis: results[instrument][axis]['recommended'] for axis in ('x', 'y')}
+            print("{}: PID_COEFFS = {{'x': {{'p': {p:.2f}, 'i': {i:.2f}, 'd': {d:.2f}}}, ".format(
+                instrument, **rec['x']) +
+                  "'y': {{'p': {p:.2f}, 'i': {i:.2f}, 'd': {d:.2f}}}, ...}}".format(**rec['y']))
+    if args.out:
+        with open(args.out, 'w') as of:
+            json.dump(results, of, indent=2)
+        print('Results written to {}'.format(args.out))
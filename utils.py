@@ -1,8 +1,19 @@
 """
 Some useful utilities for donuts
 """
+import importlib
 from datetime import datetime
 
+# instrument name -> configuration module
+INSTRUMENT_CONFIGS = {'nites': 'nites',
+                      'io': 'speculoos_io',
+                      'callisto': 'speculoos_callisto',
+                      'europa': 'speculoos_europa',
+                      'ganymede': 'speculoos_ganymede',
+                      'saintex': 'saintex',
+                      'artemis': 'speculoos_artemis',
+                      'rcos20': 'rcos20'}
+
 class ag_status:
     """
     Class to hold status flags
@@ -16,3 +27,17 @@ def log_debug(message):
     location = "C:\\donuts_debugging.txt"
     with open(location, 'a') as dlf:
         dlf.write('{} {}\n'.format(datetime.utcnow(), message))
+
+def load_config(instrument):
+    """
+    Import the configuration module for an instrument
+    """
+    return importlib.import_module(INSTRUMENT_CONFIGS[instrument])
+
+def get_config_values(instrument):
+    """
+    Return an instrument's configuration parameters as a dict,
+    equivalent to 'from <config> import *'
+    """
+    config = load_config(instrument)
+    return {key: value for key, value in vars(config).items() if key.isupper()}